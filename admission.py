@@ -0,0 +1,140 @@
+"""
+Допуск входящих обновлений к обработчикам: лимит частоты на пользователя, отсев повторных оформлений
+и сброс неважных обновлений, когда очередь диспетчера глубокая.
+
+Проверка идёт до журнала обновлений: отброшенное обновление не пишется в базу, не создаёт заказ,
+не дёргает LiqPay и не шлёт уведомление админу. Всё состояние в памяти и ограничено max_users.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Collection, Dict, NamedTuple
+
+from ratelimit import KeyedBuckets
+
+# чем меньше число, тем позже обновление сбрасывается при нагрузке
+TIER_ADMIN = 0
+TIER_CHECKOUT = 1
+TIER_INTERACTIVE = 2
+TIER_LOW = 3
+
+# доля заполнения очереди диспетчера, с которой обновления этого уровня отбрасываются (None - никогда)
+DEFAULT_SHED_LEVELS = {
+    TIER_ADMIN: None,
+    TIER_CHECKOUT: None,
+    TIER_INTERACTIVE: 0.8,
+    TIER_LOW: 0.5,
+}
+
+
+class Decision(NamedTuple):
+    admitted: bool
+    reason: str = ""
+    # предупредить покупателя (не чаще раза в notice_interval): отброшено оформление заказа
+    notify: bool = False
+    retry_after: float = 0.0
+
+
+ADMITTED = Decision(True)
+
+
+def update_user(upd: Dict[str, Any]) -> int | None:
+    if "message" in upd:
+        msg = upd["message"]
+        return msg.get("from", {}).get("id", msg.get("chat", {}).get("id"))
+    if "callback_query" in upd:
+        return upd["callback_query"].get("from", {}).get("id")
+    return None
+
+
+def update_tier(upd: Dict[str, Any]) -> int:
+    if "callback_query" in upd:
+        return TIER_INTERACTIVE
+    msg = upd.get("message", {})
+    if "web_app_data" in msg:
+        return TIER_CHECKOUT
+    if (msg.get("text") or "").startswith("/"):
+        return TIER_INTERACTIVE
+    return TIER_LOW
+
+
+def _checkout_key(user: int, data: str) -> tuple:
+    return user, hashlib.blake2b(data.encode("utf-8"), digest_size=8).digest()
+
+
+class Admission:
+    """
+    rate/burst - обновлений в секунду на пользователя и запас на всплеск;
+    checkout_rate/checkout_burst - отдельный, более строгий лимит на web_app_data;
+    повтор того же web_app_data от того же пользователя в течение dedup_seconds отбрасывается;
+    max_pending - ёмкость очереди диспетчера, от неё считаются shed_levels.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: float = 10, checkout_rate: float = 0.05, checkout_burst: float = 3,
+                 dedup_seconds: float = 30, max_pending: int = 200, shed_levels: Dict[int, float | None] | None = None,
+                 admins: Collection[int] = (), max_users: int = 10000, notice_interval: float = 60):
+        self.dedup_seconds = dedup_seconds
+        self.max_pending = max(1, max_pending)
+        self.shed_levels = dict(DEFAULT_SHED_LEVELS if shed_levels is None else shed_levels)
+        self.admins = frozenset(admins)
+        self.max_users = max_users
+        self._updates = KeyedBuckets(rate, burst, max_users)
+        self._checkouts = KeyedBuckets(checkout_rate, checkout_burst, max_users)
+        self._notices = KeyedBuckets(1 / notice_interval, 1, max_users)
+        # (user_id, digest payload) -> когда принят; по возрастанию времени, поэтому чистится с начала
+        self._recent: "OrderedDict[tuple, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, upd: Dict[str, Any], queue_depth: int = 0, now: float | None = None) -> Decision:
+        user = update_user(upd)
+        tier = TIER_ADMIN if user in self.admins else update_tier(upd)
+        if tier == TIER_ADMIN or user is None:
+            return ADMITTED
+
+        level = self.shed_levels.get(tier)
+        if level is not None and queue_depth >= self.max_pending * level:
+            return Decision(False, "shed")
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if tier == TIER_CHECKOUT:
+                return self._check_checkout(user, upd["message"]["web_app_data"].get("data", ""), now)
+            wait = self._updates.get(user, now).take(now)
+            if wait:
+                return Decision(False, "rate", retry_after=wait)
+        return ADMITTED
+
+    def revert(self, upd: Dict[str, Any]) -> None:
+        """
+        Отменяет учёт допущенного обновления, если его не удалось принять (журнал не записался):
+        токены возвращаются, отпечаток оформления забывается - повторная доставка не будет сочтена дублем.
+        """
+        user = update_user(upd)
+        if user is None or user in self.admins:
+            return
+        with self._lock:
+            self._updates.get(user).give_back()
+            if update_tier(upd) == TIER_CHECKOUT:
+                self._checkouts.get(user).give_back()
+                self._recent.pop(_checkout_key(user, upd["message"]["web_app_data"].get("data", "")), None)
+
+    def _check_checkout(self, user: int, data: str, now: float) -> Decision:
+        while self._recent and (next(iter(self._recent.values())) < now - self.dedup_seconds
+                                or len(self._recent) > self.max_users):
+            self._recent.popitem(last=False)
+        key = _checkout_key(user, data)
+        if key in self._recent:
+            return Decision(False, "duplicate")
+        # оформление расходует и общий лимит, чтобы web_app_data не обходил его
+        wait = self._checkouts.get(user, now).wait_time(now) or self._updates.get(user, now).wait_time(now)
+        if wait:
+            return Decision(False, "checkout_rate", notify=self._notices.get(user, now).take(now) == 0,
+                            retry_after=wait)
+        self._checkouts.get(user, now).take(now)
+        self._updates.get(user, now).take(now)
+        self._recent[key] = now
+        return ADMITTED
+
+    def __len__(self) -> int:
+        return len(self._updates)
@@ -0,0 +1,89 @@
+﻿"""
+Локальная заглушка серверного API LiqPay (POST /api/request) для проверки reconcile.py.
+
+Проверяет подпись запроса тем же ключом, что и бот, и на action=status отвечает
+статусом из таблицы payments; для неизвестных заказов - payment_not_found.
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Tuple
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import liqpay  # noqa: E402
+
+
+class _LiqPayHandler(BaseHTTPRequestHandler):
+    server: "FakeLiqPayServer"
+    protocol_version = "HTTP/1.1"
+    # заголовки и тело уходят отдельными write: без TCP_NODELAY keep-alive ловит задержку Nagle/delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        form = {k: v[-1] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        result = self.server.call(form.get("data", ""), form.get("signature", ""))
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeLiqPayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, private_key: str, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.05, jitter: float = 0.0):
+        super().__init__((host, port), _LiqPayHandler)
+        self.private_key = private_key
+        self.latency = latency
+        self.jitter = jitter
+        self.payments: Dict[str, Tuple[str, float]] = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/request"
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+    def start(self) -> threading.Thread:
+        t = threading.Thread(target=self.serve_forever, name="fake-liqpay", daemon=True)
+        t.start()
+        return t
+
+    def set_payment(self, order_id: int | str, status: str, amount: float) -> None:
+        self.payments[str(order_id)] = (status, amount)
+
+    def call(self, data: str, signature: str) -> Dict[str, Any]:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if not liqpay.verify_signature(data, signature, self.private_key):
+            return {"result": "error", "status": "error", "err_code": "err_signature"}
+        params = liqpay.decode_data(data)
+        if params.get("action") != "status":
+            return {"result": "error", "status": "error", "err_code": "err_action"}
+        payment = self.payments.get(str(params.get("order_id")))
+        if payment is None:
+            return {"result": "error", "status": "error", "err_code": "payment_not_found"}
+        status, amount = payment
+        response = {"result": "ok", "action": "pay", "status": status, "order_id": str(params["order_id"]),
+                    "amount": amount, "currency": "UAH", "payment_id": random.randint(10**8, 10**9)}
+        if status == "failure":
+            response["err_code"] = "limit"
+        return response
@@ -0,0 +1,154 @@
+﻿"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов.
+
+Реализует getUpdates (long polling с offset), sendMessage, answerCallbackQuery,
+editMessageText и несколько служебных методов. Каждый вызов выполняется с настраиваемой
+задержкой, чтобы имитировать сетевой round-trip до api.telegram.org.
+
+Для замера end-to-end задержки заглушка запоминает, когда обновление стало доступно
+боту, и когда бот на него ответил: sendMessage в чат покупателя для оформления заказа
+или answerCallbackQuery с тем же id для callback'а.
+"""
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    server: "FakeTelegramServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _params(self) -> Dict[str, Any]:
+        parsed = urlparse(self.path)
+        params: Dict[str, Any] = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+        return params
+
+    def _handle(self) -> None:
+        method = urlparse(self.path).path.rstrip("/").rsplit("/", 1)[-1]
+        params = self._params()
+        result = self.server.call(method, params)
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.05, jitter: float = 0.0):
+        super().__init__((host, port), _ApiHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self._cond = threading.Condition()
+        self._updates: List[Dict[str, Any]] = []
+        self._next_update_id = 1
+        self.polled = threading.Event()
+        # ключ ожидания -> (update_id, время появления обновления)
+        self._waiting: Dict[Tuple[str, Any], Tuple[int, float]] = {}
+        self.completed: Dict[int, float] = {}
+        self.injected: Dict[int, Tuple[str, float]] = {}
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # бот закрывает keep-alive соединения при остановке - это не ошибка заглушки
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+    def start(self) -> threading.Thread:
+        t = threading.Thread(target=self.serve_forever, name="fake-telegram", daemon=True)
+        t.start()
+        return t
+
+    # === Обновления ===
+    def inject(self, update: Dict[str, Any], kind: str) -> int:
+        """Добавляет обновление в очередь getUpdates и возвращает присвоенный update_id."""
+        with self._cond:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            update = dict(update, update_id=update_id)
+            now = time.perf_counter()
+            self._updates.append(update)
+            self.injected[update_id] = (kind, now)
+            self._waiting[self._completion_key(update)] = (update_id, now)
+            self._cond.notify_all()
+        return update_id
+
+    @staticmethod
+    def _completion_key(update: Dict[str, Any]) -> Tuple[str, Any]:
+        if "callback_query" in update:
+            return "callback", update["callback_query"]["id"]
+        return "chat", update["message"]["chat"]["id"]
+
+    def _complete(self, key: Tuple[str, Any]) -> None:
+        with self._cond:
+            entry = self._waiting.pop(key, None)
+            if entry:
+                self.completed[entry[0]] = time.perf_counter()
+                self._cond.notify_all()
+
+    def wait_completed(self, count: int, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self.completed) >= count, timeout)
+
+    def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        self.polled.set()
+        with self._cond:
+            # подтверждённые (update_id < offset) обновления больше не отдаются
+            if offset:
+                self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            self._cond.wait_for(lambda: self._updates, timeout)
+            return self._updates[:limit]
+
+    # === Методы API ===
+    def call(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        with self._cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return {"ok": True, "result": self._get_updates(params)}
+
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if method == "sendMessage":
+            self._complete(("chat", int(params["chat_id"])))
+            with self._cond:
+                self._message_id += 1
+                message_id = self._message_id
+            return {"ok": True, "result": {"message_id": message_id, "chat": {"id": int(params["chat_id"])},
+                                           "date": int(time.time()), "text": params.get("text", "")}}
+        if method == "answerCallbackQuery":
+            self._complete(("callback", params["callback_query_id"]))
+            return {"ok": True, "result": True}
+        if method in ("editMessageText", "setWebhook", "deleteWebhook"):
+            return {"ok": True, "result": True}
+        if method == "getMe":
+            return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+        return {"ok": False, "error_code": 404, "description": f"Not Found: method {method} not implemented"}
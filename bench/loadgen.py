@@ -0,0 +1,64 @@
+﻿"""
+Генератор синтетического трафика: оформления заказов из WebApp и callback'и админа.
+"""
+import json
+import random
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+CUSTOMER_CHAT_BASE = 5_000_000
+
+
+def load_catalog(path: str) -> List[Tuple[int, List[str]]]:
+    with open(path, "r", encoding="utf-8") as f:
+        products = json.load(f)
+    return [(int(p["id"]), [str(o["id"]) for o in p.get("options") or []]) for p in products]
+
+
+def checkout_update(n: int, catalog: List[Tuple[int, List[str]]], rng: random.Random) -> Dict[str, Any]:
+    chat_id = CUSTOMER_CHAT_BASE + n
+    items = []
+    for _ in range(rng.randint(1, 4)):
+        pid, options = rng.choice(catalog)
+        items.append({"productId": pid, "optionId": rng.choice(options) if options else None, "qty": rng.randint(1, 3)})
+    payload = {
+        "action": "cart_checkout",
+        "items": items,
+        "contact": {"name": f"Bench {n}", "phone": f"+38050{n:07d}", "address": "Київ", "comment": ""},
+    }
+    return {
+        "message": {
+            "message_id": n,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "first_name": "Bench", "last_name": str(n), "username": f"bench{n}"},
+            "web_app_data": {"data": json.dumps(payload), "button_text": "Открыть Shop"},
+        }
+    }
+
+
+def admin_callback_update(n: int, admin_id: int, order_ids: List[int], rng: random.Random) -> Dict[str, Any]:
+    if order_ids and rng.random() < 0.5:
+        data = f"status_{rng.choice(order_ids)}_{rng.choice(['processing', 'completed'])}"
+    else:
+        data = f"orders_{rng.choice(['new', 'processing', 'completed', 'all'])}"
+    return {
+        "callback_query": {
+            "id": f"bench-{n}",
+            "from": {"id": admin_id, "first_name": "Admin"},
+            "message": {"message_id": 1, "chat": {"id": admin_id, "type": "private"}, "date": int(time.time())},
+            "chat_instance": "bench",
+            "data": data,
+        }
+    }
+
+
+def generate(count: int, admin_ratio: float, admin_id: int, order_ids: List[int],
+             catalog: List[Tuple[int, List[str]]], seed: int = 1) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Выдаёт пары (вид, обновление); update_id проставляет заглушка при инъекции."""
+    rng = random.Random(seed)
+    for n in range(count):
+        if rng.random() < admin_ratio:
+            yield "admin_callback", admin_callback_update(n, admin_id, order_ids, rng)
+        else:
+            yield "checkout", checkout_update(n, catalog, rng)
@@ -0,0 +1,71 @@
+﻿"""
+Прогон сверки оплат (reconcile.py) против локальной заглушки LiqPay.
+
+Запуск (из корня репозитория):
+    python bench/reconcile_run.py --orders 3000 --latency 0.05 --workers 32
+
+Создаёт временную базу с pending-заказами "двухчасовой давности", раскладывает им
+статусы в заглушке (success / failure / не найден / в обработке) и печатает сводку прогона.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from fake_liqpay import FakeLiqPayServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRIVATE_KEY = "bench_private_key"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Сверка оплат против заглушки LiqPay")
+    parser.add_argument("--orders", type=int, default=2000, help="pending-заказов в базе")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа LiqPay, с")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix="reconcile-"), "bench.db")
+    os.environ["DB_PATH"] = db_path
+    sys.path.insert(0, ROOT)
+    import liqpay
+    import reconcile
+    import storage
+
+    storage.DB_PATH = db_path
+    storage.init_db()
+    items = [{"product_id": None, "option_id": None, "name": "Seed", "price": 100, "qty": 1}]
+    order_ids = [storage.save_order_to_db(1000 + n, f"Seed {n}", items, 100, {}) for n in range(args.orders)]
+    with storage.transaction() as conn:
+        conn.execute("UPDATE orders SET created_at = datetime('now', '-2 hours')")
+
+    server = FakeLiqPayServer(PRIVATE_KEY, latency=args.latency)
+    server.start()
+    rng = random.Random(1)
+    for oid in order_ids:
+        kind = rng.random()
+        if kind < 0.6:
+            server.set_payment(oid, "success", 100)
+        elif kind < 0.75:
+            server.set_payment(oid, "failure", 100)
+        elif kind < 0.85:
+            server.set_payment(oid, "processing", 100)
+
+    client = liqpay.LiqPayClient("bench_public_key", PRIVATE_KEY, api_url=server.api_url, pool_size=args.workers)
+    try:
+        report = reconcile.reconcile(client, age_minutes=30, workers=args.workers, limit=args.orders,
+                                     batch_size=args.batch_size)
+    finally:
+        server.shutdown()
+
+    print(f"Проверено: {report['checked']}, со статусом: {report['resolved']}, пропущено: {report['skipped']}")
+    print("Результаты:", ", ".join(f"{k}={v}" for k, v in sorted(report["results"].items())))
+    print(f"Оплачено: {len(report['paid'])}, запросов к LiqPay: {server.calls}")
+    print(f"Время: {report['elapsed_s']} с ({report['checked'] / report['elapsed_s']:.0f} заказов/с)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+﻿"""
+Нагрузочный прогон бота против локальной заглушки Telegram Bot API.
+
+Запуск (из корня репозитория):
+    python bench/run.py --count 2000 --latency 0.05
+    BOT_WORKERS=8 python bench/run.py --count 5000 --rate 200 --unthrottled --json
+
+Бот запускается отдельным процессом (python bot.py) с TELEGRAM_API_BASE, указывающим на
+заглушку, и временной базой. Отчёт: updates/s и p50/p95/p99 задержки от появления
+обновления в getUpdates до ответа бота.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from fake_telegram import FakeTelegramServer
+from loadgen import generate, load_catalog
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_ID = 42
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    ms = [v * 1000 for v in values]
+    return {
+        "count": len(ms),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "max_ms": round(max(ms), 2) if ms else 0.0,
+    }
+
+
+def seed_orders(db_path: str, count: int) -> List[int]:
+    """Создаёт схему и заказы, по которым админ будет листать списки и менять статусы."""
+    os.environ["DB_PATH"] = db_path
+    sys.path.insert(0, ROOT)
+    import storage
+
+    storage.DB_PATH = db_path
+    storage.init_db()
+    items = [{"product_id": None, "option_id": None, "name": "Seed", "price": 100, "qty": 1}]
+    return [
+        storage.save_order_to_db(1000 + n, f"Seed {n}", items, 100, {"name": f"Seed {n}"})
+        for n in range(count)
+    ]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон bot.py против заглушки Bot API")
+    parser.add_argument("--count", type=int, default=1000, help="сколько обновлений отправить")
+    parser.add_argument("--admin-ratio", type=float, default=0.2, help="доля callback'ов админа")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка каждого вызова API, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, с")
+    parser.add_argument("--rate", type=float, default=0, help="обновлений в секунду (0 - всё сразу)")
+    parser.add_argument("--seed-orders", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--unthrottled", action="store_true", help="снять лимиты отправки Telegram в боте")
+    parser.add_argument("--bot-log", help="файл для вывода бота (по умолчанию не сохраняется)")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    db_path = os.path.join(workdir, "bench.db")
+    order_ids = seed_orders(db_path, args.seed_orders)
+
+    server = FakeTelegramServer(latency=args.latency, jitter=args.jitter)
+    server.start()
+
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": "bench:token",
+        "TELEGRAM_API_BASE": server.base_url,
+        "ADMIN_CHAT_ID": str(ADMIN_ID),
+        "DB_PATH": db_path,
+        "BOT_MODE": "polling",
+        "BOT_METRICS_PORT": os.getenv("BOT_METRICS_PORT", "0"),
+    })
+    if args.unthrottled:
+        env.update({"SEND_GLOBAL_RATE": "1000000", "SEND_CHAT_RATE": "1000000"})
+    log = open(args.bot_log, "w") if args.bot_log else subprocess.DEVNULL
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], cwd=ROOT, env=env, stdout=log, stderr=log)
+
+    try:
+        if not server.polled.wait(30):
+            print("Бот не начал опрос getUpdates", file=sys.stderr)
+            return 1
+
+        catalog = load_catalog(os.path.join(ROOT, "products.json"))
+        started = time.perf_counter()
+        for n, (kind, update) in enumerate(generate(args.count, args.admin_ratio, ADMIN_ID, order_ids, catalog)):
+            if args.rate:
+                delay = started + n / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            server.inject(update, kind)
+
+        finished = server.wait_completed(args.count, args.timeout)
+        elapsed = (max(server.completed.values()) if server.completed else time.perf_counter()) - started
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        server.shutdown()
+
+    by_kind: Dict[str, List[float]] = {}
+    for update_id, (kind, injected_at) in server.injected.items():
+        done = server.completed.get(update_id)
+        if done is not None:
+            by_kind.setdefault(kind, []).append(done - injected_at)
+    all_latencies = [v for values in by_kind.values() for v in values]
+
+    report = {
+        "updates": args.count,
+        "completed": len(server.completed),
+        "timed_out": not finished,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(server.completed) / elapsed, 1) if elapsed > 0 else 0.0,
+        "latency": latency_summary(all_latencies),
+        "latency_by_kind": {kind: latency_summary(values) for kind, values in sorted(by_kind.items())},
+        "api_calls": dict(sorted(server.calls.items())),
+        "config": {
+            "api_latency_s": args.latency,
+            "rate": args.rate or "burst",
+            "bot_workers": env.get("BOT_WORKERS", "default"),
+            "send_workers": env.get("SEND_WORKERS", "default"),
+            "unthrottled": args.unthrottled,
+        },
+    }
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        lat = report["latency"]
+        print(f"Обновлений: {report['completed']}/{report['updates']}" + (" (таймаут!)" if report["timed_out"] else ""))
+        print(f"Время: {report['elapsed_s']} с, {report['updates_per_s']} upd/s")
+        print(f"Задержка, мс: p50={lat['p50_ms']} p95={lat['p95_ms']} p99={lat['p99_ms']} max={lat['max_ms']}")
+        for kind, s in report["latency_by_kind"].items():
+            print(f"  {kind}: n={s['count']} p50={s['p50_ms']} p95={s['p95_ms']} p99={s['p99_ms']}")
+        print("Вызовы API:", ", ".join(f"{m}={n}" for m, n in report["api_calls"].items()))
+    return 0 if finished else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
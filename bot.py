@@ -1,14 +1,37 @@
 ﻿import os
 import json
 import time
+import threading
 import logging
-import sqlite3
-import hashlib
-import base64
+import html
 from datetime import datetime
-from typing import Dict, Any, List
-
-import requests
+from typing import Dict, Any, List, Tuple
+
+import liqpay
+import profiling
+import reconcile
+from catalog import Catalog, ProductRecord
+from messages import (
+    DIGEST_MAX_ORDERS, MESSAGE_LIMIT, PAID_AFTER_CANCEL, SEARCH_PAGE_SIZE, STATUS_CODES, STATUS_EMOJI, render_broadcast,
+    render_broadcast_draft, render_broadcast_list, render_digest, render_search,
+)
+from pricing import PricingEngine, PromoTable
+from broadcast import Broadcaster
+from admission import Admission, TIER_CHECKOUT, TIER_INTERACTIVE, TIER_LOW
+from dispatcher import UpdateDispatcher
+from webhook import WebhookServer
+from metrics import (
+    HANDLER_SECONDS, ORDERS_CREATED, UPDATES_RECEIVED, UPDATES_DROPPED, UPDATES_LAG_SECONDS, DISPATCHER_QUEUE_DEPTH, OUTBOX_PENDING,
+    start_http_server,
+)
+from telegram_api import TelegramClient, OutboundSender, PRIORITY_ADMIN, PRIORITY_CUSTOMER
+from storage import (
+    init_db, save_order_to_db, get_orders, get_orders_page, get_order, update_order_status, get_stats,
+    encode_cursor, decode_cursor, journal_updates, finish_update, forget_update, get_pending_updates,
+    get_journal_offset, prune_update_journal, PromoLimitExceeded, count_orders, OutOfStock, expire_reservations,
+    get_stock, set_stock, adjust_stock, search_orders, archive_orders, incremental_vacuum, BroadcastJob,
+    create_broadcast, get_broadcast, list_broadcasts, broadcast_progress, start_broadcast, cancel_broadcast,
+)
 
 # === Config ===
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "8570781131:AAEsSFJf44OpGXV8ML0WlOlF_l0HOgfkAE0")
@@ -20,160 +43,131 @@ LIQPAY_PRIVATE_KEY = os.getenv("LIQPAY_PRIVATE_KEY", "your_private_key")
 LIQPAY_SANDBOX = os.getenv("LIQPAY_SANDBOX", "true").lower() == "true"
 LIQPAY_SERVER_URL = os.getenv("LIQPAY_SERVER_URL", WEBAPP_URL.rstrip('/') + "/payment_callback")
 
-API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/"
+# Адрес Bot API можно переопределить (локальный Bot API сервер, заглушка для нагрузочных тестов)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+API_URL = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/"
+
+# Пул обработчиков обновлений: 0 - обрабатывать последовательно в цикле getUpdates
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "4"))
+BOT_QUEUE_SIZE = int(os.getenv("BOT_QUEUE_SIZE", "200"))
+# Потоки исходящей отправки (лимиты Telegram соблюдаются независимо от их числа)
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+
+# Источник обновлений: polling (getUpdates) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, на который Telegram шлёт обновления
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+
+# Журнал входящих обновлений: сколько дней хранить обработанные записи
+UPDATE_JOURNAL_RETENTION_DAYS = float(os.getenv("UPDATE_JOURNAL_RETENTION_DAYS", "3"))
+
+# Резерв товара под заказ с онлайн-оплатой: сколько минут ждать оплату (больше RECONCILE_AGE_MINUTES,
+# чтобы сверка успела найти оплату без callback'а) и как часто снимать просроченные резервы
+RESERVATION_TTL_MINUTES = float(os.getenv("RESERVATION_TTL_MINUTES", "60"))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv("RESERVATION_SWEEP_INTERVAL", "60"))
+
+# Архив: завершённые и отменённые заказы старше ARCHIVE_AFTER_DAYS переносятся в архивную базу
+# пачками по ARCHIVE_BATCH_SIZE каждые ARCHIVE_INTERVAL секунд (0 - не переносить)
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+
+# Допуск обновлений (admission.py): обновлений в секунду на пользователя и запас на всплеск,
+# оформлений заказа в минуту, окно отсева одинаковых оформлений и доли очереди, с которых сбрасываются
+# callback'и и команды (ADMIT_SHED_INTERACTIVE) и прочий текст (ADMIT_SHED_LOW)
+ADMIT_USER_RATE = float(os.getenv("ADMIT_USER_RATE", "1"))
+ADMIT_USER_BURST = float(os.getenv("ADMIT_USER_BURST", "10"))
+ADMIT_CHECKOUTS_PER_MINUTE = float(os.getenv("ADMIT_CHECKOUTS_PER_MINUTE", "3"))
+ADMIT_DEDUP_SECONDS = float(os.getenv("ADMIT_DEDUP_SECONDS", "30"))
+ADMIT_SHED_INTERACTIVE = float(os.getenv("ADMIT_SHED_INTERACTIVE", "0.8"))
+ADMIT_SHED_LOW = float(os.getenv("ADMIT_SHED_LOW", "0.5"))
+
+# Рассылка /broadcast: сколько сообщений рассылки держать в очереди отправки (запас на секунду-две при
+# SEND_GLOBAL_RATE) и как часто обновлять прогресс у админа
+BROADCAST_MAX_QUEUED = int(os.getenv("BROADCAST_MAX_QUEUED", str(int(SEND_GLOBAL_RATE * 2))))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+
+# Профилирование: обновления дольше SLOW_UPDATE_SECONDS пишутся в лог с разбивкой по участкам (0 - не писать);
+# /profile N сохраняет стеки в PROFILE_DIR
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_MAX_SECONDS = 600
+
+# Метрики Prometheus: GET http://BOT_METRICS_HOST:BOT_METRICS_PORT/metrics (0 - выключено)
+BOT_METRICS_HOST = os.getenv("BOT_METRICS_HOST", "127.0.0.1")
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9101"))
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PRODUCTS_JSON_PATH = os.path.join(BASE_DIR, "products.json")
-DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "shop.db"))
-
-# === Database ===
-def init_db() -> None:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            user_name TEXT,
-            items_json TEXT,
-            total_price REAL,
-            contact_json TEXT,
-            status TEXT DEFAULT 'new',
-            payment_status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """
-    )
-    try:
-        c.execute('ALTER TABLE orders ADD COLUMN payment_status TEXT DEFAULT "pending"')
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
-    conn.close()
-
-
-def save_order_to_db(user_id: int, user_name: str, items: List[Dict[str, Any]], total_price: float, contact: Dict[str, Any]) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO orders (user_id, user_name, items_json, total_price, contact_json)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (
-            user_id,
-            user_name,
-            json.dumps(items, ensure_ascii=False),
-            total_price,
-            json.dumps(contact, ensure_ascii=False),
-        ),
-    )
-    order_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return order_id
+PROMOS_JSON_PATH = os.getenv("PROMOS_JSON_PATH", os.path.join(BASE_DIR, "promos.json"))
+# Как часто проверять products.json на изменения (секунды)
+CATALOG_POLL_INTERVAL = float(os.getenv("CATALOG_POLL_INTERVAL", "2"))
 
+# === Products ===
+catalog = Catalog(
+    PRODUCTS_JSON_PATH if os.path.exists(PRODUCTS_JSON_PATH) else os.path.join(os.getcwd(), "products.json"),
+    poll_interval=CATALOG_POLL_INTERVAL,
+)
+promos = PromoTable(PROMOS_JSON_PATH, poll_interval=CATALOG_POLL_INTERVAL)
+pricing = PricingEngine(catalog, promos)
+
+admission = Admission(
+    rate=ADMIT_USER_RATE,
+    burst=ADMIT_USER_BURST,
+    checkout_rate=ADMIT_CHECKOUTS_PER_MINUTE / 60,
+    checkout_burst=max(1.0, ADMIT_CHECKOUTS_PER_MINUTE),
+    dedup_seconds=ADMIT_DEDUP_SECONDS,
+    max_pending=BOT_QUEUE_SIZE,
+    shed_levels={TIER_CHECKOUT: None, TIER_INTERACTIVE: ADMIT_SHED_INTERACTIVE, TIER_LOW: ADMIT_SHED_LOW},
+    admins=(ADMIN_CHAT_ID,),
+)
 
-def get_orders(status: str | None = None, limit: int = 50) -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    if status:
-        c.execute('SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC LIMIT ?', (status, limit))
-    else:
-        c.execute('SELECT * FROM orders ORDER BY created_at DESC LIMIT ?', (limit,))
-    rows = c.fetchall()
-    conn.close()
 
-    columns = [
-        'id', 'user_id', 'user_name', 'items_json', 'total_price',
-        'contact_json', 'status', 'payment_status', 'created_at'
-    ]
-    orders: List[Dict[str, Any]] = []
-    for row in rows:
-        order = dict(zip(columns, row))
-        order['items'] = json.loads(order['items_json'])
-        order['contact'] = json.loads(order['contact_json'])
-        orders.append(order)
-    return orders
-
-
-def update_order_status(order_id: int, new_status: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE orders SET status = ? WHERE id = ?', (new_status, order_id))
-    conn.commit()
-    changed = c.rowcount > 0
-    conn.close()
-    return changed
-
-
-def get_order(order_id: int) -> Dict[str, Any] | None:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        return None
-    columns = [
-        'id', 'user_id', 'user_name', 'items_json', 'total_price',
-        'contact_json', 'status', 'payment_status', 'created_at'
-    ]
-    order = dict(zip(columns, row))
-    order['items'] = json.loads(order['items_json'])
-    order['contact'] = json.loads(order['contact_json'])
-    return order
+def load_products() -> None:
+    catalog.reload(force=True)
+    promos.reload(force=True)
 
 
-# === Products ===
-PRODUCTS: List[Dict[str, Any]] = []
-PRODUCTS_BY_ID: Dict[int, Dict[str, Any]] = {}
+def get_product(pid: int) -> ProductRecord | None:
+    return catalog.current().product(pid)
 
 
-def load_products() -> None:
-    global PRODUCTS, PRODUCTS_BY_ID
-    try:
-        path = PRODUCTS_JSON_PATH if os.path.exists(PRODUCTS_JSON_PATH) else os.path.join(os.getcwd(), "products.json")
-        if not os.path.exists(path):
-            logger.error("products.json not found")
-            PRODUCTS, PRODUCTS_BY_ID = [], {}
-            return
-        with open(path, "r", encoding="utf-8") as f:
-            PRODUCTS = json.load(f)
-        PRODUCTS_BY_ID = {int(p["id"]): p for p in PRODUCTS}
-        logger.info("Products loaded: %s", len(PRODUCTS))
-    except Exception as e:
-        logger.exception("Failed to load products: %s", e)
+# === Telegram helpers ===
+telegram = TelegramClient(API_URL)
+outbox = OutboundSender(telegram, workers=SEND_WORKERS, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE)
 
 
-def get_product(pid: int):
-    return PRODUCTS_BY_ID.get(pid)
+def send_message(chat_id: int, text: str, parse_mode: str | None = None, reply_markup: Dict[str, Any] | None = None,
+                 priority: int = PRIORITY_CUSTOMER) -> None:
+    reply_markup_json = json.dumps(reply_markup) if reply_markup else None
+    outbox.send_message(chat_id, text, priority=priority, parse_mode=parse_mode, reply_markup=reply_markup_json)
 
 
-def find_option(product: Dict[str, Any] | None, opt_id: Any):
-    if not product or not opt_id:
-        return None
-    for opt in product.get("options", []):
-        if str(opt.get("id")) == str(opt_id):
-            return opt
-    return None
+def answer_callback(query_id: str, text: str | None = None) -> None:
+    # ответ на нажатие кнопки не сообщение в чат: отдельный ключ лимита, чтобы не задерживать правку сообщения
+    outbox.submit("answerCallbackQuery", {"callback_query_id": query_id, "text": text} if text else
+                  {"callback_query_id": query_id}, f"callback:{query_id}", PRIORITY_ADMIN)
 
 
-# === Telegram helpers ===
-def send_message(chat_id: int, text: str, parse_mode: str | None = None, reply_markup: Dict[str, Any] | None = None) -> None:
-    data: Dict[str, Any] = {"chat_id": chat_id, "text": text}
+def edit_message(chat_id: int, message_id: int, text: str, parse_mode: str | None = "HTML",
+                 reply_markup: Dict[str, Any] | None = None) -> None:
+    """editMessageText через общую очередь отправки: учитывается в лимитах чата, 429 не держит воркер."""
+    payload: Dict[str, Any] = {"chat_id": chat_id, "message_id": message_id, "text": text}
     if parse_mode:
-        data["parse_mode"] = parse_mode
-    if reply_markup:
-        data["reply_markup"] = json.dumps(reply_markup)
-    try:
-        requests.post(API_URL + "sendMessage", json=data, timeout=10)
-    except Exception as e:
-        logger.error("Send Error: %s", e)
+        payload["parse_mode"] = parse_mode
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup
+    outbox.submit("editMessageText", payload, chat_id, PRIORITY_ADMIN)
 
 
 def format_contact(c: Dict[str, Any]) -> str:
@@ -187,6 +181,29 @@ def format_contact(c: Dict[str, Any]) -> str:
     )
 
 
+def format_stats(stats: Dict[str, Any]) -> str:
+    by_status = stats["by_status"]
+    today, yesterday, hour = stats["today"], stats["yesterday"], stats["this_hour"]
+    lines = [
+        "Статистика\n",
+        f"Всего заказов: {stats['total']}",
+        f"Новые: {by_status.get('new', 0)} · В обработке: {by_status.get('processing', 0)} · "
+        f"Завершённые: {by_status.get('completed', 0)} · Отменённые: {by_status.get('cancelled', 0)}",
+        f"Выручка: {stats['revenue']:.2f} грн (оплачено: {stats['paid_revenue']:.2f} грн)",
+        "",
+        f"Сегодня: {today['orders']} зак. · {today['revenue']:.2f} грн",
+        f"Вчера: {yesterday['orders']} зак. · {yesterday['revenue']:.2f} грн",
+        f"Текущий час: {hour['orders']} зак. · {hour['revenue']:.2f} грн",
+    ]
+    if stats["top_products"]:
+        lines.append("\nТоп товаров:")
+        for n, p in enumerate(stats["top_products"], 1):
+            product = get_product(p["product_id"])
+            name = html.escape(product.name if product else p["name"] or f"#{p['product_id']}")
+            lines.append(f"{n}. {name} - {p['qty']} шт.")
+    return "\n".join(lines)
+
+
 # === LiqPay ===
 def generate_liqpay_link(order_id: int, amount: float, description: str, result_url: str | None = None) -> str | None:
     if LIQPAY_PUBLIC_KEY == "your_public_key":
@@ -203,25 +220,56 @@ def generate_liqpay_link(order_id: int, amount: float, description: str, result_
         "result_url": result_url or WEBAPP_URL,
         "server_url": LIQPAY_SERVER_URL,
     }
-    data_str = json.dumps(data, separators=(',', ':'))
-    data_encoded = base64.b64encode(data_str.encode('utf-8')).decode('utf-8')
-    signature_string = LIQPAY_PRIVATE_KEY + data_encoded + LIQPAY_PRIVATE_KEY
-    signature = base64.b64encode(hashlib.sha1(signature_string.encode('utf-8')).digest()).decode('utf-8')
-    return f"https://www.liqpay.ua/api/3/checkout?data={data_encoded}&signature={signature}"
+    return liqpay.checkout_url(data, LIQPAY_PRIVATE_KEY)
 
 
 def verify_liqpay_signature(data: str, signature: str) -> bool:
-    expected_signature = base64.b64encode(
-        hashlib.sha1((LIQPAY_PRIVATE_KEY + data + LIQPAY_PRIVATE_KEY).encode('utf-8')).digest()
-    ).decode('utf-8')
-    return expected_signature == signature
+    return liqpay.verify_signature(data, signature, LIQPAY_PRIVATE_KEY)
+
+
+def notify_reconciled(order_ids: List[int]) -> None:
+    ids = ", ".join(f"#{oid}" for oid in order_ids)
+    send_message(ADMIN_CHAT_ID, f"✅ Сверка LiqPay: оплачены заказы {ids}", priority=PRIORITY_ADMIN)
+
+
+def notify_paid_after_cancel(order_ids: List[int]) -> None:
+    logger.warning("Payment for cancelled orders %s", order_ids)
+    send_message(ADMIN_CHAT_ID, PAID_AFTER_CANCEL(ids=", ".join(f"#{oid}" for oid in order_ids)), priority=PRIORITY_ADMIN)
+
+
+def format_out_of_stock(short: List[Tuple[int, str | None, int]], items: List[Dict[str, Any]]) -> str:
+    names = {(i["product_id"], i["option_id"]): i["name"] for i in items}
+    lines = [
+        f"- {names.get((pid, opt), f'Товар #{pid}')}: " + (f"осталось {left} шт." if left else "нет в наличии")
+        for pid, opt, left in short
+    ]
+    return "Не хватает товара на складе:\n" + "\n".join(lines) + "\n\nИзмените корзину и оформите заказ ещё раз."
+
+
+def format_stock(stock: Dict[Tuple[int, str], int]) -> str:
+    snapshot = catalog.current()
+    lines = []
+    for (pid, opt), qty in sorted(stock.items(), key=lambda kv: (kv[1], kv[0])):
+        product = snapshot.product(pid)
+        option = snapshot.option(pid, opt)
+        name = (product.name if product else f"#{pid}") + (f" ({option.name})" if option else f" ({opt})" if opt else "")
+        lines.append(f"{'⚠️' if qty == 0 else '•'} {pid}{' ' + opt if opt else ''} - {html.escape(name)}: <b>{qty}</b>")
+    if not lines:
+        return "Остатки не заведены: python inventory.py seed"
+    text = "<b>Остатки</b> (сначала заканчивающиеся):\n\n"
+    for line in lines:
+        if len(text) + len(line) > 4000:
+            return text + "…"
+        text += line + "\n"
+    return text
 
 
 # === WebApp data ===
-def process_webapp_data(message: Dict[str, Any]):
+def process_webapp_data(message: Dict[str, Any], update_id: int | None = None):
     chat_id = message["chat"]["id"]
     try:
-        payload = json.loads(message["web_app_data"]["data"])
+        with profiling.span("parse"):
+            payload = json.loads(message["web_app_data"]["data"])
     except Exception:
         return send_message(chat_id, "Ошибка данных WebApp")
 
@@ -230,43 +278,49 @@ def process_webapp_data(message: Dict[str, Any]):
     user = message.get("from", {})
     user_name = f"{user.get('first_name','')} {user.get('last_name','')}".strip()
 
-    order_items: List[Dict[str, Any]] = []
-    total_price = 0.0
-
+    # цены и скидка считаются только на сервере; totalPrice из WebApp не используется
     if action == "buy":
-        pid = int(payload.get("productId", 0))
-        oid = payload.get("optionId")
-        product = get_product(pid)
-        if product:
-            opt = find_option(product, oid)
-            name = product["name"] + (f" ({opt['name']})" if opt else "")
-            price = product["price"]
-            order_items.append({"name": name, "price": price, "qty": 1})
-            total_price += price
+        raw_items = [{"productId": payload.get("productId", 0), "optionId": payload.get("optionId"), "qty": 1}]
     elif action == "cart_checkout":
-        for item in payload.get("items", []):
-            pid = int(item.get("productId") or item.get("id", 0))
-            oid = item.get("optionId")
-            qty = item.get("qty", 1)
-            product = get_product(pid)
-            if product:
-                opt = find_option(product, oid)
-                name = product["name"] + (f" ({opt['name']})" if opt else "")
-                price = product["price"]
-                order_items.append({"name": name, "price": price, "qty": qty})
-                total_price += price * qty
-        final_price = payload.get("totalPrice")
-        if final_price is not None:
-            total_price = float(final_price)
-
-    if not order_items:
-        return send_message(chat_id, "Корзина пуста или товар не найден")
+        raw_items = payload.get("items", [])
+    else:
+        raw_items = []
+    with profiling.span("pricing"):
+        cart = pricing.price_cart(raw_items, payload.get("promo"))
 
-    order_id = save_order_to_db(chat_id, user_name, order_items, total_price, contact)
+    if not cart.items:
+        return send_message(chat_id, "Корзина пуста или товар не найден")
 
-    items_str = "\n".join([f"- {i['name']} x{i['qty']} = {i['price']*i['qty']} грн" for i in order_items])
-    promo_code = payload.get("promo")
-    promo_info = f"\nПромокод: {promo_code}" if promo_code else ""
+    promo_note = ""
+    # без онлайн-оплаты резерв держится до смены статуса заказа админом
+    reservation = RESERVATION_TTL_MINUTES if LIQPAY_PUBLIC_KEY != "your_public_key" else 0
+    try:
+        try:
+            order_id = save_order_to_db(
+                chat_id, user_name, cart.items, cart.total, contact, source_update_id=update_id,
+                promo_code=cart.promo.code if cart.promo else None, discount=cart.discount,
+                promo_limit=cart.promo.per_user_limit if cart.promo else 0, reservation_minutes=reservation,
+                unavailable=cart.unavailable,
+            )
+        except PromoLimitExceeded:
+            with profiling.span("pricing"):
+                cart = pricing.price_cart(raw_items)
+            promo_note = "\nПромокод уже использован максимальное число раз, заказ оформлен без скидки."
+            order_id = save_order_to_db(chat_id, user_name, cart.items, cart.total, contact,
+                                        source_update_id=update_id, reservation_minutes=reservation,
+                                        unavailable=cart.unavailable)
+    except OutOfStock as e:
+        return send_message(chat_id, format_out_of_stock(e.items, cart.items))
+    ORDERS_CREATED.inc()
+    total_price = cart.total
+
+    items_str = "\n".join([f"- {i['name']} x{i['qty']} = {i['price']*i['qty']} грн" for i in cart.items])
+    if cart.promo:
+        promo_info = f"\nСумма без скидки: {cart.subtotal} грн\nПромокод: {cart.promo.code} (-{cart.discount} грн)"
+    elif payload.get("promo"):
+        promo_info = f"\nПромокод {html.escape(str(payload.get('promo')))} не применён"
+    else:
+        promo_info = ""
 
     admin_msg = (
         f"🛒 <b>Новый заказ #{order_id}</b>\n\n"
@@ -276,238 +330,617 @@ def process_webapp_data(message: Dict[str, Any]):
         f"Контакты:\n{format_contact(contact)}\n"
         f"Telegram: @{user.get('username', 'net_nika')}"
     )
-    send_message(ADMIN_CHAT_ID, admin_msg, parse_mode="HTML")
+    send_message(ADMIN_CHAT_ID, admin_msg, parse_mode="HTML", priority=PRIORITY_ADMIN)
 
-    payment_link = generate_liqpay_link(order_id, total_price, f"Заказ #{order_id} - Vape Market")
+    with profiling.span("liqpay"):
+        payment_link = generate_liqpay_link(order_id, total_price, f"Заказ #{order_id} - Vape Market")
     if payment_link:
         kb = {"inline_keyboard": [[{"text": "Оплатить картой", "url": payment_link}]]}
         send_message(
             chat_id,
-            f"Спасибо! Заказ #{order_id} оформлен.\n\nСумма: {total_price} грн\n\nОплатите заказ по ссылке ниже.",
+            f"Спасибо! Заказ #{order_id} оформлен.{promo_note}\n\nСумма: {total_price} грн\n\nОплатите заказ по ссылке ниже.",
             reply_markup=kb,
         )
     else:
-        send_message(chat_id, f"Спасибо! Заказ #{order_id} оформлен. Оплата будет уточнена дополнительно.")
+        send_message(chat_id, f"Спасибо! Заказ #{order_id} оформлен.{promo_note} Оплата будет уточнена дополнительно.")
+
+
+# === Broadcasts ===
+_broadcast_shown: Dict[int, str] = {}
+
+
+def report_broadcast(job: BroadcastJob, counts: Dict[str, int], finished: bool) -> None:
+    """Перерисовывает сообщение с прогрессом; по окончании - отдельное уведомление админу."""
+    text, rows = render_broadcast(job, counts)
+    if job.chat_id and job.message_id and _broadcast_shown.get(job.id) != text:
+        _broadcast_shown[job.id] = text
+        edit_message(job.chat_id, job.message_id, text, reply_markup={"inline_keyboard": rows})
+    if finished:
+        _broadcast_shown.pop(job.id, None)
+        if job.status == "done":
+            send_message(job.chat_id or ADMIN_CHAT_ID,
+                         f"✅ Рассылка #{job.id} завершена: отправлено {counts['sent']}, заблокировали бота {counts['blocked']}",
+                         priority=PRIORITY_ADMIN)
+
+
+broadcaster = Broadcaster(outbox, report_broadcast, max_queued=BROADCAST_MAX_QUEUED,
+                          progress_interval=BROADCAST_PROGRESS_INTERVAL)
+
+
+def parse_broadcast(txt: str) -> Tuple[str | None, str]:
+    """/broadcast <текст> - всем покупателям; /broadcast <категория>, текст со следующей строки - купившим из категории."""
+    first, _, rest = txt[len("/broadcast"):].partition("\n")
+    first, rest = first.strip(), rest.strip()
+    if rest:
+        for name in catalog.current().categories():
+            if first.casefold() == name.casefold():
+                return name, rest
+    return None, f"{first}\n{rest}".strip()
+
+
+# === Update handling ===
+ORDERS_PAGE_SIZE = 5
+ORDERS_FILTER_KEYBOARD = [
+    [{"text": "Новые", "callback_data": "orders_new"}],
+    [{"text": "В обработке", "callback_data": "orders_processing"}],
+    [{"text": "Завершённые", "callback_data": "orders_completed"}],
+    [{"text": "Все", "callback_data": "orders_all"}],
+]
+
+
+STATUS_MESSAGES = {
+    "processing": "Заказ #{} принят в обработку",
+    "completed": "Заказ #{} выполнен!",
+    "cancelled": "Заказ #{} отменён. Свяжитесь с поддержкой, если нужна помощь.",
+}
+
+
+def notify_status_change(order_id: int, new_status: str) -> None:
+    order = get_order(order_id)
+    if order:
+        msg_to_user = STATUS_MESSAGES.get(new_status, "Статус заказа #{} обновлён")
+        send_message(order.user_id, msg_to_user.format(order_id))
+
+
+def build_digest(page: str) -> Tuple[str, Dict[str, Any]]:
+    """Страница дайджеста новых заказов: page - курсор ("-" - с самых новых). Возвращает (текст, клавиатура)."""
+    cursor = decode_cursor(page) if page != "-" else None
+    orders, _, older = get_orders_page(status="new", cursor=cursor, limit=DIGEST_MAX_ORDERS, full=True)
+    text, rows, shown = render_digest(orders, count_orders("new"), page)
+    nav = []
+    if cursor:
+        nav.append({"text": "⏮ В начало", "callback_data": "digest_-"})
+    if shown and (shown < len(orders) or older):
+        last = orders[shown - 1]
+        nav.append({"text": "Далее ▶️", "callback_data": f"digest_{encode_cursor((last['created_at'], last['id']))}"})
+    return text, {"inline_keyboard": rows + ([nav] if nav else [])}
+
+
+HANDLER_LABELS = {
+    "Список заказов": "orders_list",
+    "/orders": "orders_list",
+    "Новые заказы": "new_orders",
+    "Статистика": "stats",
+    "/order": "order",
+    "/start": "start",
+    "/myid": "myid",
+    "/find": "find",
+    "/stock": "stock",
+    "/broadcast": "broadcast",
+    "/broadcast_status": "broadcast_status",
+    "/profile": "profile",
+}
+
+
+def build_search(query: str, offset: int) -> Tuple[str, Dict[str, Any]]:
+    orders, has_more = search_orders(query, limit=SEARCH_PAGE_SIZE, offset=offset)
+    text, rows = render_search(query, orders, offset, has_more)
+    return text, {"inline_keyboard": rows}
+
+
+def handler_name(upd: Dict[str, Any]) -> str:
+    """Метка обработчика для гистограммы времени: команда, кнопка или тип callback'а."""
+    if "message" in upd:
+        msg = upd["message"]
+        if "web_app_data" in msg:
+            return "process_webapp_data"
+        txt = msg.get("text")
+        if not txt:
+            return "message"
+        return HANDLER_LABELS.get(txt) or HANDLER_LABELS.get((txt.split() or [""])[0], "text")
+    if "callback_query" in upd:
+        return "callback_" + (upd["callback_query"].get("data") or "").split("_", 1)[0]
+    return "other"
+
+
+def handle_update(upd: Dict[str, Any]) -> None:
+    """Обработка с отметкой в журнале: 'done' после обработки, 'failed' если обработчик упал."""
+    name = handler_name(upd)
+    try:
+        with HANDLER_SECONDS.time(handler=name), profiling.trace_update(upd["update_id"], name, SLOW_UPDATE_SECONDS):
+            _handle_update(upd)
+    except Exception:
+        finish_update(upd["update_id"], "failed")
+        raise
+    finish_update(upd["update_id"])
+
+
+def _handle_update(upd: Dict[str, Any]) -> None:
+    if "message" in upd:
+        msg = upd["message"]
+        chat_id = msg["chat"]["id"]
+        user_id = msg.get("from", {}).get("id", chat_id)
+
+        if "web_app_data" in msg:
+            process_webapp_data(msg, update_id=upd.get("update_id"))
+            return
+
+        if "text" in msg:
+            txt = msg["text"]
+
+            if txt in ("/start", "/myid"):
+                logger.info("Command %s from user %s chat %s", txt, user_id, chat_id)
+                logger.info("Admin? %s", user_id == ADMIN_CHAT_ID or chat_id == ADMIN_CHAT_ID)
+
+            if txt == "/start":
+                is_admin = (user_id == ADMIN_CHAT_ID) or (chat_id == ADMIN_CHAT_ID)
+                if is_admin:
+                    kb = {
+                        "keyboard": [
+                            [{"text": "Открыть Shop", "web_app": {"url": WEBAPP_URL}}],
+                            [{"text": "Список заказов"}, {"text": "Новые заказы"}],
+                            [{"text": "Статистика"}],
+                        ],
+                        "resize_keyboard": True,
+                    }
+                    send_message(chat_id, "Админ-панель. Выберите действие:", reply_markup=kb)
+                else:
+                    kb = {
+                        "keyboard": [[{"text": "Открыть Shop", "web_app": {"url": WEBAPP_URL}}]],
+                        "resize_keyboard": True,
+                    }
+                    send_message(chat_id, "Привет! Открой магазин по кнопке ниже.", reply_markup=kb)
+                return
+
+            if txt == "/myid":
+                send_message(
+                    chat_id,
+                    f"Твой ID:\nUser ID: {user_id}\nChat ID: {chat_id}\n\nТекущий Admin ID в коде: {ADMIN_CHAT_ID}\n\n"
+                    "Если ты админ и панель не открывается, обнови ADMIN_CHAT_ID в bot.py",
+                )
+                return
+
+            if (user_id == ADMIN_CHAT_ID) or (chat_id == ADMIN_CHAT_ID):
+                if txt == "Список заказов" or txt.startswith("/orders"):
+                    orders = get_orders(limit=10)
+                    if not orders:
+                        send_message(chat_id, "Заказы не найдены")
+                    else:
+                        msg_text = "<b>Последние заказы:</b>\n\n"
+                        for o in orders:
+                            status_emoji = STATUS_EMOJI.get(o.status, "ℹ️")
+                            msg_text += f"{status_emoji} <b>#{o.id}</b> - {o.total_price} грн ({o.status})\n"
+                            msg_text += f"   Имя: {o.user_name}\n"
+                            msg_text += f"   Время: {o.created_at}\n\n"
+                        send_message(chat_id, msg_text, parse_mode="HTML", reply_markup={"inline_keyboard": ORDERS_FILTER_KEYBOARD})
+
+                elif txt == "Новые заказы":
+                    text, kb = build_digest("-")
+                    send_message(chat_id, text, parse_mode="HTML", reply_markup=kb)
+
+                elif txt == "Статистика":
+                    stats = get_stats()
+                    send_message(chat_id, format_stats(stats), parse_mode="HTML")
+
+                elif txt.startswith("/order "):
+                    try:
+                        oid = int(txt.split()[1])
+                    except Exception:
+                        send_message(chat_id, "Используй: /order <id>")
+                        return
+                    order = get_order(oid)
+                    if order:
+                        items_str = "\n".join([f"- {i['name']} x{i['qty']} = {i['price']*i['qty']} грн" for i in order.items])
+                        msg_text = (
+                            f"ℹ️ <b>Заказ #{order.id}</b>\n\n{items_str}\n----------------\n"
+                            f"Итого: <b>{order.total_price} грн</b>\n\nКонтакты:\n{format_contact(order.contact)}\n"
+                            f"Создан: {order.created_at}\nСтатус: {order.status}"
+                        )
+                        kb = {
+                            "inline_keyboard": [
+                                [
+                                    {"text": "В обработке", "callback_data": f"status_{order.id}_processing"},
+                                    {"text": "Завершён", "callback_data": f"status_{order.id}_completed"},
+                                ],
+                                [{"text": "Отменить", "callback_data": f"status_{order.id}_cancelled"}],
+                            ]
+                        }
+                        send_message(chat_id, msg_text, parse_mode="HTML", reply_markup=kb)
+                    else:
+                        send_message(chat_id, "Заказ не найден")
+
+                elif txt == "/find" or txt.startswith("/find "):
+                    query = txt[len("/find"):].strip()
+                    if not query:
+                        send_message(chat_id, "Используй: /find <имя, телефон, адрес или товар>")
+                        return
+                    text, kb = build_search(query, 0)
+                    send_message(chat_id, text, parse_mode="HTML", reply_markup=kb)
+
+                elif txt == "/stock" or txt.startswith("/stock "):
+                    # /stock - список; /stock <id> [опция] <кол-во> - задать; +N/-N - приход/списание
+                    args = txt.split()[1:]
+                    if not args:
+                        send_message(chat_id, format_stock(get_stock()), parse_mode="HTML")
+                        return
+                    if len(args) not in (2, 3) or not args[-1].lstrip("+-").isdigit() or not args[0].isdigit():
+                        send_message(chat_id, "Используй: /stock <id> [опция] <кол-во | +N | -N>")
+                        return
+                    pid, opt, value = int(args[0]), args[1] if len(args) == 3 else None, args[-1]
+                    if value[0] in "+-":
+                        left = adjust_stock(pid, opt, int(value))
+                        if left is None:
+                            send_message(chat_id, "Товар не учитывается или остаток ушёл бы в минус")
+                            return
+                    else:
+                        left = int(value)
+                        set_stock(pid, opt, left)
+                    send_message(chat_id, f"Остаток {pid}{' ' + opt if opt else ''}: {left}")
+
+                elif (txt.split(None, 1) or [""])[0] == "/broadcast":
+                    category, text = parse_broadcast(txt)
+                    if not text:
+                        send_message(chat_id, "Используй: /broadcast <текст>\nили /broadcast <категория> и текст со следующей строки")
+                        return
+                    if len(text) > MESSAGE_LIMIT:
+                        send_message(chat_id, f"Текст длиннее {MESSAGE_LIMIT} символов")
+                        return
+                    product_ids = [p.id for p in catalog.current().category(category)] if category else None
+                    job_id, total = create_broadcast(text, product_ids, category, created_by=user_id)
+                    body, rows = render_broadcast_draft(get_broadcast(job_id), total)
+                    send_message(chat_id, body, parse_mode="HTML", reply_markup={"inline_keyboard": rows})
+
+                elif (txt.split(None, 1) or [""])[0] == "/broadcast_status":
+                    args = txt.split()[1:]
+                    if args and args[0].isdigit():
+                        job = get_broadcast(int(args[0]))
+                        if not job:
+                            send_message(chat_id, "Рассылка не найдена")
+                            return
+                        body, rows = render_broadcast(job, broadcast_progress(job.id))
+                        send_message(chat_id, body, parse_mode="HTML", reply_markup={"inline_keyboard": rows})
+                    else:
+                        jobs = [(job, broadcast_progress(job.id)) for job in list_broadcasts()]
+                        send_message(chat_id, render_broadcast_list(jobs), parse_mode="HTML")
+
+                elif txt == "/profile" or txt.startswith("/profile "):
+                    args = txt.split()[1:]
+                    if args and not (args[0].isdigit() and 0 < int(args[0]) <= PROFILE_MAX_SECONDS):
+                        send_message(chat_id, f"Используй: /profile <секунды, до {PROFILE_MAX_SECONDS}>")
+                        return
+                    if profiler.busy:
+                        send_message(chat_id, "Профилирование уже идёт")
+                        return
+                    seconds = int(args[0]) if args else 30
+                    start_profile(chat_id, seconds)
+                    send_message(chat_id, f"⏱ Профилирование обработчиков на {seconds} с запущено")
+
+                else:
+                    send_message(chat_id, "Команды: Список заказов, Новые заказы, Статистика, /order <id>, /find <запрос>, "
+                                          "/stock, /broadcast <текст>, /broadcast_status, /profile <секунды>")
+
+    elif "callback_query" in upd:
+        query = upd["callback_query"]
+        query_id = query["id"]
+        data_cb = query["data"]
+        chat_id = query.get("message", {}).get("chat", {}).get("id", 0)
+        user_id_from_query = query["from"]["id"]
+
+        if (user_id_from_query != ADMIN_CHAT_ID) and (chat_id != ADMIN_CHAT_ID):
+            answer_callback(query_id, "Нет прав")
+            return
+
+        if data_cb.startswith("status_"):
+            parts = data_cb.split("_")
+            order_id = int(parts[1])
+            new_status = parts[2]
+
+            if update_order_status(order_id, new_status):
+                notify_status_change(order_id, new_status)
+
+                answer_callback(query_id, f"Статус обновлён на {new_status}")
+
+                status_emoji = STATUS_EMOJI.get(new_status, "ℹ️")
+                edit_message(chat_id, query["message"]["message_id"], f"{status_emoji} Статус заказа #{order_id} теперь: {new_status}")
+            else:
+                answer_callback(query_id, "Не удалось обновить статус")
+
+        elif data_cb.startswith("dst_"):
+            # dst_<id>_<p|c|x>_<страница дайджеста>: смена статуса и перерисовка той же страницы
+            _, order_id_str, code, page = data_cb.split("_", 3)
+            order_id, new_status = int(order_id_str), STATUS_CODES[code]
+            changed = update_order_status(order_id, new_status)
+            if changed:
+                notify_status_change(order_id, new_status)
+            answer_callback(query_id, f"#{order_id}: {new_status}" if changed else "Не удалось обновить статус")
+            text, kb = build_digest(page)
+            edit_message(chat_id, query["message"]["message_id"], text, reply_markup=kb)
+
+        elif data_cb.startswith("find_"):
+            # find_<смещение>_<запрос>
+            _, offset, search_text = data_cb.split("_", 2)
+            text, kb = build_search(search_text, int(offset))
+            edit_message(chat_id, query["message"]["message_id"], text, reply_markup=kb)
+            answer_callback(query_id)
+
+        elif data_cb.startswith("bc_"):
+            # bc_go_<id> - запустить черновик рассылки, bc_x_<id> - отменить черновик или остановить рассылку
+            _, action, job_id_str = data_cb.split("_", 2)
+            job_id = int(job_id_str)
+            if action == "go":
+                changed = start_broadcast(job_id, chat_id, query["message"]["message_id"])
+                if changed:
+                    broadcaster.wake()
+            else:
+                changed = cancel_broadcast(job_id)
+            answer_callback(query_id, ("Рассылка запущена" if action == "go" else "Рассылка остановлена") if changed else "Уже не актуально")
+            job = get_broadcast(job_id)
+            if job:
+                text, rows = render_broadcast(job, broadcast_progress(job_id))
+                _broadcast_shown[job_id] = text
+                edit_message(chat_id, query["message"]["message_id"], text, reply_markup={"inline_keyboard": rows})
+
+        elif data_cb.startswith("digest_"):
+            text, kb = build_digest(data_cb.split("_", 1)[1])
+            edit_message(chat_id, query["message"]["message_id"], text, reply_markup=kb)
+            answer_callback(query_id)
+
+        elif data_cb.startswith("orders_"):
+            # orders_<status>[_<n|p>_<курсор>]: n - листать к старым, p - к новым
+            parts = data_cb.split("_", 3)
+            status = parts[1]
+            direction = "prev" if len(parts) > 2 and parts[2] == "p" else "next"
+            cursor = decode_cursor(parts[3]) if len(parts) > 3 else None
+            orders, newer, older = get_orders_page(
+                status=None if status == "all" else status, cursor=cursor, direction=direction, limit=ORDERS_PAGE_SIZE,
+            )
+            if not orders:
+                answer_callback(query_id, "Заказы не найдены")
+            else:
+                msg_text = f"<b>Заказы ({status}):</b>\n\n"
+                for o in orders:
+                    msg_text += f"#{o.id} - {o.total_price} грн\n"
+                nav = []
+                if newer:
+                    nav.append({"text": "◀️ Новее", "callback_data": f"orders_{status}_p_{encode_cursor(newer)}"})
+                if older:
+                    nav.append({"text": "Старее ▶️", "callback_data": f"orders_{status}_n_{encode_cursor(older)}"})
+                kb = {"inline_keyboard": ([nav] if nav else []) + ORDERS_FILTER_KEYBOARD}
+                edit_message(chat_id, query["message"]["message_id"], msg_text, reply_markup=kb)
+                answer_callback(query_id)
 
 
 # === Main loop ===
-def main():
-    init_db()
-    load_products()
-    logger.info("Bot started...")
+def admit(dispatcher: UpdateDispatcher | None, upd: Dict[str, Any]) -> bool:
+    """Дешёвая проверка до журнала: флуд, повтор оформления, сброс при перегрузке. False - обновление отброшено."""
+    decision = admission.check(upd, dispatcher.qsize() if dispatcher else 0)
+    if decision.admitted:
+        return True
+    UPDATES_DROPPED.inc(reason=decision.reason)
+    if decision.notify:
+        send_message(upd["message"]["chat"]["id"],
+                     f"Слишком много заказов подряд. Попробуйте через {int(decision.retry_after) + 1} сек.")
+    return False
+
+
+def dispatch(dispatcher: UpdateDispatcher | None, upd: Dict[str, Any]) -> None:
+    if dispatcher:
+        dispatcher.submit(upd)
+        return
+    try:
+        handle_update(upd)
+    except Exception:
+        logger.exception("Update %s handler error", upd.get("update_id"))
+
 
-    offset = None
+def replay_journal(dispatcher: UpdateDispatcher | None) -> None:
+    """Обновления, записанные в журнал, но не обработанные до остановки/падения."""
+    pending = get_pending_updates()
+    if pending:
+        logger.info("Replaying %s pending updates from journal", len(pending))
+    for upd in pending:
+        dispatch(dispatcher, upd)
+
+
+def run_polling(dispatcher: UpdateDispatcher | None) -> None:
+    # после запуска в режиме webhook Telegram отвечает 409 на getUpdates, пока webhook не снят;
+    # накопившиеся обновления не сбрасываются - их заберёт getUpdates
+    result = telegram.call("deleteWebhook", {"drop_pending_updates": False})
+    logger.info("deleteWebhook: %s", result.get("description"))
+    offset = get_journal_offset()
     while True:
         try:
-            params = {"timeout": 50, "offset": offset}
-            resp = requests.get(API_URL + "getUpdates", params=params, timeout=60)
-            data = resp.json()
+            params: Dict[str, Any] = {"timeout": 50}
+            if offset is not None:
+                params["offset"] = offset
+            data = telegram.request("getUpdates", params, timeout=60)
             if not data.get("ok"):
+                logger.error("getUpdates failed: %s", data.get("description"))
+                time.sleep(data.get("parameters", {}).get("retry_after", 5))
+                continue
+
+            updates = data.get("result", [])
+            UPDATES_RECEIVED.inc(len(updates), source="polling")
+            dates = [u["message"]["date"] for u in updates if "date" in u.get("message", {})]
+            UPDATES_LAG_SECONDS.set(max(0.0, time.time() - max(dates)) if dates else 0.0)
+            if not updates:
                 continue
 
-            for upd in data.get("result", []):
-                offset = upd["update_id"] + 1
-                if "message" in upd:
-                    msg = upd["message"]
-                    chat_id = msg["chat"]["id"]
-                    user_id = msg.get("from", {}).get("id", chat_id)
-
-                    if "web_app_data" in msg:
-                        process_webapp_data(msg)
-                        continue
-
-                    if "text" in msg:
-                        txt = msg["text"]
-
-                        if txt in ("/start", "/myid"):
-                            logger.info("Command %s from user %s chat %s", txt, user_id, chat_id)
-                            logger.info("Admin? %s", user_id == ADMIN_CHAT_ID or chat_id == ADMIN_CHAT_ID)
-
-                        if txt == "/start":
-                            is_admin = (user_id == ADMIN_CHAT_ID) or (chat_id == ADMIN_CHAT_ID)
-                            if is_admin:
-                                kb = {
-                                    "keyboard": [
-                                        [{"text": "Открыть Shop", "web_app": {"url": WEBAPP_URL}}],
-                                        [{"text": "Список заказов"}, {"text": "Новые заказы"}],
-                                        [{"text": "Статистика"}],
-                                    ],
-                                    "resize_keyboard": True,
-                                }
-                                send_message(chat_id, "Админ-панель. Выберите действие:", reply_markup=kb)
-                            else:
-                                kb = {
-                                    "keyboard": [[{"text": "Открыть Shop", "web_app": {"url": WEBAPP_URL}}]],
-                                    "resize_keyboard": True,
-                                }
-                                send_message(chat_id, "Привет! Открой магазин по кнопке ниже.", reply_markup=kb)
-                            continue
-
-                        if txt == "/myid":
-                            send_message(
-                                chat_id,
-                                f"Твой ID:\nUser ID: {user_id}\nChat ID: {chat_id}\n\nТекущий Admin ID в коде: {ADMIN_CHAT_ID}\n\n"
-                                "Если ты админ и панель не открывается, обнови ADMIN_CHAT_ID в bot.py",
-                            )
-                            continue
-
-                        if (user_id == ADMIN_CHAT_ID) or (chat_id == ADMIN_CHAT_ID):
-                            if txt == "Список заказов" or txt.startswith("/orders"):
-                                orders = get_orders(limit=10)
-                                if not orders:
-                                    send_message(chat_id, "Заказы не найдены")
-                                else:
-                                    msg_text = "<b>Последние заказы:</b>\n\n"
-                                    for o in orders:
-                                        status_emoji = {"new": "🆕", "processing": "⏳", "completed": "✅", "cancelled": "❌"}.get(o['status'], "ℹ️")
-                                        msg_text += f"{status_emoji} <b>#{o['id']}</b> - {o['total_price']} грн ({o['status']})\n"
-                                        msg_text += f"   Имя: {o['user_name']}\n"
-                                        msg_text += f"   Время: {o['created_at']}\n\n"
-                                    kb = {
-                                        "inline_keyboard": [
-                                            [{"text": "Новые", "callback_data": "orders_new"}],
-                                            [{"text": "В обработке", "callback_data": "orders_processing"}],
-                                            [{"text": "Завершённые", "callback_data": "orders_completed"}],
-                                        ]
-                                    }
-                                    send_message(chat_id, msg_text, parse_mode="HTML", reply_markup=kb)
-
-                            elif txt == "Новые заказы":
-                                orders = get_orders(status="new", limit=20)
-                                if not orders:
-                                    send_message(chat_id, "Новых заказов нет")
-                                else:
-                                    for o in orders:
-                                        items_str = "\n".join([f"- {i['name']} x{i['qty']}" for i in o['items']])
-                                        msg_text = (
-                                            f"🆕 <b>Заказ #{o['id']}</b>\n\n{items_str}\nИтого: <b>{o['total_price']} грн</b>\n\n"
-                                            f"Имя: {o['contact'].get('name')}\nТелефон: {o['contact'].get('phone')}\nАдрес: {o['contact'].get('address')}\n"
-                                        )
-                                        kb = {
-                                            "inline_keyboard": [
-                                                [
-                                                    {"text": "В обработке", "callback_data": f"status_{o['id']}_processing"},
-                                                    {"text": "Завершён", "callback_data": f"status_{o['id']}_completed"},
-                                                ],
-                                                [{"text": "Отменить", "callback_data": f"status_{o['id']}_cancelled"}],
-                                            ]
-                                        }
-                                        send_message(chat_id, msg_text, parse_mode="HTML", reply_markup=kb)
-
-                            elif txt == "Статистика":
-                                conn = sqlite3.connect(DB_PATH)
-                                c = conn.cursor()
-                                c.execute('SELECT COUNT(*) FROM orders')
-                                total = c.fetchone()[0]
-                                c.execute('SELECT COUNT(*) FROM orders WHERE status = "new"')
-                                new_count = c.fetchone()[0]
-                                c.execute('SELECT SUM(total_price) FROM orders WHERE status != "cancelled"')
-                                revenue = c.fetchone()[0] or 0
-                                conn.close()
-                                msg_text = (
-                                    f"Статистика\n\nВсего заказов: {total}\nНовые: {new_count}\nВыручка: {revenue:.2f} грн"
-                                )
-                                send_message(chat_id, msg_text, parse_mode="HTML")
-
-                            elif txt.startswith("/order "):
-                                try:
-                                    oid = int(txt.split()[1])
-                                except Exception:
-                                    send_message(chat_id, "Используй: /order <id>")
-                                    continue
-                                order = get_order(oid)
-                                if order:
-                                    items_str = "\n".join([f"- {i['name']} x{i['qty']} = {i['price']*i['qty']} грн" for i in order['items']])
-                                    msg_text = (
-                                        f"ℹ️ <b>Заказ #{order['id']}</b>\n\n{items_str}\n----------------\n"
-                                        f"Итого: <b>{order['total_price']} грн</b>\n\nКонтакты:\n{format_contact(order['contact'])}\n"
-                                        f"Создан: {order['created_at']}\nСтатус: {order['status']}"
-                                    )
-                                    kb = {
-                                        "inline_keyboard": [
-                                            [
-                                                {"text": "В обработке", "callback_data": f"status_{order['id']}_processing"},
-                                                {"text": "Завершён", "callback_data": f"status_{order['id']}_completed"},
-                                            ],
-                                            [{"text": "Отменить", "callback_data": f"status_{order['id']}_cancelled"}],
-                                        ]
-                                    }
-                                    send_message(chat_id, msg_text, parse_mode="HTML", reply_markup=kb)
-                                else:
-                                    send_message(chat_id, "Заказ не найден")
-
-                            else:
-                                send_message(chat_id, "Команды: Список заказов, Новые заказы, Статистика, /order <id>")
-
-                elif "callback_query" in upd:
-                    query = upd["callback_query"]
-                    query_id = query["id"]
-                    data_cb = query["data"]
-                    chat_id = query.get("message", {}).get("chat", {}).get("id", 0)
-                    user_id_from_query = query["from"]["id"]
-
-                    if (user_id_from_query != ADMIN_CHAT_ID) and (chat_id != ADMIN_CHAT_ID):
-                        requests.post(API_URL + "answerCallbackQuery", json={"callback_query_id": query_id, "text": "Нет прав"})
-                        continue
-
-                    if data_cb.startswith("status_"):
-                        parts = data_cb.split("_")
-                        order_id = int(parts[1])
-                        new_status = parts[2]
-
-                        if update_order_status(order_id, new_status):
-                            order = get_order(order_id)
-                            if order:
-                                status_messages = {
-                                    "processing": "Заказ #{} принят в обработку",
-                                    "completed": "Заказ #{} выполнен!",
-                                    "cancelled": "Заказ #{} отменён. Свяжитесь с поддержкой, если нужна помощь.",
-                                }
-                                msg_to_user = status_messages.get(new_status, "Статус заказа #{} обновлён")
-                                send_message(order['user_id'], msg_to_user.format(order_id))
-
-                            requests.post(API_URL + "answerCallbackQuery", json={
-                                "callback_query_id": query_id,
-                                "text": f"Статус обновлён на {new_status}",
-                            })
-
-                            status_emoji = {"new": "🆕", "processing": "⏳", "completed": "✅", "cancelled": "❌"}.get(new_status, "ℹ️")
-                            requests.post(API_URL + "editMessageText", json={
-                                "chat_id": chat_id,
-                                "message_id": query["message"]["message_id"],
-                                "text": f"{status_emoji} Статус заказа #{order_id} теперь: {new_status}",
-                                "parse_mode": "HTML",
-                            })
-                        else:
-                            requests.post(API_URL + "answerCallbackQuery", json={
-                                "callback_query_id": query_id,
-                                "text": "Не удалось обновить статус",
-                            })
-
-                    elif data_cb.startswith("orders_"):
-                        status = data_cb.split("_")[1]
-                        orders = get_orders(status=None if status == "all" else status, limit=10)
-                        if not orders:
-                            requests.post(API_URL + "answerCallbackQuery", json={
-                                "callback_query_id": query_id,
-                                "text": "Заказы не найдены",
-                            })
-                        else:
-                            msg_text = f"<b>Заказы ({status}):</b>\n\n"
-                            for o in orders[:5]:
-                                msg_text += f"#{o['id']} - {o['total_price']} грн\n"
-                            requests.post(API_URL + "editMessageText", json={
-                                "chat_id": chat_id,
-                                "message_id": query["message"]["message_id"],
-                                "text": msg_text,
-                                "parse_mode": "HTML",
-                            })
-                            requests.post(API_URL + "answerCallbackQuery", json={"callback_query_id": query_id})
+            # сначала журнал, потом offset: подтверждённое Telegram обновление уже лежит в базе;
+            # отброшенные admission не пишутся вовсе
+            admitted = [u for u in updates if admit(dispatcher, u)]
+            try:
+                fresh = journal_updates(admitted)
+            except Exception:
+                # пачка придёт снова с тем же offset: без отката оформление отбросилось бы как повтор
+                for upd in admitted:
+                    admission.revert(upd)
+                raise
+            offset = updates[-1]["update_id"] + 1
+            for upd in fresh:
+                dispatch(dispatcher, upd)
 
         except Exception as e:
             logger.error("Error: %s", e)
             time.sleep(5)
 
 
+def run_webhook(dispatcher: UpdateDispatcher) -> None:
+    def accept(upd: Dict[str, Any]) -> bool:
+        UPDATES_RECEIVED.inc(source="webhook")
+        if not admit(dispatcher, upd):
+            return True  # отброшено: повторная доставка не нужна
+        try:
+            if not journal_updates([upd]):
+                return True  # повторная доставка уже записанного обновления
+        except Exception:
+            admission.revert(upd)  # ошибка - Telegram повторит доставку, она не должна считаться дублем
+            raise
+        if dispatcher.submit(upd, timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+            return True
+        forget_update(upd["update_id"])  # 503: Telegram повторит доставку
+        admission.revert(upd)
+        return False
+
+    server = WebhookServer(
+        accept,
+        WEBHOOK_SECRET,
+        host=WEBHOOK_HOST,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+    )
+    if WEBHOOK_URL:
+        result = telegram.call("setWebhook", {
+            "url": WEBHOOK_URL,
+            "secret_token": WEBHOOK_SECRET,
+            "allowed_updates": ["message", "callback_query"],
+            "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        })
+        logger.info("setWebhook %s: %s", WEBHOOK_URL, result.get("description"))
+    logger.info("Webhook listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    server.serve_forever()
+
+
+profiler = profiling.SamplingProfiler(PROFILE_DIR)
+
+
+def start_profile(chat_id: int, seconds: float) -> threading.Thread:
+    def run() -> None:
+        try:
+            report = profiler.run(seconds)
+            if report is not None:
+                logger.info("Profile: %s busy stacks in %.0fs, dump %s", report.busy, report.seconds, report.path)
+                send_message(chat_id, profiling.format_report(report), parse_mode="HTML", priority=PRIORITY_ADMIN)
+        except Exception as e:
+            logger.error("Profile error: %s", e)
+            send_message(chat_id, f"Профилирование не удалось: {e}", priority=PRIORITY_ADMIN)
+
+    t = threading.Thread(target=run, name="profiler", daemon=True)
+    t.start()
+    return t
+
+
+def start_journal_pruner() -> threading.Thread:
+    def loop() -> None:
+        while True:
+            try:
+                removed = prune_update_journal(UPDATE_JOURNAL_RETENTION_DAYS)
+                if removed:
+                    logger.info("Update journal: pruned %s entries", removed)
+            except Exception as e:
+                logger.error("Journal prune error: %s", e)
+            time.sleep(3600)
+
+    t = threading.Thread(target=loop, name="journal-pruner", daemon=True)
+    t.start()
+    return t
+
+
+def start_reservation_sweeper() -> threading.Thread:
+    def loop() -> None:
+        while True:
+            time.sleep(RESERVATION_SWEEP_INTERVAL)
+            try:
+                expired = expire_reservations()
+                if expired:
+                    logger.info("Stock reservations expired for orders %s", expired)
+                    for oid in expired:
+                        notify_status_change(oid, "cancelled")
+                    ids = ", ".join(f"#{oid}" for oid in expired)
+                    send_message(ADMIN_CHAT_ID, f"⌛ Не оплачены вовремя, резерв снят и заказы отменены: {ids}",
+                                 priority=PRIORITY_ADMIN)
+            except Exception as e:
+                logger.error("Reservation sweep error: %s", e)
+
+    t = threading.Thread(target=loop, name="reservation-sweeper", daemon=True)
+    t.start()
+    return t
+
+
+def start_archiver() -> threading.Thread:
+    def loop() -> None:
+        while True:
+            time.sleep(ARCHIVE_INTERVAL)
+            try:
+                moved = archive_orders(ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE)
+                if moved:
+                    released = incremental_vacuum()
+                    logger.info("Archived %s orders, released %s pages", moved, released)
+            except Exception as e:
+                logger.error("Archive error: %s", e)
+
+    t = threading.Thread(target=loop, name="order-archiver", daemon=True)
+    t.start()
+    return t
+
+
+def main():
+    profiling.install()
+    init_db()
+    load_products()
+    catalog.start_watching()
+    promos.start_watching()
+    outbox.start()
+    OUTBOX_PENDING.set_function(outbox.pending)
+    if BOT_METRICS_PORT:
+        start_http_server(BOT_METRICS_PORT, host=BOT_METRICS_HOST)
+        logger.info("Metrics on http://%s:%s/metrics", BOT_METRICS_HOST, BOT_METRICS_PORT)
+    if reconcile.RECONCILE_INTERVAL > 0 and LIQPAY_PUBLIC_KEY != "your_public_key":
+        client = liqpay.LiqPayClient(LIQPAY_PUBLIC_KEY, LIQPAY_PRIVATE_KEY, pool_size=reconcile.RECONCILE_WORKERS)
+        reconcile.start_scheduler(client, on_paid=notify_reconciled, on_paid_after_cancel=notify_paid_after_cancel)
+        logger.info("Payment reconciliation every %ss", reconcile.RECONCILE_INTERVAL)
+    logger.info("Bot started...")
+
+    dispatcher = None
+    if BOT_WORKERS > 0 or BOT_MODE == "webhook":
+        workers = max(BOT_WORKERS, 1)
+        dispatcher = UpdateDispatcher(handle_update, workers=workers, max_pending=BOT_QUEUE_SIZE)
+        dispatcher.start()
+        DISPATCHER_QUEUE_DEPTH.set_function(dispatcher.qsize)
+        logger.info("Dispatcher started: %s workers, queue %s", workers, BOT_QUEUE_SIZE)
+
+    replay_journal(dispatcher)
+    start_journal_pruner()
+    start_reservation_sweeper()
+    broadcaster.start()
+    if ARCHIVE_INTERVAL > 0:
+        start_archiver()
+
+    if BOT_MODE == "webhook":
+        run_webhook(dispatcher)
+    else:
+        run_polling(dispatcher)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,123 @@
+"""
+Рассылка покупателям (/broadcast): получатели и их состояние хранятся в базе (storage.py),
+сообщения уходят через общую очередь отправки с приоритетом PRIORITY_BULK - на пределе лимита Telegram,
+но после ответов покупателям и уведомлений админу.
+
+Получатели забираются из базы небольшими пачками, только когда очередь отправки почти пуста, поэтому
+в состоянии sending одновременно не больше max_queued человек. После перезапуска такие получатели
+помечаются unknown и повторно не получают сообщение; остальные досылаются с того же места.
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from metrics import BROADCAST_MESSAGES
+from storage import (
+    BroadcastJob, broadcast_progress, claim_broadcast_recipients, finish_broadcast, get_broadcast,
+    get_running_broadcasts, record_broadcast_results, recover_broadcasts,
+)
+from telegram_api import PRIORITY_BULK, OutboundSender
+
+logger = logging.getLogger(__name__)
+
+
+def result_state(result: Dict[str, Any]) -> Tuple[str, str | None]:
+    """Ответ Bot API -> (sent | blocked | failed, ошибка). 403 - бот заблокирован или аккаунт удалён."""
+    if result.get("ok"):
+        return "sent", None
+    state = "blocked" if result.get("error_code") == 403 else "failed"
+    return state, str(result.get("description") or result.get("error_code"))[:200]
+
+
+class Broadcaster:
+    """
+    Один фоновый поток, задания выполняются по очереди в порядке создания.
+    on_progress(job, counts, finished) вызывается не чаще раза в progress_interval секунд и в конце задания.
+    """
+
+    def __init__(self, outbox: OutboundSender, on_progress: Callable[[BroadcastJob, Dict[str, int], bool], None],
+                 max_queued: int = 60, progress_interval: float = 10):
+        self.outbox = outbox
+        self.on_progress = on_progress
+        self.max_queued = max_queued
+        self.progress_interval = progress_interval
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._results: List[Tuple[int, str, str | None]] = []
+        self._in_flight = 0
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> threading.Thread:
+        recovered = recover_broadcasts()
+        if recovered:
+            logger.warning("Broadcast: %s recipients were in flight at shutdown, marked unknown", recovered)
+        self._thread = threading.Thread(target=self._loop, name="broadcaster", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def wake(self) -> None:
+        """Запустить новое задание, не дожидаясь следующей проверки."""
+        self._wake.set()
+
+    def _loop(self) -> None:
+        while True:
+            for job_id in get_running_broadcasts():
+                try:
+                    self._run(job_id)
+                except Exception as e:
+                    logger.error("Broadcast %s error: %s", job_id, e)
+                    time.sleep(5)
+            self._wake.wait(60)
+            self._wake.clear()
+
+    def _run(self, job_id: int) -> None:
+        job = get_broadcast(job_id)
+        logger.info("Broadcast %s started", job_id)
+        reported = 0.0
+        while True:
+            self._flush(job_id)
+            now = time.monotonic()
+            if now - reported >= self.progress_interval:
+                self._report(job, finished=False)
+                reported = now
+            room = self.max_queued - self.outbox.pending()
+            if room <= 0:
+                time.sleep(0.2)
+                continue
+            users = claim_broadcast_recipients(job_id, room)
+            if not users:
+                with self._lock:
+                    in_flight = self._in_flight
+                if in_flight:
+                    time.sleep(0.2)
+                    continue
+                # всё отправлено, либо задание остановлено: в sending никого не осталось
+                finish_broadcast(job_id)
+                self._report(get_broadcast(job_id) or job, finished=True)
+                logger.info("Broadcast %s finished", job_id)
+                return
+            with self._lock:
+                self._in_flight += len(users)
+            for user_id in users:
+                self.outbox.send_message(user_id, job.text, priority=PRIORITY_BULK,
+                                         on_done=lambda result, user_id=user_id: self._done(user_id, result))
+
+    def _done(self, user_id: int, result: Dict[str, Any]) -> None:
+        state, error = result_state(result)
+        BROADCAST_MESSAGES.inc(result=state)
+        with self._lock:
+            self._results.append((user_id, state, error))
+
+    def _flush(self, job_id: int) -> None:
+        with self._lock:
+            results, self._results = self._results, []
+        record_broadcast_results(job_id, results)
+        with self._lock:
+            self._in_flight -= len(results)
+
+    def _report(self, job: BroadcastJob, finished: bool) -> None:
+        try:
+            self.on_progress(job, broadcast_progress(job.id), finished)
+        except Exception as e:
+            logger.error("Broadcast progress error: %s", e)
@@ -0,0 +1,139 @@
+﻿"""
+Каталог товаров из products.json.
+
+Файл компилируется в неизменяемый снимок с индексами по товару, по (товар, опция)
+и по категории. Новый снимок собирается целиком и подменяется одной операцией
+присваивания, поэтому заказ в процессе оформления никогда не видит полузагруженный каталог.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class OptionRecord(NamedTuple):
+    id: str
+    name: str
+    in_stock: bool
+
+
+class ProductRecord(NamedTuple):
+    id: int
+    name: str
+    price: float
+    category: str
+    image: str
+    option_label: str
+    in_stock: bool
+    options: Tuple[OptionRecord, ...]
+
+
+class CatalogSnapshot:
+    __slots__ = ("version", "products", "_by_id", "_options", "_by_category")
+
+    def __init__(self, products: List[ProductRecord], version: str):
+        self.version = version
+        self.products: Tuple[ProductRecord, ...] = tuple(products)
+        self._by_id: Dict[int, ProductRecord] = {p.id: p for p in self.products}
+        self._options: Dict[Tuple[int, str], OptionRecord] = {
+            (p.id, o.id): o for p in self.products for o in p.options
+        }
+        by_category: Dict[str, List[ProductRecord]] = {}
+        for p in self.products:
+            by_category.setdefault(p.category, []).append(p)
+        self._by_category: Dict[str, Tuple[ProductRecord, ...]] = {k: tuple(v) for k, v in by_category.items()}
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def product(self, pid: int) -> ProductRecord | None:
+        return self._by_id.get(pid)
+
+    def option(self, pid: int, opt_id: Any) -> OptionRecord | None:
+        if opt_id is None or opt_id == "":
+            return None
+        return self._options.get((pid, opt_id if isinstance(opt_id, str) else str(opt_id)))
+
+    def category(self, name: str) -> Tuple[ProductRecord, ...]:
+        return self._by_category.get(name, ())
+
+    def categories(self) -> List[str]:
+        return list(self._by_category)
+
+
+EMPTY_SNAPSHOT = CatalogSnapshot([], "")
+
+
+def compile_products(raw: List[Dict[str, Any]], version: str) -> CatalogSnapshot:
+    products = []
+    for p in raw:
+        options = tuple(
+            OptionRecord(str(o["id"]), o.get("name", str(o["id"])), o.get("inStock", True) is not False)
+            for o in p.get("options") or []
+        )
+        in_stock = any(o.in_stock for o in options) if options else p.get("inStock", True) is not False
+        products.append(ProductRecord(
+            id=int(p["id"]),
+            name=p["name"],
+            price=p["price"],
+            category=p.get("category", ""),
+            image=p.get("image", ""),
+            option_label=p.get("optionLabel", ""),
+            in_stock=in_stock,
+            options=options,
+        ))
+    return CatalogSnapshot(products, version)
+
+
+class Catalog:
+    def __init__(self, path: str, poll_interval: float = 2.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._snapshot = EMPTY_SNAPSHOT
+        self._stamp: Tuple[int, int] | None = None
+        self._lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+
+    def current(self) -> CatalogSnapshot:
+        return self._snapshot
+
+    def reload(self, force: bool = False) -> bool:
+        """Пересобирает снимок, если файл изменился. При ошибке остаётся прежний каталог."""
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                if force:
+                    logger.error("products.json not found")
+                return False
+            stamp = (st.st_mtime_ns, st.st_size)
+            if not force and stamp == self._stamp:
+                return False
+            try:
+                with open(self.path, "rb") as f:
+                    data = f.read()
+                snapshot = compile_products(json.loads(data), hashlib.sha1(data).hexdigest()[:12])
+            except Exception as e:
+                logger.exception("Failed to load products: %s", e)
+                self._stamp = stamp
+                return False
+            self._snapshot = snapshot
+            self._stamp = stamp
+        logger.info("Products loaded: %s (version %s)", len(snapshot), snapshot.version)
+        return True
+
+    def start_watching(self) -> None:
+        if self._watcher:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="catalog-watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            self.reload()
@@ -0,0 +1,238 @@
+﻿"""
+Сборка каталога для WebApp: минифицированный products.json с хэшем содержимого в имени,
+готовые gzip- и brotli-варианты (brotli - если установлен пакет brotli) и маленький манифест.
+Запуск:
+    python catalog_bundle.py
+    python catalog_bundle.py --source webapp/products.json -o webapp/catalog
+
+По умолчанию файлы пишутся в catalog/ рядом с products.json - WebApp читает их оттуда (catalog/manifest.json),
+тот же путь отдаёт и payment_handler.py, поэтому страница работает с любым из двух источников.
+
+Файл бандла неизменяем (новое содержимое - новое имя), поэтому отдаётся с долгим
+Cache-Control; манифест короткий и проверяется по ETag (304 без тела).
+payment_handler.py раздаёт то же самое из памяти через BundleCache.
+Если собран манифест картинок (image_pipeline.py), товары в бандле получают imageSet/optionImageSets со srcset.
+inStock учитываемых товаров берётся из таблицы stock (storage.py): бандл пересобирается при смене версии наличия.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него отдаются gzip и несжатый вариант
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCE = os.path.join(BASE_DIR, "products.json")
+MANIFEST_NAME = "manifest.json"
+# манифест image_pipeline.py относительно каталога с products.json
+IMAGES_MANIFEST = os.path.join("img", "derived", "manifest.json")
+
+
+class Bundle(NamedTuple):
+    version: str
+    file: str
+    raw: bytes
+    gzip: bytes
+    br: bytes | None
+    manifest: bytes
+
+    def etag(self, encoding: str | None = None) -> str:
+        """Сильный ETag отдельно для каждого варианта: сжатые тела побайтно отличаются от несжатого."""
+        return f"{self.version}-{encoding}" if encoding else self.version
+
+    def variant(self, accept_encoding: str) -> Tuple[bytes, str | None]:
+        """Тело и Content-Encoding под заголовок Accept-Encoding клиента."""
+        accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+        if self.br is not None and "br" in accepted:
+            return self.br, "br"
+        if "gzip" in accepted:
+            return self.gzip, "gzip"
+        return self.raw, None
+
+
+def minify(products: List[Dict[str, Any]]) -> bytes:
+    return json.dumps(products, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def apply_images(products: List[Dict[str, Any]], images: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Добавляет к товарам srcset из манифеста image_pipeline.py; исходные словари не меняются."""
+    sets = images.get("products") or {}
+    if not sets:
+        return products
+    result = []
+    for p in products:
+        entry = sets.get(str(p.get("id")))
+        if entry:
+            p = dict(p)
+            if "image" in entry:
+                p["imageSet"] = entry["image"]
+            if entry.get("options"):
+                p["optionImageSets"] = entry["options"]
+        result.append(p)
+    return result
+
+
+def apply_stock(products: List[Dict[str, Any]], stock: Dict[Tuple[int, str], int]) -> List[Dict[str, Any]]:
+    """inStock из остатков {(product_id, option_id): qty}; у товаров без строки в stock остаётся как в products.json."""
+    if not stock:
+        return products
+    result = []
+    for p in products:
+        pid = int(p["id"])
+        if p.get("options"):
+            options = [
+                dict(o, inStock=stock[(pid, str(o["id"]))] > 0) if (pid, str(o["id"])) in stock else o
+                for o in p["options"]
+            ]
+            p = dict(p, options=options)
+        elif (pid, "") in stock:
+            p = dict(p, inStock=stock[(pid, "")] > 0)
+        result.append(p)
+    return result
+
+
+def build_bundle(products: List[Dict[str, Any]], images: Dict[str, Any] | None = None,
+                 stock: Dict[Tuple[int, str], int] | None = None) -> Bundle:
+    if images:
+        products = apply_images(products, images)
+    if stock:
+        products = apply_stock(products, stock)
+    raw = minify(products)
+    version = hashlib.sha256(raw).hexdigest()[:16]
+    name = f"catalog.{version}.json"
+    manifest = {
+        "version": version,
+        "file": name,
+        "size": len(raw),
+        "products": len(products),
+    }
+    return Bundle(
+        version=version,
+        file=name,
+        raw=raw,
+        # mtime=0: одинаковый вход - побайтно одинаковый .gz
+        gzip=gzip.compress(raw, compresslevel=9, mtime=0),
+        br=brotli.compress(raw, quality=11) if brotli else None,
+        manifest=json.dumps(manifest, separators=(",", ":")).encode("utf-8"),
+    )
+
+
+def load_products(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8-sig") as f:
+        return json.load(f)
+
+
+def load_images(path: str) -> Dict[str, Any] | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_bundle(bundle: Bundle, out_dir: str, keep: int = 3) -> List[str]:
+    """Пишет бандл и манифест в out_dir; старые бандлы сверх keep последних удаляются."""
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    variants = [(bundle.file, bundle.raw), (bundle.file + ".gz", bundle.gzip)]
+    if bundle.br is not None:
+        variants.append((bundle.file + ".br", bundle.br))
+    for name, data in variants + [(MANIFEST_NAME, bundle.manifest)]:
+        path = os.path.join(out_dir, name)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        written.append(path)
+
+    old = sorted(
+        (os.path.getmtime(os.path.join(out_dir, n)), n) for n in os.listdir(out_dir)
+        if n.startswith("catalog.") and n.endswith(".json") and n != bundle.file
+    )
+    for _, name in old[:max(0, len(old) - (keep - 1))]:
+        for suffix in ("", ".gz", ".br"):
+            try:
+                os.remove(os.path.join(out_dir, name + suffix))
+            except FileNotFoundError:
+                pass
+    return written
+
+
+class BundleCache:
+    """Бандл в памяти для раздачи из Flask; пересобирается, когда меняется исходный файл."""
+
+    def __init__(self, source: str = DEFAULT_SOURCE, keep: int = 2, images: str | None = None,
+                 stock_version: Callable[[], int] | None = None,
+                 stock_levels: Callable[[], Dict[Tuple[int, str], int]] | None = None):
+        self.source = source
+        self.stock_version = stock_version
+        self.stock_levels = stock_levels
+        self.images = images or os.path.join(os.path.dirname(os.path.abspath(source)), IMAGES_MANIFEST)
+        self.keep = keep
+        self._stamp: Tuple[Any, ...] | None = None
+        self._current: Bundle | None = None
+        self._by_version: Dict[str, Bundle] = {}
+        self._lock = threading.Lock()
+
+    def current(self) -> Bundle | None:
+        stamp = _stamp(self.source) + _stamp(self.images)
+        if self.stock_version:
+            stamp += (self.stock_version(),)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    stock = self.stock_levels() if self.stock_levels else None
+                    bundle = build_bundle(load_products(self.source), load_images(self.images), stock)
+                    # предыдущие версии остаются доступны клиентам, успевшим прочитать старый манифест
+                    self._by_version[bundle.version] = bundle
+                    while len(self._by_version) > self.keep:
+                        self._by_version.pop(next(iter(self._by_version)))
+                    self._current, self._stamp = bundle, stamp
+        return self._current
+
+    def get(self, version: str) -> Bundle | None:
+        self.current()
+        return self._by_version.get(version)
+
+
+def _stamp(path: str) -> Tuple[int, int] | Tuple[None, None]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None, None
+    return st.st_mtime_ns, st.st_size
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Сборка версионированного бандла каталога")
+    parser.add_argument("--source", default=DEFAULT_SOURCE, help="products.json")
+    parser.add_argument("-o", "--out", help="каталог для файлов (по умолчанию catalog/ рядом с --source)")
+    parser.add_argument("--images", help="манифест image_pipeline.py (по умолчанию img/derived/manifest.json рядом с --source)")
+    parser.add_argument("--stock", action="store_true", help="inStock по текущим остаткам из базы (DB_PATH)")
+    parser.add_argument("--keep", type=int, default=3, help="сколько последних версий оставить")
+    args = parser.parse_args()
+
+    out_dir = args.out or os.path.join(os.path.dirname(os.path.abspath(args.source)), "catalog")
+    images_path = args.images or os.path.join(os.path.dirname(os.path.abspath(args.source)), IMAGES_MANIFEST)
+    stock = None
+    if args.stock:
+        import storage
+        storage.init_db()
+        stock = storage.get_stock()
+    bundle = build_bundle(load_products(args.source), load_images(images_path), stock)
+    for path in write_bundle(bundle, out_dir, args.keep):
+        print(f"{path} ({os.path.getsize(path)} байт)")
+    if bundle.br is None:
+        print("brotli не установлен - .br не создан (pip install brotli)", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+﻿"""
+Диспетчер обновлений Telegram: пул воркеров с сохранением порядка внутри чата.
+
+Обновления одного чата обрабатываются строго по очереди, разные чаты - параллельно.
+Очередь ограничена: при переполнении submit() блокируется (backpressure на getUpdates).
+"""
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+
+def chat_key(upd: Dict[str, Any]) -> int:
+    if "message" in upd:
+        return upd["message"]["chat"]["id"]
+    if "callback_query" in upd:
+        query = upd["callback_query"]
+        return query.get("message", {}).get("chat", {}).get("id") or query["from"]["id"]
+    return 0
+
+
+class UpdateDispatcher:
+    def __init__(self, handler: Callable[[Dict[str, Any]], None], workers: int = 4, max_pending: int = 200):
+        self._handler = handler
+        self._workers = max(1, workers)
+        self._max_pending = max(1, max_pending)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # chat -> ожидающие обновления; чат в _ready, только если у него есть обновления и он не занят воркером
+        self._queues: Dict[int, Deque[Dict[str, Any]]] = {}
+        self._ready: Deque[int] = deque()
+        self._active: Set[int] = set()
+        self._pending = 0
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        for i in range(self._workers):
+            t = threading.Thread(target=self._worker, name=f"update-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, upd: Dict[str, Any], timeout: float | None = None) -> bool:
+        """Ставит обновление в очередь. Блокируется, пока очередь полна; False - по таймауту или при остановке."""
+        key = chat_key(upd)
+        with self._not_full:
+            if not self._not_full.wait_for(lambda: self._pending < self._max_pending or self._stopping, timeout):
+                return False
+            if self._stopping:
+                return False
+            chat_queue = self._queues.setdefault(key, deque())
+            chat_queue.append(upd)
+            self._pending += 1
+            if len(chat_queue) == 1 and key not in self._active:
+                self._ready.append(key)
+                self._not_empty.notify()
+        return True
+
+    def qsize(self) -> int:
+        with self._lock:
+            return self._pending
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Дорабатывает уже принятые обновления и останавливает воркеры."""
+        with self._lock:
+            self._stopping = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _worker(self) -> None:
+        while True:
+            with self._not_empty:
+                self._not_empty.wait_for(lambda: self._ready or self._stopping)
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                upd = self._queues[key].popleft()
+                self._active.add(key)
+                self._pending -= 1
+                self._not_full.notify()
+
+            try:
+                self._handler(upd)
+            except Exception:
+                logger.exception("Update %s handler error", upd.get("update_id"))
+
+            with self._lock:
+                self._active.discard(key)
+                if self._queues[key]:
+                    self._ready.append(key)
+                    self._not_empty.notify()
+                else:
+                    del self._queues[key]
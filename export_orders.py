@@ -0,0 +1,112 @@
+﻿"""
+Выгрузка заказов для бухгалтерии (CSV или JSONL).
+Запуск:
+    python export_orders.py --format csv --since 2025-01-01 --until 2025-02-01 -o orders.csv
+    python export_orders.py --format jsonl --payment-status paid > paid.jsonl
+
+Заказы читаются потоково отдельным read-only соединением: память не растёт с размером
+таблицы, а запись бота в это время не блокируется (WAL).
+"""
+import argparse
+import csv
+import json
+import sys
+from typing import Any, Dict, Generator, Iterable, TextIO
+
+from storage import OrderRecord, connect_readonly, iter_orders
+
+CSV_FIELDS = [
+    'id', 'created_at', 'user_id', 'user_name', 'status', 'payment_status', 'total_price', 'promo_code', 'discount',
+    'contact_name', 'contact_phone', 'contact_address', 'contact_comment', 'items_count', 'items',
+]
+
+
+def to_csv_row(order: OrderRecord) -> Dict[str, Any]:
+    contact = order.contact
+    items = order.items or []
+    return {
+        'id': order.id,
+        'created_at': order.created_at,
+        'user_id': order.user_id,
+        'user_name': order.user_name,
+        'status': order.status,
+        'payment_status': order.payment_status,
+        'total_price': order.total_price,
+        'promo_code': order.promo_code,
+        'discount': order.discount,
+        'contact_name': contact.get('name'),
+        'contact_phone': contact.get('phone'),
+        'contact_address': contact.get('address'),
+        'contact_comment': contact.get('comment'),
+        'items_count': sum(int(i.get('qty', 1)) for i in items),
+        'items': "; ".join(f"{i['name']} x{i['qty']} = {i['price'] * i['qty']}" for i in items),
+    }
+
+
+def to_json_row(order: OrderRecord) -> Dict[str, Any]:
+    return order.as_dict()
+
+
+def write_csv(orders: Iterable[OrderRecord], out: TextIO) -> int:
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+    count = 0
+    for row in map(to_csv_row, orders):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def write_jsonl(orders: Iterable[OrderRecord], out: TextIO) -> int:
+    count = 0
+    for row in map(to_json_row, orders):
+        out.write(json.dumps(row, ensure_ascii=False))
+        out.write("\n")
+        count += 1
+    return count
+
+
+WRITERS = {"csv": write_csv, "jsonl": write_jsonl}
+
+
+def export(args: argparse.Namespace, out: TextIO) -> int:
+    conn = connect_readonly()
+    orders: Generator[OrderRecord, None, None] = iter_orders(
+        conn,
+        since=args.since,
+        until=args.until,
+        status=args.status,
+        payment_status=args.payment_status,
+        batch_size=args.batch_size,
+    )
+    try:
+        return WRITERS[args.format](orders, out)
+    finally:
+        orders.close()
+        conn.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Выгрузка заказов в CSV/JSONL")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    parser.add_argument("-o", "--output", default="-", help="файл или '-' для stdout")
+    parser.add_argument("--since", help="created_at >= (YYYY-MM-DD или 'YYYY-MM-DD HH:MM:SS', UTC)")
+    parser.add_argument("--until", help="created_at < (YYYY-MM-DD или 'YYYY-MM-DD HH:MM:SS', UTC)")
+    parser.add_argument("--status", help="new, processing, completed, cancelled")
+    parser.add_argument("--payment-status", help="pending, paid, failed, expired")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.output == "-":
+        count = export(args, sys.stdout)
+    else:
+        # BOM для CSV, чтобы Excel правильно открыл кириллицу
+        encoding = "utf-8-sig" if args.format == "csv" else "utf-8"
+        with open(args.output, "w", encoding=encoding, newline="") as out:
+            count = export(args, out)
+    print(f"Выгружено заказов: {count}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""
+Производные изображения каталога: уменьшенные WebP/JPEG нескольких ширин и манифест srcset для WebApp.
+Запуск:
+    python image_pipeline.py
+    python image_pipeline.py --catalog webapp/products.json --widths 200,400,800 --workers 4
+
+Исходники - поля image и optionImages каталога: локальные пути (относительно products.json) или URL,
+URL скачиваются один раз в кэш рядом с производными. В имени производного файла есть хэш содержимого
+исходника, поэтому неизменённые картинки (тот же sha256 и те же настройки) пропускаются и пересборка
+после замены пары фото занимает секунды. Картинки обрабатываются в пуле процессов.
+Манифест (img/derived/manifest.json) подхватывает catalog_bundle.py: в бандл попадают imageSet/optionImageSets.
+Нужен Pillow: pip install Pillow
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow нужен только этому инструменту, бот и сервер работают без него
+    Image = ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CATALOG = os.path.join(BASE_DIR, "products.json")
+DERIVED_DIR = os.path.join("img", "derived")
+MANIFEST_NAME = "manifest.json"
+STATE_NAME = ".pipeline-state.json"
+SOURCES_DIR = ".sources"
+
+DEFAULT_WIDTHS = (160, 320, 640)
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+# меняется при изменении алгоритма - старое состояние тогда не используется
+PIPELINE_VERSION = 1
+
+
+def iter_image_refs(products: List[Dict[str, Any]]) -> Iterator[Tuple[str, str | None, str]]:
+    """(id товара, id варианта или None, ссылка на картинку как в каталоге)"""
+    for p in products:
+        pid = str(p["id"])
+        if p.get("image"):
+            yield pid, None, p["image"]
+        for opt_id, ref in (p.get("optionImages") or {}).items():
+            if ref:
+                yield pid, str(opt_id), ref
+
+
+def is_remote(ref: str) -> bool:
+    return urlparse(ref).scheme in ("http", "https")
+
+
+def slug(ref: str) -> str:
+    name = os.path.splitext(os.path.basename(urlparse(ref).path))[0].lower()
+    return re.sub(r"[^a-z0-9_-]+", "-", name).strip("-")[:48] or "image"
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fetch_remote(url: str, cache_dir: str, refresh: bool = False, timeout: float = 20) -> str:
+    """Скачивает картинку по URL в кэш (имя - хэш URL) и возвращает локальный путь."""
+    ext = os.path.splitext(urlparse(url).path)[1].lower() or ".img"
+    path = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest()[:16] + ext)
+    if os.path.exists(path) and not refresh:
+        return path
+    resp = requests.get(url, timeout=timeout)
+    resp.raise_for_status()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(resp.content)
+    os.replace(tmp, path)
+    return path
+
+
+def target_widths(width: int, widths: Sequence[int]) -> List[int]:
+    """Ширины производных без увеличения: если исходник уже самой большой ширины, последняя - его собственная."""
+    targets = {w for w in widths if w < width}
+    targets.add(min(max(widths), width))
+    return sorted(targets)
+
+
+def _save(image: Any, path: str, fmt: str, **options: Any) -> None:
+    tmp = path + ".tmp"
+    image.save(tmp, fmt, **options)
+    os.replace(tmp, path)
+
+
+def render_image(path: str, digest: str, stem: str, out_dir: str, widths: Sequence[int],
+                 jpeg_quality: int = JPEG_QUALITY, webp_quality: int = WEBP_QUALITY) -> Dict[str, Any]:
+    """
+    Делает WebP и JPEG для каждой ширины. Выполняется в процессе пула, поэтому получает и возвращает
+    только простые значения: {"width", "height", "files": [(ширина, webp, jpeg), ...]} с именами файлов.
+    """
+    with Image.open(path) as im:
+        width, height = im.size
+        targets = target_widths(width, widths)
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8) - в разы быстрее полного декодирования
+        im.draft("RGB", (targets[-1], max(1, height * targets[-1] // width)))
+        im = ImageOps.exif_transpose(im)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        width, height = im.size
+        files = []
+        for w in target_widths(width, targets):
+            h = max(1, round(height * w / width))
+            resized = im if w == width else im.resize((w, h), Image.LANCZOS)
+            base = f"{stem}-{digest[:10]}-{w}"
+            _save(resized, os.path.join(out_dir, base + ".webp"), "WEBP", quality=webp_quality, method=6)
+            _save(resized, os.path.join(out_dir, base + ".jpg"), "JPEG", quality=jpeg_quality,
+                  optimize=True, progressive=True)
+            files.append((w, base + ".webp", base + ".jpg"))
+    return {"width": width, "height": height, "files": files}
+
+
+def srcset_entry(rendered: Dict[str, Any], url_prefix: str) -> Dict[str, Any]:
+    files = rendered["files"]
+    return {
+        "src": url_prefix + files[-1][2],
+        "webp": ", ".join(f"{url_prefix}{webp} {w}w" for w, webp, _ in files),
+        "jpeg": ", ".join(f"{url_prefix}{jpeg} {w}w" for w, _, jpeg in files),
+        "width": rendered["width"],
+        "height": rendered["height"],
+    }
+
+
+def _load_json(path: str, default: Any) -> Any:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _write_json(path: str, data: Any) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def build(catalog_path: str = DEFAULT_CATALOG, out_dir: str | None = None, widths: Sequence[int] = DEFAULT_WIDTHS,
+          workers: int | None = None, refresh_remote: bool = False,
+          jpeg_quality: int = JPEG_QUALITY, webp_quality: int = WEBP_QUALITY) -> Dict[str, Any]:
+    """Собирает производные для всех картинок каталога и пишет манифест. Возвращает сводку прогона."""
+    if Image is None:
+        raise RuntimeError("Pillow is not installed (pip install Pillow)")
+    started = time.monotonic()
+    root = os.path.dirname(os.path.abspath(catalog_path))
+    out_dir = out_dir or os.path.join(root, DERIVED_DIR)
+    sources_dir = os.path.join(out_dir, SOURCES_DIR)
+    os.makedirs(sources_dir, exist_ok=True)
+    # пути в манифесте - относительно страницы WebApp, которая лежит рядом с products.json
+    url_prefix = os.path.relpath(out_dir, root).replace(os.sep, "/") + "/"
+
+    with open(catalog_path, "r", encoding="utf-8-sig") as f:
+        products = json.load(f)
+    refs = list(iter_image_refs(products))
+    unique = sorted({ref for _, _, ref in refs})
+
+    # 1. исходники: локальные файлы как есть, URL - из кэша (скачиваются параллельно, это ввод-вывод)
+    paths: Dict[str, str] = {}
+    missing: List[str] = []
+    remote = [ref for ref in unique if is_remote(ref)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        fetched = pool.map(lambda url: _try_fetch(url, sources_dir, refresh_remote), remote)
+        for url, path in zip(remote, fetched):
+            if path:
+                paths[url] = path
+            else:
+                missing.append(url)
+    for ref in unique:
+        if is_remote(ref):
+            continue
+        path = os.path.join(root, ref)
+        if os.path.isfile(path):
+            paths[ref] = path
+        else:
+            logger.warning("Image not found: %s", ref)
+            missing.append(ref)
+
+    # 2. хэши содержимого; рендерим только то, чего нет в состоянии прошлого прогона
+    settings = {"version": PIPELINE_VERSION, "widths": sorted(widths), "jpeg": jpeg_quality, "webp": webp_quality}
+    state = _load_json(os.path.join(out_dir, STATE_NAME), {})
+    done: Dict[str, Dict[str, Any]] = state.get("images", {}) if state.get("settings") == settings else {}
+    digests = {ref: file_digest(path) for ref, path in paths.items()}
+    todo: Dict[str, str] = {}
+    for ref, digest in digests.items():
+        prev = done.get(digest)
+        if prev is None or not all(os.path.exists(os.path.join(out_dir, name))
+                                   for _, webp, jpeg in prev["files"] for name in (webp, jpeg)):
+            todo.setdefault(digest, ref)
+
+    # 3. рендер в пуле процессов (декодирование и сжатие упираются в CPU, потоки тут не помогают)
+    jobs = [(paths[ref], digest, slug(ref), out_dir, tuple(widths), jpeg_quality, webp_quality)
+            for digest, ref in todo.items()]
+    failed: List[str] = []
+    if jobs:
+        if workers == 0 or len(jobs) == 1:
+            results = [_try_render(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_try_render, jobs))
+        for (digest, ref), rendered in zip(todo.items(), results):
+            if rendered is None:
+                failed.append(ref)
+            else:
+                done[digest] = rendered
+
+    # 4. манифест и состояние; файлы, на которые больше ничего не ссылается, удаляются
+    images = {digest: done[digest] for digest in set(digests.values()) if digest in done}
+    manifest: Dict[str, Any] = {"widths": sorted(widths), "products": {}}
+    for pid, opt_id, ref in refs:
+        rendered = images.get(digests.get(ref, ""))
+        if rendered is None:
+            continue
+        entry = manifest["products"].setdefault(pid, {})
+        if opt_id is None:
+            entry["image"] = srcset_entry(rendered, url_prefix)
+        else:
+            entry.setdefault("options", {})[opt_id] = srcset_entry(rendered, url_prefix)
+    _write_json(os.path.join(out_dir, STATE_NAME), {"settings": settings, "images": images})
+    _write_json(os.path.join(out_dir, MANIFEST_NAME), manifest)
+
+    keep = {name for r in images.values() for _, webp, jpeg in r["files"] for name in (webp, jpeg)}
+    removed = 0
+    for name in os.listdir(out_dir):
+        if name.endswith((".webp", ".jpg")) and name not in keep:
+            os.remove(os.path.join(out_dir, name))
+            removed += 1
+
+    return {
+        "images": len(paths),
+        "rendered": len(jobs) - len(failed),
+        "skipped": len(digests) - len(jobs),
+        "missing": missing,
+        "failed": failed,
+        "removed": removed,
+        "manifest": os.path.join(out_dir, MANIFEST_NAME),
+        "elapsed_s": round(time.monotonic() - started, 2),
+    }
+
+
+def _try_fetch(url: str, cache_dir: str, refresh: bool) -> str | None:
+    try:
+        return fetch_remote(url, cache_dir, refresh)
+    except requests.RequestException as e:
+        logger.warning("Failed to fetch %s: %s", url, e)
+        return None
+
+
+def _try_render(job: Tuple[Any, ...]) -> Dict[str, Any] | None:
+    try:
+        return render_image(*job)
+    except Exception as e:
+        logger.warning("Failed to render %s: %s", job[0], e)
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Уменьшенные WebP/JPEG и манифест srcset для картинок каталога")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG, help="products.json")
+    parser.add_argument("-o", "--out", help="каталог производных (по умолчанию img/derived рядом с products.json)")
+    parser.add_argument("--widths", default=",".join(map(str, DEFAULT_WIDTHS)), help="ширины через запятую")
+    parser.add_argument("--workers", type=int, help="процессов (по умолчанию - число CPU, 0 - без пула)")
+    parser.add_argument("--jpeg-quality", type=int, default=JPEG_QUALITY)
+    parser.add_argument("--webp-quality", type=int, default=WEBP_QUALITY)
+    parser.add_argument("--refresh-remote", action="store_true", help="заново скачать картинки по URL")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    if Image is None:
+        print("Нужен Pillow: pip install Pillow", file=sys.stderr)
+        return 1
+    widths = sorted({int(w) for w in args.widths.split(",") if w.strip()})
+    report = build(args.catalog, args.out, widths, args.workers, args.refresh_remote,
+                   args.jpeg_quality, args.webp_quality)
+    print(f"Картинок: {report['images']}, обработано: {report['rendered']}, без изменений: {report['skipped']}, "
+          f"удалено старых файлов: {report['removed']}, время: {report['elapsed_s']} с")
+    for ref in report["missing"]:
+        print(f"Не найдено: {ref}", file=sys.stderr)
+    for ref in report["failed"]:
+        print(f"Ошибка обработки: {ref}", file=sys.stderr)
+    print(f"Манифест: {report['manifest']}")
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Остатки товаров (таблица stock).
+Запуск:
+    python inventory.py seed --qty 20            # завести остатки по products.json (inStock: false -> 0)
+    python inventory.py set 2 0.6 15             # товар 2, вариант 0.6: ровно 15 шт.
+    python inventory.py add 1 mango_ice 10       # приход (отрицательное число - списание)
+    python inventory.py list
+    python inventory.py expire                   # снять просроченные резервы сейчас, не дожидаясь бота
+
+Учитываются только товары, заведённые в stock: остальные продаются как раньше, по inStock из products.json.
+Бот и payment_handler.py подхватывают изменения сразу - products.json переписывать не нужно.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import List, Tuple
+
+from storage import adjust_stock, expire_reservations, get_stock, init_db, seed_stock, set_stock
+
+DEFAULT_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "products.json")
+
+
+def seed_rows(catalog_path: str, qty: int) -> List[Tuple[int, str | None, int]]:
+    with open(catalog_path, "r", encoding="utf-8-sig") as f:
+        products = json.load(f)
+    rows = []
+    for p in products:
+        if p.get("options"):
+            rows.extend((int(p["id"]), str(o["id"]), qty if o.get("inStock", True) is not False else 0)
+                        for o in p["options"])
+        else:
+            rows.append((int(p["id"]), None, qty if p.get("inStock", True) is not False else 0))
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Остатки товаров")
+    sub = parser.add_subparsers(dest="command", required=True)
+    seed = sub.add_parser("seed", help="завести остатки для всех товаров каталога")
+    seed.add_argument("--qty", type=int, default=10, help="остаток для товаров в наличии")
+    seed.add_argument("--catalog", default=DEFAULT_CATALOG)
+    seed.add_argument("--overwrite", action="store_true", help="перезаписать уже заведённые остатки")
+    for name, help_text in (("set", "задать остаток"), ("add", "приход или списание")):
+        cmd = sub.add_parser(name, help=help_text)
+        cmd.add_argument("product_id", type=int)
+        cmd.add_argument("option_id", nargs="?", help="вариант (у товаров без вариантов не указывается)")
+        cmd.add_argument("qty", type=int)
+    sub.add_parser("list", help="текущие остатки")
+    sub.add_parser("expire", help="снять просроченные резервы")
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == "seed":
+        count = seed_stock(seed_rows(args.catalog, args.qty), overwrite=args.overwrite)
+        print(f"Заведено остатков: {count}")
+    elif args.command == "set":
+        set_stock(args.product_id, args.option_id, args.qty)
+    elif args.command == "add":
+        left = adjust_stock(args.product_id, args.option_id, args.qty)
+        if left is None:
+            print("Товар не учитывается или остаток ушёл бы в минус", file=sys.stderr)
+            return 1
+        print(f"Остаток: {left}")
+    elif args.command == "list":
+        for (pid, opt), qty in sorted(get_stock().items()):
+            print(f"{pid}\t{opt or '-'}\t{qty}")
+    elif args.command == "expire":
+        print(f"Снято резервов по заказам: {expire_reservations()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+Общая работа с LiqPay API v3 для bot.py, payment_handler.py и reconcile.py:
+кодирование data, подпись base64(sha1(private_key + data + private_key)), ссылка на оплату
+и запрос статуса платежа (action=status).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LIQPAY_CHECKOUT_URL = os.getenv("LIQPAY_CHECKOUT_URL", "https://www.liqpay.ua/api/3/checkout")
+LIQPAY_API_URL = os.getenv("LIQPAY_API_URL", "https://www.liqpay.ua/api/request")
+
+
+def encode_data(params: Dict[str, Any]) -> str:
+    data_str = json.dumps(params, separators=(',', ':'))
+    return base64.b64encode(data_str.encode('utf-8')).decode('utf-8')
+
+
+def decode_data(data: str) -> Dict[str, Any]:
+    return json.loads(base64.b64decode(data).decode('utf-8'))
+
+
+def sign(data: str, private_key: str) -> str:
+    signature_string = private_key + data + private_key
+    return base64.b64encode(hashlib.sha1(signature_string.encode('utf-8')).digest()).decode('utf-8')
+
+
+def verify_signature(data: str, signature: str, private_key: str) -> bool:
+    return hmac.compare_digest(sign(data, private_key).encode('utf-8'), signature.encode('utf-8'))
+
+
+def checkout_url(params: Dict[str, Any], private_key: str) -> str:
+    data = encode_data(params)
+    return f"{LIQPAY_CHECKOUT_URL}?data={data}&signature={sign(data, private_key)}"
+
+
+class LiqPayClient:
+    """Запросы к серверному API LiqPay через keep-alive сессию (безопасно из нескольких потоков)."""
+
+    def __init__(self, public_key: str, private_key: str, api_url: str = LIQPAY_API_URL, pool_size: int = 16):
+        self.public_key = public_key
+        self.private_key = private_key
+        self.api_url = api_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, params: Dict[str, Any], timeout: float = 15) -> Dict[str, Any]:
+        """Подписанный запрос; сетевые ошибки возвращаются как result=error, err_code=network."""
+        data = encode_data({"public_key": self.public_key, "version": "3", **params})
+        try:
+            resp = self.session.post(
+                self.api_url, data={"data": data, "signature": sign(data, self.private_key)}, timeout=timeout
+            )
+            return resp.json()
+        except (requests.RequestException, ValueError) as e:
+            return {"result": "error", "err_code": "network", "err_description": str(e)}
+
+    def status(self, order_id: int | str, timeout: float = 15) -> Dict[str, Any]:
+        return self.request({"action": "status", "order_id": str(order_id)}, timeout=timeout)
@@ -0,0 +1,212 @@
+﻿"""
+Шаблоны сообщений админу: дайджест заказов, результаты поиска /find и прогресс рассылки /broadcast.
+
+Шаблоны разбираются один раз при импорте (ошибка в имени поля видна сразу при запуске),
+а дайджест собирает столько заказов, сколько помещается в одно сообщение Telegram (4096 символов),
+и даёт каждому заказу компактную строку кнопок.
+"""
+import html
+from string import Formatter
+from typing import Any, Dict, List, Tuple
+
+from storage import SNIPPET_CLOSE, SNIPPET_OPEN, BroadcastJob, OrderRecord, OrderSearchHit
+
+MESSAGE_LIMIT = 4096
+# кнопок в inline-клавиатуре не больше 100: 3 на заказ + навигация
+DIGEST_MAX_ORDERS = 30
+# длинный состав заказа обрезается, чтобы один заказ всегда помещался в сообщение
+DIGEST_ITEMS_CHARS = 500
+
+STATUS_EMOJI = {"new": "🆕", "processing": "⏳", "completed": "✅", "cancelled": "❌"}
+# короткие коды статусов для callback_data (лимит 64 байта)
+STATUS_CODES = {"p": "processing", "c": "completed", "x": "cancelled"}
+CALLBACK_DATA_LIMIT = 64
+SEARCH_PAGE_SIZE = 5
+
+
+class Template:
+    __slots__ = ("text", "fields", "render")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.fields = frozenset(name for _, name, _, _ in Formatter().parse(text) if name)
+        self.render = text.format_map
+
+    def __call__(self, **values: Any) -> str:
+        return self.render(values)
+
+
+DIGEST_HEADER = Template("🆕 <b>Новые заказы</b> ({shown} из {total})\n\n")
+DIGEST_ENTRY = Template(
+    "<b>#{id}</b> · {total_price} грн · {created_at}\n"
+    "{name} · {phone}\n"
+    "{items}\n\n"
+)
+DIGEST_ITEM = Template("{name} x{qty}")
+DIGEST_EMPTY = Template("Новых заказов нет")
+
+SEARCH_HEADER = Template("🔎 <b>{query}</b> - результаты {first}-{last}\n\n")
+SEARCH_ENTRY = Template(
+    "{emoji} <b>#{id}</b> · {total_price} грн · {created_at}\n"
+    "{name} · {phone}\n"
+    "{snippet}\n"
+)
+SEARCH_EMPTY = Template("🔎 По запросу <b>{query}</b> ничего не найдено")
+SEARCH_FOOTER = Template("Подробнее: /order &lt;id&gt;")
+
+PAID_AFTER_CANCEL = Template(
+    "⚠️ Оплачен уже отменённый заказ {ids}: резерв снят, товар мог быть продан.\n"
+    "Верните оплату или соберите и зарезервируйте заказ заново."
+)
+
+BROADCAST_STATUS_EMOJI = {"draft": "📝", "running": "📤", "done": "✅", "cancelled": "⏹"}
+BROADCAST_PREVIEW_CHARS = 300
+BROADCAST_DRAFT = Template(
+    "📝 <b>Рассылка #{id}</b>\n"
+    "Получатели: {audience} - <b>{total}</b>\n\n"
+    "{text}"
+)
+BROADCAST_PROGRESS = Template(
+    "{emoji} <b>Рассылка #{id}</b> · {audience}\n"
+    "Отправлено {sent} из {total}\n"
+    "Заблокировали бота: {blocked} · ошибки: {failed}{unknown}\n"
+    "Осталось: {left}"
+)
+BROADCAST_LIST_ENTRY = Template("{emoji} <b>#{id}</b> · {created_at} · {audience} · {sent}/{total}, 🚫 {blocked}")
+BROADCAST_LIST_EMPTY = Template("Рассылок ещё не было")
+
+
+def _digest_entry(order: OrderRecord) -> str:
+    contact = order.contact
+    items = ", ".join(DIGEST_ITEM(name=i["name"], qty=i["qty"]) for i in order.items)
+    if len(items) > DIGEST_ITEMS_CHARS:
+        items = items[:DIGEST_ITEMS_CHARS] + "…"
+    return DIGEST_ENTRY(
+        id=order.id,
+        total_price=order.total_price,
+        created_at=order.created_at[5:16],
+        name=html.escape(str(contact.get("name") or order.user_name or "-")[:100]),
+        phone=html.escape(str(contact.get("phone") or "-")[:40]),
+        items=html.escape(items),
+    )
+
+
+def _digest_buttons(order_id: int, page: str) -> List[Dict[str, str]]:
+    return [
+        {"text": f"⏳ #{order_id}", "callback_data": f"dst_{order_id}_p_{page}"},
+        {"text": "✅", "callback_data": f"dst_{order_id}_c_{page}"},
+        {"text": "❌", "callback_data": f"dst_{order_id}_x_{page}"},
+    ]
+
+
+def render_digest(orders: List[OrderRecord], total: int, page: str,
+                  limit: int = MESSAGE_LIMIT) -> Tuple[str, List[List[Dict[str, str]]], int]:
+    """
+    Упаковывает заказы (от новых к старым) в одно сообщение. page - курсор текущей страницы для callback_data
+    ("-" - первая). Возвращает (текст, строки кнопок, сколько заказов поместилось).
+    """
+    if not orders:
+        return DIGEST_EMPTY(), [], 0
+    reserve = len(DIGEST_HEADER(shown=len(orders), total=total))
+    entries: List[str] = []
+    used = 0
+    for order in orders[:DIGEST_MAX_ORDERS]:
+        entry = _digest_entry(order)
+        if entries and used + len(entry) + reserve > limit:
+            break
+        entries.append(entry)
+        used += len(entry)
+    text = DIGEST_HEADER(shown=len(entries), total=total) + "".join(entries)
+    keyboard = [_digest_buttons(o.id, page) for o in orders[:len(entries)]]
+    return text.rstrip("\n"), keyboard, len(entries)
+
+
+def _highlight(snippet: str | None) -> str:
+    if not snippet:
+        return ""
+    return html.escape(snippet).replace(SNIPPET_OPEN, "<b>").replace(SNIPPET_CLOSE, "</b>")
+
+
+def _search_entry(hit: OrderSearchHit) -> str:
+    return SEARCH_ENTRY(
+        emoji=STATUS_EMOJI.get(hit.status, "ℹ️"),
+        id=hit.id,
+        total_price=hit.total_price,
+        created_at=hit.created_at[:16],
+        name=html.escape(str(hit.name or hit.user_name or "-")[:100]),
+        phone=html.escape(str(hit.phone or "-")[:40]),
+        snippet=_highlight(hit.snippet),
+    )
+
+
+def search_callback(query: str, offset: int) -> str | None:
+    """callback_data для листания поиска; None - запрос не помещается в 64 байта."""
+    data = f"find_{offset}_{query}"
+    return data if len(data.encode("utf-8")) <= CALLBACK_DATA_LIMIT else None
+
+
+def render_search(query: str, orders: List[OrderSearchHit], offset: int,
+                  has_more: bool) -> Tuple[str, List[List[Dict[str, str]]]]:
+    """Страница результатов /find: текст и строка навигации (пустая, если листать некуда)."""
+    safe_query = html.escape(query[:100])
+    if not orders:
+        return SEARCH_EMPTY(query=safe_query), []
+    text = SEARCH_HEADER(query=safe_query, first=offset + 1, last=offset + len(orders))
+    text += "\n".join(_search_entry(o) for o in orders) + "\n" + SEARCH_FOOTER()
+    nav = []
+    prev_data = search_callback(query, max(0, offset - SEARCH_PAGE_SIZE)) if offset else None
+    next_data = search_callback(query, offset + len(orders)) if has_more else None
+    if prev_data:
+        nav.append({"text": "◀️ Назад", "callback_data": prev_data})
+    if next_data:
+        nav.append({"text": "Далее ▶️", "callback_data": next_data})
+    elif has_more:
+        text += "\n\nЗапрос слишком длинный для листания - уточните его."
+    return text, [nav] if nav else []
+
+
+def _audience(job: BroadcastJob) -> str:
+    return html.escape(job.category) if job.category else "все покупатели"
+
+
+def render_broadcast_draft(job: BroadcastJob, total: int) -> Tuple[str, List[List[Dict[str, str]]]]:
+    text = job.text if len(job.text) <= BROADCAST_PREVIEW_CHARS else job.text[:BROADCAST_PREVIEW_CHARS] + "…"
+    keyboard = [[
+        {"text": "▶️ Отправить", "callback_data": f"bc_go_{job.id}"},
+        {"text": "✖️ Отмена", "callback_data": f"bc_x_{job.id}"},
+    ]] if total else []
+    return BROADCAST_DRAFT(id=job.id, audience=_audience(job), total=total, text=html.escape(text)), keyboard
+
+
+def render_broadcast(job: BroadcastJob, counts: Dict[str, int]) -> Tuple[str, List[List[Dict[str, str]]]]:
+    """Прогресс рассылки; у идущей - кнопка остановки."""
+    text = BROADCAST_PROGRESS(
+        emoji=BROADCAST_STATUS_EMOJI.get(job.status, "ℹ️"),
+        id=job.id,
+        audience=_audience(job),
+        sent=counts["sent"],
+        total=sum(counts.values()),
+        blocked=counts["blocked"],
+        failed=counts["failed"],
+        unknown=f" · не подтверждено (перезапуск): {counts['unknown']}" if counts["unknown"] else "",
+        left=counts["pending"] + counts["sending"],
+    )
+    keyboard = [[{"text": "⏹ Остановить", "callback_data": f"bc_x_{job.id}"}]] if job.status == "running" else []
+    return text, keyboard
+
+
+def render_broadcast_list(jobs: List[Tuple[BroadcastJob, Dict[str, int]]]) -> str:
+    if not jobs:
+        return BROADCAST_LIST_EMPTY()
+    return "\n".join(
+        BROADCAST_LIST_ENTRY(
+            emoji=BROADCAST_STATUS_EMOJI.get(job.status, "ℹ️"),
+            id=job.id,
+            created_at=job.created_at[:16],
+            audience=_audience(job),
+            sent=counts["sent"],
+            total=sum(counts.values()),
+            blocked=counts["blocked"],
+        )
+        for job, counts in jobs
+    ) + "\n\nПодробнее: /broadcast_status &lt;id&gt;"
@@ -0,0 +1,244 @@
+"""
+Метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей.
+
+Один реестр на процесс: бот отдаёт его встроенным HTTP-эндпоинтом (start_http_server),
+payment_handler.py - маршрутом /metrics во Flask.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# (имя метрики, метки, секунды) для каждого замера Histogram.time/timed - например, трассировка profiling.py
+_observers: List[Callable[[str, Dict[str, Any], float], None]] = []
+
+
+def add_observer(fn: Callable[[str, Dict[str, Any], float], None]) -> None:
+    _observers.append(fn)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: List[str] | Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[Any, ...]:
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def collect(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.collect())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        # метрика без меток видна со значением 0 с момента запуска
+        self._values: Dict[Tuple[Any, ...], float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[Any, ...], float] = {}
+        self._functions: Dict[Tuple[Any, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, fn: Callable[[], float], **labels: Any) -> None:
+        """Значение вычисляется в момент сбора (например, глубина очереди)."""
+        with self._lock:
+            self._functions[self._key(labels)] = fn
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions.items())
+        for key, fn in functions:
+            try:
+                values[key] = fn()
+            except Exception:
+                continue
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: List[str] | Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [счётчики по бакетам..., сумма, количество]
+        self._values: Dict[Tuple[Any, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(elapsed, **labels)
+            for fn in _observers:
+                fn(self.name, labels, elapsed)
+
+    def timed(self, **labels: Any) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+        """Декоратор: время выполнения функции."""
+        def decorator(fn: Callable[..., Any]) -> Callable[..., Any]:
+            @functools.wraps(fn)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                with self.time(**labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+# === Метрики магазина ===
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки обновления по типу обработчика", ["handler"])
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Время запроса к SQLite", ["query"])
+TELEGRAM_API_SECONDS = Histogram("telegram_api_seconds", "Время вызова Telegram Bot API", ["method"])
+
+ORDERS_CREATED = Counter("orders_created_total", "Созданные заказы")
+PAYMENTS = Counter("payments_total", "Callback'и LiqPay по статусу платежа", ["status"])
+SIGNATURE_FAILURES = Counter("liqpay_signature_failures_total", "Callback'и LiqPay с неверной подписью")
+SEND_ERRORS = Counter("telegram_send_errors_total", "Окончательно неудавшиеся вызовы Bot API", ["method", "code"])
+RECONCILE_RESULTS = Counter("payment_reconcile_total", "Результаты сверки оплат с LiqPay", ["result"])
+UPDATES_RECEIVED = Counter("bot_updates_total", "Полученные обновления Telegram", ["source"])
+UPDATES_DROPPED = Counter("bot_updates_dropped_total", "Обновления, отброшенные до обработки (admission.py)", ["reason"])
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Сообщения рассылки по результату", ["result"])
+
+DISPATCHER_QUEUE_DEPTH = Gauge("bot_dispatcher_queue_depth", "Обновления, ожидающие воркера")
+OUTBOX_PENDING = Gauge("telegram_outbox_pending", "Сообщения в очереди исходящей отправки")
+UPDATES_LAG_SECONDS = Gauge("bot_updates_lag_seconds", "Отставание: время получения минус дата последнего сообщения в пачке")
@@ -3,17 +3,33 @@ Webhook обработчик LiqPay
 Запуск: python payment_handler.py
 """
 import os
-import json
-import base64
-import hashlib
-import sqlite3
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+
+import liqpay
+from catalog_bundle import BundleCache
+from messages import PAID_AFTER_CANCEL
+from storage import init_db, apply_payment_callback, get_stock, get_stock_version
+from telegram_api import TelegramClient, OutboundSender, PRIORITY_ADMIN
+import metrics
+from metrics import PAYMENTS, SIGNATURE_FAILURES
 
 LIQPAY_PRIVATE_KEY = os.getenv("LIQPAY_PRIVATE_KEY", "your_private_key")
-DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "shop.db"))
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+telegram = TelegramClient(f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/", pool_size=4)
+# уведомления уходят из фоновой очереди: ответ LiqPay не ждёт Telegram
+outbox = OutboundSender(telegram, workers=1)
+outbox.start()
+
+# inStock в бандле - по таблице stock; пересборка только когда какой-то товар закончился или появился
+catalog_bundle = BundleCache(
+    os.getenv("PRODUCTS_JSON_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "products.json")),
+    stock_version=get_stock_version,
+    stock_levels=get_stock,
+)
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -21,43 +37,16 @@ logger = logging.getLogger(__name__)
 
 
 def verify_liqpay_signature(data: str, signature: str) -> bool:
-    expected_signature = base64.b64encode(
-        hashlib.sha1((LIQPAY_PRIVATE_KEY + data + LIQPAY_PRIVATE_KEY).encode('utf-8')).digest()
-    ).decode('utf-8')
-    return expected_signature == signature
-
-
-def update_order_payment_status(order_id: int, status: str) -> None:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE orders SET payment_status = ? WHERE id = ?', (status, order_id))
-    conn.commit()
-    conn.close()
-
-
-def get_order(order_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT id, total_price, payment_status FROM orders WHERE id = ?', (order_id,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        return None
-    return {"id": row[0], "total_price": row[1], "payment_status": row[2]}
+    return liqpay.verify_signature(data, signature, LIQPAY_PRIVATE_KEY)
 
 
 def send_telegram_message(chat_id: int, text: str) -> None:
-    import requests
-    api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/"
-    try:
-        requests.post(api_url + "sendMessage", json={"chat_id": chat_id, "text": text}, timeout=10)
-    except Exception as e:
-        logger.error(f"Telegram send error: {e}")
+    outbox.send_message(chat_id, text, priority=PRIORITY_ADMIN)
 
 
 @app.route('/payment_callback', methods=['POST'])
 def payment_callback():
-    """Принимает callback от LiqPay"""
+    """Принимает callback от LiqPay: проверка подписи, одна транзакция в БД, уведомление - в фоне"""
     try:
         data = request.form.get('data')
         signature = request.form.get('signature')
@@ -67,51 +56,44 @@ def payment_callback():
 
         if not verify_liqpay_signature(data, signature):
             logger.warning("Invalid signature")
+            SIGNATURE_FAILURES.inc()
             return jsonify({"error": "Invalid signature"}), 400
 
-        decoded_data = base64.b64decode(data).decode('utf-8')
-        payment_data = json.loads(decoded_data)
+        payment_data = liqpay.decode_data(data)
 
         order_id = int(payment_data.get('order_id', 0))
         status = payment_data.get('status')
         amount = payment_data.get('amount')
         currency = (payment_data.get('currency') or '').upper()
+        PAYMENTS.inc(status=status or "unknown")
 
-        order = get_order(order_id)
-        if not order:
-            logger.warning("Order not found: %s", order_id)
-            return jsonify({"error": "order not found"}), 404
-
-        if amount is None:
-            return jsonify({"error": "amount missing"}), 400
         try:
-            amount_val = float(amount)
-        except Exception:
+            amount_val = float(amount) if amount is not None else None
+        except (TypeError, ValueError):
+            amount_val = None
+
+        # отклонённые callback'и тоже пишутся в payment_events - для аудита и повторного разбора
+        result = apply_payment_callback(order_id, status, amount_val, currency or None, data, signature)
+        if result == 'invalid_amount':
+            logger.warning("Invalid amount for order %s: %r", order_id, amount)
             return jsonify({"error": "invalid amount"}), 400
-
-        if abs(float(order['total_price']) - amount_val) > 0.01:
-            logger.warning("Amount mismatch for order %s: expected %s got %s", order_id, order['total_price'], amount_val)
-            return jsonify({"error": "amount mismatch"}), 400
-
-        if currency and currency != 'UAH':
+        if result == 'currency_mismatch':
             logger.warning("Currency mismatch for order %s: %s", order_id, currency)
             return jsonify({"error": "currency mismatch"}), 400
+        if result == 'not_found':
+            logger.warning("Order not found: %s", order_id)
+            return jsonify({"error": "order not found"}), 404
+        if result == 'amount_mismatch':
+            logger.warning("Amount mismatch for order %s: got %s", order_id, amount_val)
+            return jsonify({"error": "amount mismatch"}), 400
 
-        if status == 'success':
-            if order.get('payment_status') == 'paid':
-                return jsonify({"status": "ok"})
-
-            update_order_payment_status(order_id, 'paid')
-
-            if ADMIN_CHAT_ID:
-                send_telegram_message(ADMIN_CHAT_ID, f"✅ Оплата заказа #{order_id}\nСумма: {amount_val} UAH")
+        if result == 'applied' and status == 'success' and ADMIN_CHAT_ID:
+            send_telegram_message(ADMIN_CHAT_ID, f"✅ Оплата заказа #{order_id}\nСумма: {amount_val} UAH")
+        if result == 'paid_after_cancel' and ADMIN_CHAT_ID:
+            logger.warning("Payment for cancelled order %s", order_id)
+            send_telegram_message(ADMIN_CHAT_ID, PAID_AFTER_CANCEL(ids=f"#{order_id}") + f"\nСумма: {amount_val} UAH")
 
-            return jsonify({"status": "ok"})
-        elif status == 'failure':
-            update_order_payment_status(order_id, 'failed')
-            return jsonify({"status": "ok"})
-        else:
-            return jsonify({"status": "ok"})
+        return jsonify({"status": "ok"})
 
     except Exception as e:
         logger.exception(f"Payment callback error: {e}")
@@ -124,5 +106,44 @@ def health():
     return jsonify({"status": "ok"})
 
 
+def _bundle_response(body: bytes, etag: str, cache_control: str, encoding: str | None = None) -> Response:
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, content_type="application/json; charset=utf-8")
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache_control
+    resp.headers['Vary'] = 'Accept-Encoding'
+    # WebApp открывается с другого домена
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+
+@app.route('/catalog/manifest.json', methods=['GET'])
+def catalog_manifest():
+    """Версия и имя текущего бандла каталога; клиент перепроверяет его по ETag"""
+    bundle = catalog_bundle.current()
+    return _bundle_response(bundle.manifest, bundle.version, 'no-cache')
+
+
+@app.route('/catalog/catalog.<version>.json', methods=['GET'])
+def catalog_file(version: str):
+    """Неизменяемый бандл каталога с хэшем содержимого в имени"""
+    bundle = catalog_bundle.get(version)
+    if not bundle:
+        return jsonify({"error": "unknown catalog version"}), 404
+    body, encoding = bundle.variant(request.headers.get('Accept-Encoding', ''))
+    return _bundle_response(body, bundle.etag(encoding), 'public, max-age=31536000, immutable', encoding)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в формате Prometheus"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 if __name__ == '__main__':
+    init_db()
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,201 @@
+"""
+Расчёт корзины на сервере: цены из снимка каталога и промокоды из promos.json.
+
+Сумма, пришедшая из WebApp (totalPrice), больше не используется - итог считается
+здесь за один проход по корзине. Правила промокодов компилируются в таблицу, а область
+действия (категории -> id товаров) кэшируется по паре (версия каталога, версия промокодов).
+Лимит использований на покупателя проверяется атомарно при сохранении заказа (storage.save_order_to_db).
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Tuple
+
+from catalog import Catalog, CatalogSnapshot
+
+logger = logging.getLogger(__name__)
+
+PROMO_KINDS = ("percent", "fixed")
+
+
+class PromoRule(NamedTuple):
+    code: str
+    kind: str  # percent | fixed
+    value: float
+    min_total: float
+    categories: FrozenSet[str]  # пусто - на весь каталог
+    per_user_limit: int  # 0 - без ограничений
+    active: bool
+
+
+class PricedCart(NamedTuple):
+    items: List[Dict[str, Any]]  # позиции для заказа: product_id, option_id, name, price, qty, discount
+    subtotal: float
+    discount: float
+    total: float
+    promo: PromoRule | None
+    promo_error: str | None  # почему промокод не применён
+    # (product_id, option_id) позиций, которых по каталогу нет в наличии; решает остаток в stock, если он заведён
+    unavailable: FrozenSet[Tuple[int, str | None]]
+
+
+def compile_promos(raw: List[Dict[str, Any]]) -> Dict[str, PromoRule]:
+    rules = {}
+    for p in raw:
+        code = str(p["code"]).strip().upper()
+        kind = p.get("type", "percent")
+        if kind not in PROMO_KINDS:
+            raise ValueError(f"promo {code}: unknown type {kind}")
+        rules[code] = PromoRule(
+            code=code,
+            kind=kind,
+            value=float(p["value"]),
+            min_total=float(p.get("minTotal", 0)),
+            categories=frozenset(p.get("categories") or ()),
+            per_user_limit=int(p.get("perUserLimit", 0)),
+            active=p.get("active", True) is not False,
+        )
+    return rules
+
+
+def round_total(value: float) -> float:
+    """Округление до гривны половиной вверх - как Math.round в WebApp."""
+    return float(int(value + 0.5)) if value >= 0 else 0.0
+
+
+class PromoTable:
+    """Промокоды из promos.json с перечиткой при изменении файла (по аналогии с Catalog)."""
+
+    def __init__(self, path: str, poll_interval: float = 2.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._table: Tuple[str, Dict[str, PromoRule]] = ("", {})
+        self._stamp: Tuple[int, int] | None = None
+        self._lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+
+    def reload(self, force: bool = False) -> bool:
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                if force:
+                    logger.warning("promos.json not found, promo codes disabled")
+                return False
+            stamp = (st.st_mtime_ns, st.st_size)
+            if not force and stamp == self._stamp:
+                return False
+            try:
+                with open(self.path, "rb") as f:
+                    data = f.read()
+                rules = compile_promos(json.loads(data))
+            except Exception as e:
+                logger.exception("Failed to load promos: %s", e)
+                self._stamp = stamp
+                return False
+            # версия и правила подменяются одним присваиванием: читатель видит согласованную пару
+            self._table = (hashlib.sha1(data).hexdigest()[:12], rules)
+            self._stamp = stamp
+        logger.info("Promos loaded: %s (version %s)", len(rules), self._table[0])
+        return True
+
+    def current(self) -> Tuple[str, Dict[str, PromoRule]]:
+        """(версия, {код: правило})"""
+        return self._table
+
+    def start_watching(self) -> None:
+        if self._watcher:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="promos-watcher", daemon=True)
+        self._watcher.start()
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            self.reload()
+
+
+class PricingEngine:
+    def __init__(self, catalog: Catalog, promos: PromoTable):
+        self.catalog = catalog
+        self.promos = promos
+        # (версия каталога, версия промокодов) -> {код: id товаров в области действия или None - весь каталог}
+        self._scopes: Tuple[Tuple[str, str], Dict[str, FrozenSet[int] | None]] = (("", ""), {})
+
+    def _scope(self, snapshot: CatalogSnapshot, rules: Dict[str, PromoRule], version: str) -> Dict[str, FrozenSet[int] | None]:
+        key = (snapshot.version, version)
+        cached_key, scopes = self._scopes
+        if cached_key == key:
+            return scopes
+        scopes = {
+            code: frozenset(p.id for c in rule.categories for p in snapshot.category(c)) if rule.categories else None
+            for code, rule in rules.items()
+        }
+        self._scopes = (key, scopes)
+        return scopes
+
+    def price_cart(self, items: List[Dict[str, Any]], promo_code: str | None = None,
+                   snapshot: CatalogSnapshot | None = None) -> PricedCart:
+        """
+        items - позиции из WebApp: productId (или id), optionId, qty. Неизвестные товары, qty < 1 и товары
+        с вариантами без известного optionId пропускаются - иначе позиция обошла бы учёт остатков варианта.
+        Скидка распределяется по позициям в области действия промокода, итог округляется до гривны.
+        """
+        snapshot = snapshot or self.catalog.current()
+        version, rules = self.promos.current()
+        code = (promo_code or "").strip().upper()
+        rule = rules.get(code) if code else None
+        promo_error = None
+        if code and (rule is None or not rule.active):
+            rule, promo_error = None, "unknown"
+        scope = self._scope(snapshot, rules, version).get(code) if rule else None
+
+        lines: List[Dict[str, Any]] = []
+        unavailable = set()
+        subtotal = eligible = 0.0
+        for item in items:
+            try:
+                pid = int(item.get("productId") or item.get("id", 0))
+                qty = int(item.get("qty", 1))
+            except (TypeError, ValueError):
+                continue
+            product = snapshot.product(pid)
+            if not product or qty < 1:
+                continue
+            opt = snapshot.option(pid, item.get("optionId"))
+            if product.options and opt is None:
+                continue
+            if not (opt.in_stock if opt else product.in_stock):
+                unavailable.add((pid, opt.id if opt else None))
+            line_total = product.price * qty
+            subtotal += line_total
+            in_scope = rule is not None and (scope is None or pid in scope)
+            if in_scope:
+                eligible += line_total
+            lines.append({
+                "product_id": pid, "option_id": opt.id if opt else None,
+                "name": product.name + (f" ({opt.name})" if opt else ""),
+                "price": product.price, "qty": qty, "discount": 0.0,
+                "_eligible": in_scope,
+            })
+
+        discount = 0.0
+        if rule and subtotal < rule.min_total:
+            rule, promo_error = None, "min_total"
+        elif rule and not eligible:
+            rule, promo_error = None, "not_applicable"
+        elif rule:
+            discount = eligible * rule.value / 100 if rule.kind == "percent" else min(rule.value, eligible)
+
+        if rule:
+            total = round_total(subtotal - discount)
+            discount = round(subtotal - total, 2)
+        else:
+            total = subtotal
+        for line in lines:
+            if line.pop("_eligible") and rule:
+                line["discount"] = round(discount * line["price"] * line["qty"] / eligible, 2)
+        return PricedCart(lines, subtotal, discount, total, rule, promo_error, frozenset(unavailable))
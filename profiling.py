@@ -0,0 +1,249 @@
+"""
+Профилирование бота на живой системе, без перезапуска.
+
+Трассировка: на время обработки обновления поток получает Trace, куда складывается время по участкам -
+разбор данных, расчёт корзины, запросы SQLite (db:<запрос>), синхронные вызовы Bot API (tg:<метод>)
+и постановка в очередь отправки (outbox:<метод>). Обновление дольше порога пишется в лог с разбивкой; упавшее - тоже.
+Сообщения из очереди уходят уже после обработки: если доставка заняла дольше того же порога,
+она пишется в лог отдельно, с update_id обновления, которое её поставило.
+
+Сэмплирующий профайлер (/profile N): раз в interval секунд снимает стеки потоков, которые прямо сейчас
+обрабатывают обновление (sys._current_frames), и через N секунд пишет свёрнутые стеки в файл
+(формат flamegraph.pl / speedscope) и возвращает топ функций. Простаивающие воркеры в выборку не попадают.
+"""
+import html
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# гистограммы metrics.py, которые становятся участками трассировки: имя метрики -> (префикс, метка)
+SPAN_METRICS = {
+    "db_query_seconds": ("db", "query"),
+    "telegram_api_seconds": ("tg", "method"),
+}
+
+
+class Trace:
+    __slots__ = ("update_id", "handler", "started", "spans", "entry", "slow_seconds")
+
+    def __init__(self, update_id: Any, handler: str, entry: Any = None, slow_seconds: float = 0):
+        self.update_id = update_id
+        self.handler = handler
+        self.slow_seconds = slow_seconds
+        # кадр, открывший трассировку: стеки профайлера обрезаются по нему
+        self.entry = entry
+        self.started = time.perf_counter()
+        # участок -> [секунды, вызовы]
+        self.spans: Dict[str, List[float]] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        entry = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def breakdown(self, elapsed: float) -> str:
+        parts = []
+        for name, (seconds, calls) in sorted(self.spans.items(), key=lambda kv: -kv[1][0]):
+            parts.append(f"{name} {seconds * 1000:.1f}ms" + (f" x{calls}" if calls > 1 else ""))
+        rest = elapsed - sum(seconds for seconds, _ in self.spans.values())
+        if rest > 0:
+            parts.append(f"other {rest * 1000:.1f}ms")
+        return ", ".join(parts)
+
+
+_local = threading.local()
+# ident потока -> его текущая трассировка; по нему профайлер выбирает занятые потоки
+_active: Dict[int, Trace] = {}
+
+
+def current() -> Trace | None:
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def trace_update(update_id: Any, handler: str, slow_seconds: float = 0) -> Iterator[Trace]:
+    """Трассировка обработки одного обновления; slow_seconds > 0 - порог записи в лог."""
+    # 0 - этот генератор, 1 - __enter__ из contextlib, 2 - вызывающая функция
+    tr = Trace(update_id, handler, sys._getframe(2), slow_seconds)
+    ident = threading.get_ident()
+    _local.trace = tr
+    _active[ident] = tr
+    try:
+        yield tr
+    except Exception:
+        elapsed = time.perf_counter() - tr.started
+        logger.error("Update %s (%s) failed after %.1fms: %s", update_id, handler, elapsed * 1000, tr.breakdown(elapsed))
+        raise
+    else:
+        elapsed = time.perf_counter() - tr.started
+        if slow_seconds and elapsed >= slow_seconds:
+            logger.warning("Slow update %s (%s): %.1fms: %s", update_id, handler, elapsed * 1000, tr.breakdown(elapsed))
+    finally:
+        _active.pop(ident, None)
+        _local.trace = None
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    tr = current()
+    if tr is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        tr.add(name, time.perf_counter() - started)
+
+
+def observe_metric(metric: str, labels: Dict[str, Any], seconds: float) -> None:
+    tr = current()
+    if tr is None:
+        return
+    mapping = SPAN_METRICS.get(metric)
+    if mapping:
+        prefix, label = mapping
+        tr.add(f"{prefix}:{labels.get(label, '')}", seconds)
+
+
+def sent(tr: Trace | None, method: str, queued: float, started: float, result: Dict[str, Any]) -> None:
+    """
+    Доставка из очереди отправки для обновления tr (queued, started - perf_counter постановки и начала запроса).
+    Трассировка к этому времени уже закрыта, поэтому медленная доставка пишется в лог отдельной строкой.
+    """
+    if tr is None or not tr.slow_seconds:
+        return
+    finished = time.perf_counter()
+    if finished - queued >= tr.slow_seconds:
+        logger.warning("Slow send for update %s (%s): %s %s after %.1fms (queued %.1fms, request %.1fms)",
+                       tr.update_id, tr.handler, method, "ok" if result.get("ok") else result.get("error_code"),
+                       (finished - queued) * 1000, (started - queued) * 1000, (finished - started) * 1000)
+
+
+def install() -> None:
+    """Подключает гистограммы SQLite и Bot API к трассировке."""
+    metrics.add_observer(observe_metric)
+
+
+# === Sampling profiler ===
+class ProfileReport(NamedTuple):
+    seconds: float
+    samples: int  # снимков всего
+    busy: int  # стеков занятых потоков
+    stacks: Counter  # "корень;...;лист" -> число попаданий
+    path: str | None
+
+
+def _frame_name(frame: Any) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame: Any, tr: Trace) -> str:
+    """Стек от кадра, открывшего трассировку, до текущего; первым - метка обработчика."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        if frame is tr.entry:
+            break
+        frame = frame.f_back
+    names.append(tr.handler)
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Один запуск за раз; run() блокирует вызывающий поток на время профилирования."""
+
+    def __init__(self, out_dir: str, interval: float = 0.01):
+        self.out_dir = out_dir
+        self.interval = interval
+        self._running = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._running.locked()
+
+    def run(self, seconds: float) -> ProfileReport | None:
+        """None - профилирование уже идёт."""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            stacks: Counter = Counter()
+            samples = 0
+            own = threading.get_ident()
+            started = time.monotonic()
+            deadline = started + seconds
+            while time.monotonic() < deadline:
+                active = dict(_active)
+                if active:
+                    frames = sys._current_frames()
+                    for ident, tr in active.items():
+                        frame = frames.get(ident)
+                        if frame is not None and ident != own:
+                            stacks[_collapse(frame, tr)] += 1
+                    del frames
+                samples += 1
+                time.sleep(self.interval)
+            report = ProfileReport(time.monotonic() - started, samples, sum(stacks.values()), stacks, None)
+            return report._replace(path=self._dump(report))
+        finally:
+            self._running.release()
+
+    def _dump(self, report: ProfileReport) -> str | None:
+        if not report.stacks:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in report.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def top_functions(stacks: Counter, top: int = 10) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+    """(собственное время - лист стека, полное время - функция где-либо в стеке), в числе попаданий."""
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")[1:]
+        if not frames:
+            continue
+        own[frames[-1]] += count
+        for name in set(frames):
+            total[name] += count
+    return own.most_common(top), total.most_common(top)
+
+
+def format_report(report: ProfileReport, top: int = 10) -> str:
+    """Сводка для админа (HTML)."""
+    if not report.busy:
+        return f"⏱ Профилирование {report.seconds:.0f} с: обновлений за это время не обрабатывалось"
+    own, total = top_functions(report.stacks, top)
+    by_handler: Counter = Counter()
+    for stack, count in report.stacks.items():
+        by_handler[stack.split(";", 1)[0]] += count
+
+    def lines(rows: List[Tuple[str, int]]) -> str:
+        return "\n".join(f"{count * 100 / report.busy:5.1f}% {html.escape(name)}" for name, count in rows)
+
+    handlers = ", ".join(f"{html.escape(name)} {count * 100 / report.busy:.0f}%" for name, count in by_handler.most_common(5))
+    return (
+        f"⏱ <b>Профилирование {report.seconds:.0f} с</b>: {report.busy} стеков из {report.samples} снимков\n"
+        f"Обработчики: {handlers}\n\n"
+        f"<b>Собственное время</b>\n<pre>{lines(own)}</pre>\n"
+        f"<b>С вложенными вызовами</b>\n<pre>{lines(total)}</pre>\n"
+        f"Стеки: <code>{html.escape(report.path or '-')}</code>"
+    )
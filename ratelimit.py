@@ -0,0 +1,64 @@
+"""
+Token bucket и набор бакетов по ключу с вытеснением давно неиспользуемых (LRU).
+Потокобезопасность обеспечивает вызывающий код.
+"""
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float | None = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float | None = None) -> float:
+        """Сколько секунд ждать до следующего токена (0 - токен есть)."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float | None = None) -> float:
+        """Забирает токен и возвращает 0, либо возвращает время ожидания, ничего не забирая."""
+        wait = self.wait_time(now)
+        if wait == 0:
+            self.tokens -= 1
+        return wait
+
+    def give_back(self) -> None:
+        """Возвращает токен, взятый take(), если действие в итоге не состоялось."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class KeyedBuckets:
+    """Бакет на каждый ключ (чат, пользователь); хранится не больше max_keys последних."""
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+
+    def get(self, key: Any, now: float | None = None) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -0,0 +1,132 @@
+"""
+Сверка оплат с LiqPay для заказов, застрявших в payment_status='pending' (например, если
+callback на server_url потерялся).
+Запуск:
+    python reconcile.py --age 30 --workers 16
+    python reconcile.py --dry-run
+
+Статусы запрашиваются параллельно через ограниченный пул потоков (action=status),
+а применяются пакетами в транзакциях тем же условным UPDATE, что и callback'и.
+В bot.py сверка запускается фоновым потоком каждые RECONCILE_INTERVAL секунд.
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import liqpay
+from metrics import RECONCILE_RESULTS
+from storage import PAYMENT_TRANSITIONS, apply_payment_results, get_pending_payments, init_db
+
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "300"))  # 0 - не запускать в боте
+RECONCILE_AGE_MINUTES = float(os.getenv("RECONCILE_AGE_MINUTES", "30"))
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "16"))
+RECONCILE_LIMIT = int(os.getenv("RECONCILE_LIMIT", "5000"))
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "500"))
+
+logger = logging.getLogger(__name__)
+
+# платёж не найден или LiqPay недоступен - заказ остаётся pending до следующего прогона
+SKIP_ERRORS = {"network", "payment_not_found"}
+
+
+def _to_result(order_id: int, response: Dict[str, Any]) -> Tuple[int, str | None, float, str | None, str] | None:
+    status = response.get("status")
+    if response.get("err_code") in SKIP_ERRORS or status not in PAYMENT_TRANSITIONS:
+        return None
+    try:
+        amount = float(response["amount"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    currency = (response.get("currency") or "").upper() or None
+    if currency and currency != "UAH":
+        logger.warning("Reconcile: currency mismatch for order %s: %s", order_id, currency)
+        return None
+    return order_id, status, amount, currency, liqpay.encode_data(response)
+
+
+def reconcile(client: liqpay.LiqPayClient, age_minutes: float = RECONCILE_AGE_MINUTES, workers: int = RECONCILE_WORKERS,
+              limit: int = RECONCILE_LIMIT, batch_size: int = RECONCILE_BATCH_SIZE, dry_run: bool = False) -> Dict[str, Any]:
+    """Один прогон сверки. Возвращает сводку: checked, applied, skipped, по результатам и id оплаченных заказов."""
+    started = time.perf_counter()
+    pending = get_pending_payments(age_minutes, limit)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="reconcile") as pool:
+        responses = list(pool.map(lambda row: client.status(row[0]), pending))
+
+    results = [r for r in (_to_result(oid, resp) for (oid, _), resp in zip(pending, responses)) if r]
+    applied = [] if dry_run else apply_payment_results(results, batch_size)
+
+    by_result: Dict[str, int] = {}
+    for _, result in applied:
+        by_result[result] = by_result.get(result, 0) + 1
+        RECONCILE_RESULTS.inc(result=result)
+    statuses = {r[0]: r[1] for r in results}
+    return {
+        "checked": len(pending),
+        "resolved": len(results),
+        "skipped": len(pending) - len(results),
+        "results": by_result,
+        "paid": [oid for oid, result in applied if result == "applied" and statuses[oid] == "success"],
+        "paid_after_cancel": [oid for oid, result in applied if result == "paid_after_cancel"],
+        "elapsed_s": round(time.perf_counter() - started, 3),
+    }
+
+
+def start_scheduler(client: liqpay.LiqPayClient, interval: float = RECONCILE_INTERVAL,
+                    on_paid: Callable[[List[int]], None] | None = None,
+                    on_paid_after_cancel: Callable[[List[int]], None] | None = None) -> threading.Thread:
+    """
+    Фоновый поток: сверка каждые interval секунд; on_paid получает id заказов, ставших оплаченными,
+    on_paid_after_cancel - id оплаченных, но уже отменённых заказов (резерв снят).
+    """
+    def loop() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                report = reconcile(client)
+                if report["checked"]:
+                    logger.info("Reconcile: %s pending checked, %s in %ss",
+                                report["checked"], report["results"], report["elapsed_s"])
+                if report["paid"] and on_paid:
+                    on_paid(report["paid"])
+                if report["paid_after_cancel"] and on_paid_after_cancel:
+                    on_paid_after_cancel(report["paid_after_cancel"])
+            except Exception as e:
+                logger.error("Reconcile error: %s", e)
+
+    t = threading.Thread(target=loop, name="reconcile", daemon=True)
+    t.start()
+    return t
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Сверка pending-оплат с LiqPay")
+    parser.add_argument("--age", type=float, default=RECONCILE_AGE_MINUTES, help="заказы старше N минут")
+    parser.add_argument("--workers", type=int, default=RECONCILE_WORKERS, help="параллельных запросов к LiqPay")
+    parser.add_argument("--limit", type=int, default=RECONCILE_LIMIT, help="максимум заказов за прогон")
+    parser.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE, help="заказов на транзакцию")
+    parser.add_argument("--dry-run", action="store_true", help="только запросить статусы, без записи в БД")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    client = liqpay.LiqPayClient(
+        os.getenv("LIQPAY_PUBLIC_KEY", "your_public_key"),
+        os.getenv("LIQPAY_PRIVATE_KEY", "your_private_key"),
+        pool_size=args.workers,
+    )
+    init_db()
+    report = reconcile(client, args.age, args.workers, args.limit, args.batch_size, args.dry_run)
+    print(f"Проверено: {report['checked']}, со статусом: {report['resolved']}, пропущено: {report['skipped']}")
+    print("Результаты:", ", ".join(f"{k}={v}" for k, v in sorted(report["results"].items())) or "-")
+    print(f"Оплачено: {len(report['paid'])}, время: {report['elapsed_s']} с")
+    if report["paid_after_cancel"]:
+        print("Оплачены отменённые заказы (резерв снят): " + ", ".join(f"#{oid}" for oid in report["paid_after_cancel"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
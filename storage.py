@@ -0,0 +1,1539 @@
+﻿"""
+Общий слой хранения заказов (SQLite) для bot.py и payment_handler.py.
+
+Соединения живут по одному на поток и переиспользуются, база работает в режиме WAL:
+чтения не блокируются записью, а callback'и LiqPay и новые заказы не дерутся за файл.
+Старые завершённые и отменённые заказы переносятся в архивную базу (ATTACH ... AS archive),
+get_order и выгрузка читают её прозрачно.
+"""
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import logging
+import calendar
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Collection, Generator, Iterator, List, NamedTuple, Tuple
+
+from metrics import DB_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "shop.db"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+# Архив заказов: по умолчанию рядом с основной базой (shop.db -> shop-archive.db)
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "")
+# Сколько освободившихся страниц возвращать файлу за один шаг incremental_vacuum
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "1000"))
+
+ORDER_COLUMNS = [
+    'id', 'user_id', 'user_name', 'items_json', 'total_price',
+    'contact_json', 'status', 'payment_status', 'created_at', 'promo_code', 'discount'
+]
+ORDER_SELECT = ", ".join(ORDER_COLUMNS)
+ORDER_SUMMARY_COLUMNS = ['id', 'total_price', 'status', 'user_name', 'created_at']
+ORDER_SUMMARY_SELECT = ", ".join(ORDER_SUMMARY_COLUMNS)
+
+_local = threading.local()
+
+
+# === Connections ===
+def _connect(path: str) -> sqlite3.Connection:
+    # isolation_level=None: без неявных транзакций, запись только через transaction()
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def archive_path() -> str:
+    return ARCHIVE_DB_PATH or os.path.splitext(DB_PATH)[0] + "-archive.db"
+
+
+def get_conn() -> sqlite3.Connection:
+    """Соединение текущего потока (создаётся при первом обращении) с подключённым архивом."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = _connect(DB_PATH)
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path(),))
+        conn.execute("PRAGMA archive.journal_mode=WAL")
+        _local.conn, _local.path = conn, DB_PATH
+    return conn
+
+
+def connect_readonly() -> sqlite3.Connection:
+    """Отдельное соединение только для чтения (выгрузки и отчёты): в WAL не мешает записи бота."""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    if os.path.exists(archive_path()):
+        conn.execute("ATTACH DATABASE ? AS archive", (f"file:{archive_path()}?mode=ro",))
+    return conn
+
+
+def has_archive(conn: sqlite3.Connection) -> bool:
+    if not any(row[1] == "archive" for row in conn.execute("PRAGMA database_list")):
+        return False
+    return conn.execute("SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'orders'").fetchone() is not None
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """BEGIN IMMEDIATE ... COMMIT: блокировка записи берётся сразу, без апгрейда посреди транзакции."""
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+# === Schema ===
+# Миграции применяются по порядку, номер последней хранится в PRAGMA user_version.
+# Уже выпущенные миграции не меняются - только добавляются новые в конец списка.
+def _m1_orders(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_name TEXT,
+            items_json TEXT,
+            total_price REAL,
+            contact_json TEXT,
+            status TEXT DEFAULT 'new',
+            payment_status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    # старые базы создавались без payment_status
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)")}
+    if "payment_status" not in columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN payment_status TEXT DEFAULT 'pending'")
+
+
+def _m2_order_items(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE order_items (
+            id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL REFERENCES orders(id),
+            product_id INTEGER,
+            option_id TEXT,
+            name TEXT,
+            qty INTEGER NOT NULL,
+            unit_price REAL NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX idx_order_items_order ON order_items(order_id)")
+    conn.execute("CREATE INDEX idx_order_items_product ON order_items(product_id, option_id)")
+    conn.execute("CREATE INDEX idx_orders_status_created ON orders(status, created_at)")
+    conn.execute("CREATE INDEX idx_orders_created ON orders(created_at)")
+    conn.execute("CREATE INDEX idx_orders_user ON orders(user_id)")
+    conn.execute("CREATE INDEX idx_orders_payment_status ON orders(payment_status)")
+    # перенос позиций из items_json уже существующих заказов
+    conn.execute(
+        """
+        INSERT INTO order_items (order_id, product_id, option_id, name, qty, unit_price)
+        SELECT o.id,
+               json_extract(j.value, '$.product_id'),
+               json_extract(j.value, '$.option_id'),
+               json_extract(j.value, '$.name'),
+               COALESCE(json_extract(j.value, '$.qty'), 1),
+               COALESCE(json_extract(j.value, '$.price'), 0)
+        FROM orders o, json_each(o.items_json) j
+        WHERE json_valid(o.items_json)
+        ORDER BY o.id
+        """
+    )
+
+
+_ORDER_CONTRIB = """
+    {sign} 1,
+    {sign} COALESCE({row}.total_price, 0) * (COALESCE({row}.status, 'new') != 'cancelled'),
+    {sign} COALESCE({row}.total_price, 0) * (COALESCE({row}.status, 'new') != 'cancelled')
+           * (COALESCE({row}.payment_status, 'pending') = 'paid')
+"""
+
+
+def _bucket_upsert(table: str, key_expr: str, row: str, sign: str) -> str:
+    return f"""
+        INSERT INTO {table} (bucket, orders, revenue, paid_revenue)
+        VALUES ({key_expr.format(row=row)}, {_ORDER_CONTRIB.format(row=row, sign=sign)})
+        ON CONFLICT(bucket) DO UPDATE SET
+            orders = orders + excluded.orders,
+            revenue = revenue + excluded.revenue,
+            paid_revenue = paid_revenue + excluded.paid_revenue;
+    """
+
+
+def _stats_upsert(row: str, sign: str) -> str:
+    return f"""
+        INSERT INTO order_stats (status, payment_status, orders, revenue)
+        VALUES (COALESCE({row}.status, 'new'), COALESCE({row}.payment_status, 'pending'),
+                {sign} 1, {sign} COALESCE({row}.total_price, 0))
+        ON CONFLICT(status, payment_status) DO UPDATE SET
+            orders = orders + excluded.orders,
+            revenue = revenue + excluded.revenue;
+    """
+
+
+_HOUR = "strftime('%Y-%m-%d %H:00', {row}.created_at)"
+_DAY = "date({row}.created_at)"
+
+_SALES_AGGREGATES_SQL = [
+    """
+    CREATE TABLE order_stats (
+        status TEXT NOT NULL,
+        payment_status TEXT NOT NULL,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (status, payment_status)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE revenue_hourly (
+        bucket TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        paid_revenue REAL NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE revenue_daily (
+        bucket TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        paid_revenue REAL NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE product_sales (
+        product_id INTEGER PRIMARY KEY,
+        name TEXT,
+        qty INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0
+    )
+    """,
+    f"""
+    CREATE TRIGGER trg_orders_stats_insert AFTER INSERT ON orders
+    BEGIN
+        {_stats_upsert("NEW", "+")}
+        {_bucket_upsert("revenue_hourly", _HOUR, "NEW", "+")}
+        {_bucket_upsert("revenue_daily", _DAY, "NEW", "+")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER trg_orders_stats_update AFTER UPDATE OF status, payment_status, total_price ON orders
+    BEGIN
+        {_stats_upsert("OLD", "-")}
+        {_stats_upsert("NEW", "+")}
+        {_bucket_upsert("revenue_hourly", _HOUR, "OLD", "-")}
+        {_bucket_upsert("revenue_hourly", _HOUR, "NEW", "+")}
+        {_bucket_upsert("revenue_daily", _DAY, "OLD", "-")}
+        {_bucket_upsert("revenue_daily", _DAY, "NEW", "+")}
+    END
+    """,
+    """
+    CREATE TRIGGER trg_order_items_sales AFTER INSERT ON order_items
+    WHEN NEW.product_id IS NOT NULL
+     AND (SELECT COALESCE(status, 'new') FROM orders WHERE id = NEW.order_id) != 'cancelled'
+    BEGIN
+        INSERT INTO product_sales (product_id, name, qty, revenue)
+        VALUES (NEW.product_id, NEW.name, NEW.qty, NEW.qty * NEW.unit_price)
+        ON CONFLICT(product_id) DO UPDATE SET
+            qty = qty + excluded.qty,
+            revenue = revenue + excluded.revenue;
+    END
+    """,
+    """
+    CREATE TRIGGER trg_orders_sales_cancel AFTER UPDATE OF status ON orders
+    WHEN (COALESCE(OLD.status, 'new') = 'cancelled') != (COALESCE(NEW.status, 'new') = 'cancelled')
+    BEGIN
+        INSERT INTO product_sales (product_id, name, qty, revenue)
+        SELECT i.product_id, MAX(i.name),
+               (CASE WHEN NEW.status = 'cancelled' THEN -1 ELSE 1 END) * SUM(i.qty),
+               (CASE WHEN NEW.status = 'cancelled' THEN -1 ELSE 1 END) * SUM(i.qty * i.unit_price)
+        FROM order_items i
+        WHERE i.order_id = NEW.id AND i.product_id IS NOT NULL
+        GROUP BY i.product_id
+        ON CONFLICT(product_id) DO UPDATE SET
+            qty = qty + excluded.qty,
+            revenue = revenue + excluded.revenue;
+    END
+    """,
+    # заполнение по уже существующим заказам
+    """
+    INSERT INTO order_stats (status, payment_status, orders, revenue)
+    SELECT COALESCE(status, 'new'), COALESCE(payment_status, 'pending'), COUNT(*), COALESCE(SUM(total_price), 0)
+    FROM orders GROUP BY 1, 2
+    """,
+    *[
+        f"""
+        INSERT INTO {table} (bucket, orders, revenue, paid_revenue)
+        SELECT {key.format(row="orders")}, COUNT(*),
+               COALESCE(SUM(total_price * (COALESCE(status, 'new') != 'cancelled')), 0),
+               COALESCE(SUM(total_price * (COALESCE(status, 'new') != 'cancelled')
+                                        * (COALESCE(payment_status, 'pending') = 'paid')), 0)
+        FROM orders GROUP BY 1
+        """
+        for table, key in (("revenue_hourly", _HOUR), ("revenue_daily", _DAY))
+    ],
+    """
+    INSERT INTO product_sales (product_id, name, qty, revenue)
+    SELECT i.product_id, MAX(i.name), SUM(i.qty), SUM(i.qty * i.unit_price)
+    FROM order_items i JOIN orders o ON o.id = i.order_id
+    WHERE i.product_id IS NOT NULL AND COALESCE(o.status, 'new') != 'cancelled'
+    GROUP BY i.product_id
+    """,
+]
+
+
+def _m3_sales_aggregates(conn: sqlite3.Connection) -> None:
+    # Агрегаты для "Статистики" поддерживаются триггерами при вставке и смене статуса заказа.
+    # Заказы из orders не удаляются (кроме переноса в архив), поэтому DELETE-триггеров нет:
+    # счётчики считаются за всё время.
+    for sql in _SALES_AGGREGATES_SQL:
+        conn.execute(sql)
+
+
+def _m4_payment_events(conn: sqlite3.Connection) -> None:
+    # Каждый callback LiqPay сохраняется как есть (data + signature) - для аудита и повторной обработки.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            status TEXT,
+            amount REAL,
+            currency TEXT,
+            result TEXT NOT NULL,
+            data TEXT NOT NULL,
+            signature TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_payment_events_order ON payment_events(order_id, id)')
+
+
+def _m5_pending_payments_index(conn: sqlite3.Connection) -> None:
+    # сверка с LiqPay ищет pending-заказы старше N минут: диапазон по индексу вместо фильтра по created_at
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_payment_created ON orders(payment_status, created_at)')
+    conn.execute('DROP INDEX IF EXISTS idx_orders_payment_status')
+
+
+def _m6_update_journal(conn: sqlite3.Connection) -> None:
+    # Журнал входящих обновлений Telegram: записывается до подтверждения offset, помечается после обработки.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS update_journal (
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            done_at TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_update_journal_pending ON update_journal(update_id) WHERE state = 'pending'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_update_journal_done ON update_journal(done_at) WHERE state != 'pending'")
+    # заказ из повторно обработанного обновления не создаётся второй раз
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(orders)")]
+    if 'source_update_id' not in columns:
+        conn.execute('ALTER TABLE orders ADD COLUMN source_update_id INTEGER')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_source_update ON orders(source_update_id)')
+
+
+def _m7_promo_usage(conn: sqlite3.Connection) -> None:
+    # промокод и скидка заказа + счётчик использований промокода покупателем для лимитов
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(orders)")]
+    if 'promo_code' not in columns:
+        conn.execute('ALTER TABLE orders ADD COLUMN promo_code TEXT')
+    if 'discount' not in columns:
+        conn.execute('ALTER TABLE orders ADD COLUMN discount REAL NOT NULL DEFAULT 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS promo_usage (
+            code TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            uses INTEGER NOT NULL,
+            PRIMARY KEY (code, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _m8_inventory(conn: sqlite3.Connection) -> None:
+    # Остатки по (товар, вариант); option_id = '' у товаров без вариантов. Товары без строки в stock не учитываются.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock (
+            product_id INTEGER NOT NULL,
+            option_id TEXT NOT NULL DEFAULT '',
+            qty INTEGER NOT NULL CHECK (qty >= 0),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (product_id, option_id)
+        ) WITHOUT ROWID
+    ''')
+    # Списанное под заказ: возвращается на склад при отмене или истечении резерва неоплаченного заказа
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            option_id TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            expires_at TIMESTAMP,
+            PRIMARY KEY (order_id, product_id, option_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_stock_reservations_expires ON stock_reservations(expires_at) '
+        'WHERE expires_at IS NOT NULL'
+    )
+    # Версия наличия для бандла каталога: растёт, только когда товар появляется или заканчивается
+    conn.execute('CREATE TABLE IF NOT EXISTS stock_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO stock_version (id, version) VALUES (1, 0)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stock_version_insert AFTER INSERT ON stock
+        BEGIN UPDATE stock_version SET version = version + 1; END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stock_version_delete AFTER DELETE ON stock
+        BEGIN UPDATE stock_version SET version = version + 1; END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stock_version_update AFTER UPDATE OF qty ON stock
+        WHEN (old.qty > 0) != (new.qty > 0)
+        BEGIN UPDATE stock_version SET version = version + 1; END
+    ''')
+
+
+# Поиск заказов (/find): имя, телефон, адрес, комментарий из contact_json, user_name и названия позиций.
+# Телефон индексируется как есть и цифрами: полностью и последние 10/9 цифр - "+38 (067) 123-45-67",
+# "0671234567" и "671234567" находят один заказ. rowid индекса = orders.id.
+_DIGITS = "replace(replace(replace(replace(replace(replace({}, '+', ''), '(', ''), ')', ''), '-', ''), ' ', ''), '.', '')"
+_FTS_PHONE = "json_extract({row}.contact_json, '$.phone')"
+_FTS_ROW = f"""
+    {{row}}.id,
+    json_extract({{row}}.contact_json, '$.name'),
+    {_FTS_PHONE} || ' ' || {_DIGITS.format(_FTS_PHONE)} || ' ' || substr({_DIGITS.format(_FTS_PHONE)}, -10)
+        || ' ' || substr({_DIGITS.format(_FTS_PHONE)}, -9),
+    json_extract({{row}}.contact_json, '$.address'),
+    json_extract({{row}}.contact_json, '$.comment'),
+    {{row}}.user_name,
+    (SELECT group_concat(json_extract(j.value, '$.name'), ' ') FROM json_each({{row}}.items_json) j)
+"""
+_FTS_COLUMNS = "rowid, name, phone, address, comment, user_name, items"
+
+
+def _m9_orders_fts(conn: sqlite3.Connection) -> None:
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+            name, phone, address, comment, user_name, items,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    ''')
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_fts_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO orders_fts ({_FTS_COLUMNS}) SELECT {_FTS_ROW.format(row='new')};
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_fts_update AFTER UPDATE OF contact_json, items_json, user_name ON orders
+        BEGIN
+            DELETE FROM orders_fts WHERE rowid = old.id;
+            INSERT INTO orders_fts ({_FTS_COLUMNS}) SELECT {_FTS_ROW.format(row='new')};
+        END
+    """)
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_orders_fts_delete AFTER DELETE ON orders
+        BEGIN
+            DELETE FROM orders_fts WHERE rowid = old.id;
+        END
+    ''')
+    conn.execute(f"INSERT INTO orders_fts ({_FTS_COLUMNS}) SELECT {_FTS_ROW.format(row='o')} FROM orders o "
+                 "WHERE json_valid(o.contact_json) AND json_valid(o.items_json)")
+
+
+def _m10_broadcasts(conn: sqlite3.Connection) -> None:
+    # Рассылка: задание и получатели с состоянием, чтобы после перезапуска продолжить с того же места.
+    # draft -> running -> done; cancelled - остановлена админом
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL DEFAULT 'draft',
+            text TEXT NOT NULL,
+            category TEXT,
+            created_by INTEGER,
+            chat_id INTEGER,
+            message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    # pending -> sending (передано в очередь отправки) -> sent | blocked (403) | failed;
+    # unknown - была в отправке при остановке бота: повторно не шлётся, чтобы не было дублей
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_state ON broadcast_recipients(job_id, state)')
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_blocked ON broadcast_recipients(user_id, updated_at) "
+        "WHERE state = 'blocked'"
+    )
+
+
+MIGRATIONS = [
+    (1, _m1_orders),
+    (2, _m2_order_items),
+    (3, _m3_sales_aggregates),
+    (4, _m4_payment_events),
+    (5, _m5_pending_payments_index),
+    (6, _m6_update_journal),
+    (7, _m7_promo_usage),
+    (8, _m8_inventory),
+    (9, _m9_orders_fts),
+    (10, _m10_broadcasts),
+]
+
+
+def migrate() -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции. Возвращает версию схемы."""
+    conn = get_conn()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        with transaction() as conn:
+            # другой процесс мог успеть применить миграцию, пока мы ждали блокировку
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+        version = target
+    return version
+
+
+def incremental_vacuum_enabled() -> bool:
+    return get_conn().execute("PRAGMA main.auto_vacuum").fetchone()[0] == 2
+
+
+def enable_incremental_vacuum() -> bool:
+    """
+    auto_vacuum=INCREMENTAL: страницы, освободившиеся после переноса в архив, возвращаются файлу
+    короткими шагами (incremental_vacuum) вместо VACUUM под долгой эксклюзивной блокировкой.
+    Существующую базу режим требует перестроить один раз полным VACUUM - он держит эксклюзивную блокировку
+    всё время перестройки, поэтому запускается вручную (python storage.py --enable-incremental-vacuum),
+    лучше при остановленном боте. False - режим уже был включён.
+    """
+    if incremental_vacuum_enabled():
+        return False
+    conn = get_conn()
+    conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM main")
+    return True
+
+
+# Архив повторяет столбцы горячих таблиц. Новые столбцы orders/order_items/payment_events
+# нужно добавлять и сюда (ALTER TABLE archive....), иначе перенос упадёт.
+ARCHIVE_ORDER_COLUMNS = ORDER_COLUMNS + ['source_update_id']
+ARCHIVE_ITEM_COLUMNS = ['id', 'order_id', 'product_id', 'option_id', 'name', 'qty', 'unit_price']
+ARCHIVE_EVENT_COLUMNS = ['id', 'order_id', 'status', 'amount', 'currency', 'result', 'data', 'signature', 'received_at']
+
+
+def init_archive() -> None:
+    with transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.orders (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                user_name TEXT,
+                items_json TEXT,
+                total_price REAL,
+                contact_json TEXT,
+                status TEXT,
+                payment_status TEXT,
+                created_at TIMESTAMP,
+                promo_code TEXT,
+                discount REAL NOT NULL DEFAULT 0,
+                source_update_id INTEGER,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_orders_created ON orders(created_at)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.order_items (
+                id INTEGER PRIMARY KEY,
+                order_id INTEGER NOT NULL,
+                product_id INTEGER,
+                option_id TEXT,
+                name TEXT,
+                qty INTEGER NOT NULL,
+                unit_price REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_items_order ON order_items(order_id)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.payment_events (
+                id INTEGER PRIMARY KEY,
+                order_id INTEGER,
+                status TEXT,
+                amount REAL,
+                currency TEXT,
+                result TEXT NOT NULL,
+                data TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                received_at TIMESTAMP
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_events_order ON payment_events(order_id, id)')
+
+
+def init_db() -> None:
+    conn = get_conn()
+    if not conn.execute("SELECT 1 FROM main.sqlite_master LIMIT 1").fetchone():
+        # новая пустая база: VACUUM перестраивать нечего, он мгновенный
+        enable_incremental_vacuum()
+    elif not incremental_vacuum_enabled():
+        logger.warning("auto_vacuum is not INCREMENTAL: archived pages stay in %s until "
+                       "'python storage.py --enable-incremental-vacuum' is run", DB_PATH)
+    migrate()
+    init_archive()
+
+
+# === Orders ===
+class OrderSummary(NamedTuple):
+    """Строка списка заказов в админке: только столбцы ORDER_SUMMARY_COLUMNS, без JSON."""
+    id: int
+    total_price: float
+    status: str
+    user_name: str
+    created_at: str
+
+
+class OrderRecord:
+    """
+    Заказ целиком (столбцы ORDER_COLUMNS). items и contact разбираются из JSON при первом обращении:
+    списки, которым нужны только статус или user_id, json.loads не вызывают.
+    """
+    __slots__ = tuple(ORDER_COLUMNS) + ('_items', '_contact')
+
+    def __init__(self, row: tuple):
+        # порядок - как в ORDER_COLUMNS / ORDER_SELECT
+        (self.id, self.user_id, self.user_name, self.items_json, self.total_price, self.contact_json,
+         self.status, self.payment_status, self.created_at, self.promo_code, self.discount) = row
+        self._items: List[Dict[str, Any]] | None = None
+        self._contact: Dict[str, Any] | None = None
+
+    @property
+    def items(self) -> List[Dict[str, Any]]:
+        if self._items is None:
+            self._items = json.loads(self.items_json)
+        return self._items
+
+    @property
+    def contact(self) -> Dict[str, Any]:
+        if self._contact is None:
+            self._contact = json.loads(self.contact_json) or {}
+        return self._contact
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Поля заказа с разобранными items и contact вместо исходного JSON."""
+        order = {name: getattr(self, name) for name in ORDER_COLUMNS if not name.endswith('_json')}
+        order['items'] = self.items
+        order['contact'] = self.contact
+        return order
+
+    def __repr__(self) -> str:
+        return f"OrderRecord(id={self.id}, status={self.status!r}, total_price={self.total_price})"
+
+
+class PromoLimitExceeded(Exception):
+    """Покупатель уже использовал промокод максимально разрешённое число раз."""
+
+
+class OutOfStock(Exception):
+    """Не хватает остатка. items - [(product_id, option_id или None, сколько осталось), ...]"""
+
+    def __init__(self, items: List[Tuple[int, str | None, int]]):
+        super().__init__(items)
+        self.items = items
+
+
+def _reserve_stock(conn: sqlite3.Connection, order_id: int, items: List[Dict[str, Any]],
+                   reservation_minutes: float, unavailable: Collection[Tuple[int, str | None]] = ()) -> None:
+    # без строки в stock позиция не учитывается, но и продать отсутствующее по каталогу нельзя
+    unavailable_keys = {(int(pid), str(opt or '')) for pid, opt in unavailable}
+    wanted: Dict[Tuple[int, str], int] = {}
+    for i in items:
+        if i.get('product_id') is None:
+            continue
+        key = (int(i['product_id']), str(i.get('option_id') or ''))
+        wanted[key] = wanted.get(key, 0) + int(i['qty'])
+    reserved, short = [], []
+    for (product_id, option_id), qty in wanted.items():
+        # условный UPDATE: остаток не уходит в минус даже при одновременных заказах
+        if conn.execute(
+            '''
+            UPDATE stock SET qty = qty - ?, updated_at = CURRENT_TIMESTAMP
+            WHERE product_id = ? AND option_id = ? AND qty >= ?
+            ''',
+            (qty, product_id, option_id, qty),
+        ).rowcount:
+            reserved.append((order_id, product_id, option_id, qty))
+            continue
+        row = conn.execute(
+            'SELECT qty FROM stock WHERE product_id = ? AND option_id = ?', (product_id, option_id)
+        ).fetchone()
+        if row is not None:
+            short.append((product_id, option_id or None, row[0]))
+        elif (product_id, option_id) in unavailable_keys:
+            short.append((product_id, option_id or None, 0))
+    if short:
+        raise OutOfStock(short)
+    expires = f'+{float(reservation_minutes)} minutes' if reservation_minutes > 0 else None
+    conn.executemany(
+        '''
+        INSERT INTO stock_reservations (order_id, product_id, option_id, qty, expires_at)
+        VALUES (?, ?, ?, ?, datetime('now', ?))
+        ''',
+        [(*r, expires) for r in reserved],
+    )
+
+
+def _release_stock(conn: sqlite3.Connection, order_ids: List[int]) -> None:
+    marks = ", ".join("?" * len(order_ids))
+    conn.execute(
+        f'''
+        UPDATE stock SET qty = stock.qty + r.qty, updated_at = CURRENT_TIMESTAMP
+        FROM (SELECT product_id, option_id, SUM(qty) AS qty FROM stock_reservations
+              WHERE order_id IN ({marks}) GROUP BY product_id, option_id) AS r
+        WHERE stock.product_id = r.product_id AND stock.option_id = r.option_id
+        ''',
+        order_ids,
+    )
+    conn.execute(f'DELETE FROM stock_reservations WHERE order_id IN ({marks})', order_ids)
+
+
+@DB_QUERY_SECONDS.timed(query="save_order_to_db")
+def save_order_to_db(user_id: int, user_name: str, items: List[Dict[str, Any]], total_price: float, contact: Dict[str, Any],
+                     source_update_id: int | None = None, promo_code: str | None = None, discount: float = 0,
+                     promo_limit: int = 0, reservation_minutes: float = 0,
+                     unavailable: Collection[Tuple[int, str | None]] = ()) -> int:
+    """
+    Сохраняет заказ с позициями. source_update_id - update_id Telegram, из которого пришёл заказ:
+    при повторной обработке того же обновления (replay журнала) возвращается id уже созданного заказа.
+    promo_limit > 0 - сколько раз покупатель может использовать promo_code; счётчик увеличивается в той же
+    транзакции условным upsert, при превышении - PromoLimitExceeded и заказ не сохраняется.
+    Остатки учитываемых товаров (есть строка в stock) списываются там же; если чего-то не хватает -
+    OutOfStock. unavailable - (product_id, option_id), которых нет в наличии по каталогу: без строки в stock
+    они тоже дают OutOfStock. reservation_minutes > 0 - резерв снимается (expire_reservations), если заказ не оплачен за это время.
+    """
+    with transaction() as conn:
+        c = conn.execute(
+            """
+            INSERT INTO orders (user_id, user_name, items_json, total_price, contact_json, source_update_id,
+                                promo_code, discount)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source_update_id) DO NOTHING
+            """,
+            (
+                user_id,
+                user_name,
+                json.dumps(items, ensure_ascii=False),
+                total_price,
+                json.dumps(contact, ensure_ascii=False),
+                source_update_id,
+                promo_code,
+                discount,
+            ),
+        )
+        if not c.rowcount:
+            return conn.execute('SELECT id FROM orders WHERE source_update_id = ?', (source_update_id,)).fetchone()[0]
+        order_id = c.lastrowid
+        if promo_code:
+            counted = conn.execute(
+                """
+                INSERT INTO promo_usage (code, user_id, uses) VALUES (?, ?, 1)
+                ON CONFLICT (code, user_id) DO UPDATE SET uses = uses + 1 WHERE ? = 0 OR uses < ?
+                """,
+                (promo_code, user_id, promo_limit, promo_limit),
+            ).rowcount
+            if not counted:
+                raise PromoLimitExceeded(promo_code)
+        conn.executemany(
+            """
+            INSERT INTO order_items (order_id, product_id, option_id, name, qty, unit_price)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (order_id, i.get('product_id'), i.get('option_id'), i['name'], i['qty'], i['price'])
+                for i in items
+            ],
+        )
+        _reserve_stock(conn, order_id, items, reservation_minutes, unavailable)
+        return order_id
+
+
+@DB_QUERY_SECONDS.timed(query="get_orders")
+def get_orders(status: str | None = None, limit: int = 50) -> List[OrderSummary]:
+    conn = get_conn()
+    if status:
+        rows = conn.execute(f'SELECT {ORDER_SUMMARY_SELECT} FROM orders WHERE status = ? ORDER BY created_at DESC LIMIT ?', (status, limit)).fetchall()
+    else:
+        rows = conn.execute(f'SELECT {ORDER_SUMMARY_SELECT} FROM orders ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+    return list(map(OrderSummary._make, rows))
+
+
+def iter_orders(conn: sqlite3.Connection, since: str | None = None, until: str | None = None,
+                status: str | None = None, payment_status: str | None = None,
+                batch_size: int = 1000) -> Generator[OrderRecord, None, None]:
+    """
+    Потоковое чтение заказов по возрастанию created_at: курсор выбирается пачками по batch_size,
+    JSON разбирается построчно при обращении, в памяти одновременно не больше одной пачки.
+    Если к соединению подключён архив, заказы читаются из обеих баз.
+    """
+    where, params = [], []
+    if since:
+        where.append('created_at >= ?')
+        params.append(since)
+    if until:
+        where.append('created_at < ?')
+        params.append(until)
+    if status:
+        where.append('status = ?')
+        params.append(status)
+    if payment_status:
+        where.append('payment_status = ?')
+        params.append(payment_status)
+    source = 'main.orders'
+    if has_archive(conn):
+        # заказ, оставшийся в обеих базах после прерванного переноса, берётся из горячей
+        source = (
+            f'(SELECT {ORDER_SELECT} FROM main.orders UNION ALL '
+            f'SELECT {ORDER_SELECT} FROM archive.orders WHERE id NOT IN (SELECT id FROM main.orders))'
+        )
+    sql = (
+        f'SELECT {ORDER_SELECT} FROM {source}'
+        + (f' WHERE {" AND ".join(where)}' if where else '')
+        + ' ORDER BY created_at, id'
+    )
+    cur = conn.execute(sql, params)
+    try:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from map(OrderRecord, rows)
+    finally:
+        cur.close()
+
+
+# Курсор страницы - ключ сортировки (created_at, id) граничного заказа
+Cursor = Tuple[str, int]
+
+
+def encode_cursor(cursor: Cursor) -> str:
+    """Компактная форма курсора для callback_data: <unix time>_<id>."""
+    created_at, order_id = cursor
+    ts = calendar.timegm(time.strptime(created_at[:19], "%Y-%m-%d %H:%M:%S"))
+    return f"{ts}_{order_id}"
+
+
+def decode_cursor(value: str) -> Cursor:
+    ts, order_id = value.split("_")
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(int(ts))), int(order_id)
+
+
+@DB_QUERY_SECONDS.timed(query="get_orders_page")
+def get_orders_page(status: str | None = None, cursor: Cursor | None = None, direction: str = "next",
+                    limit: int = 5, full: bool = False
+                    ) -> Tuple[List[OrderSummary] | List[OrderRecord], Cursor | None, Cursor | None]:
+    """
+    Страница заказов от новых к старым по ключу (created_at, id) - один диапазонный запрос по индексу.
+    direction="next" - заказы старше курсора, "prev" - новее. Возвращает (заказы, курсор_новее, курсор_старше);
+    курсор равен None, если в эту сторону листать некуда. full=True - OrderRecord с позициями и контактами,
+    иначе OrderSummary.
+    """
+    where, params = [], []
+    if status:
+        where.append('status = ?')
+        params.append(status)
+    older = direction != "prev"
+    if cursor:
+        where.append('(created_at, id) < (?, ?)' if older else '(created_at, id) > (?, ?)')
+        params.extend(cursor)
+    order = 'DESC' if older else 'ASC'
+    sql = (
+        f'SELECT {ORDER_SELECT if full else ORDER_SUMMARY_SELECT} FROM orders'
+        + (f' WHERE {" AND ".join(where)}' if where else '')
+        + f' ORDER BY created_at {order}, id {order} LIMIT ?'
+    )
+    rows = get_conn().execute(sql, (*params, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not older:
+        rows.reverse()
+    orders = list(map(OrderRecord if full else OrderSummary._make, rows))
+    if not orders:
+        return orders, None, None
+
+    first = (orders[0].created_at, orders[0].id)
+    last = (orders[-1].created_at, orders[-1].id)
+    has_newer = has_more if not older else cursor is not None
+    has_older = has_more if older else True
+    return orders, first if has_newer else None, last if has_older else None
+
+
+@DB_QUERY_SECONDS.timed(query="count_orders")
+def count_orders(status: str) -> int:
+    """Число заказов в статусе - из агрегата order_stats, без прохода по orders."""
+    row = get_conn().execute('SELECT COALESCE(SUM(orders), 0) FROM order_stats WHERE status = ?', (status,)).fetchone()
+    return row[0]
+
+
+# === Search ===
+# веса bm25 по столбцам orders_fts: name, phone, address, comment, user_name, items
+SEARCH_WEIGHTS = (10.0, 10.0, 4.0, 1.0, 5.0, 2.0)
+# границы подсвеченного фрагмента в snippet: заменяются на теги после html-экранирования
+SNIPPET_OPEN, SNIPPET_CLOSE = "\x02", "\x03"
+_PHONE_PUNCT = str.maketrans("", "", "+()-. ")
+_WORD = re.compile(r"\w+")
+
+
+class OrderSearchHit(NamedTuple):
+    id: int
+    total_price: float
+    status: str
+    payment_status: str
+    created_at: str
+    user_name: str
+    name: str | None
+    phone: str | None
+    snippet: str | None  # фрагмент с совпадением, границы - SNIPPET_OPEN/SNIPPET_CLOSE
+
+
+def build_search_query(text: str) -> str | None:
+    """
+    Строка админа -> выражение FTS5 MATCH. Номер телефона (цифры с + ( ) - . и пробелами) ищется префиксом
+    по столбцу phone, иначе - все слова префиксами по всем столбцам. Кавычки и операторы FTS5 из ввода не проходят.
+    """
+    digits = text.translate(_PHONE_PUNCT)
+    if digits.isdigit() and len(digits) >= 4:
+        # полный номер в любом формате (+380..., 0...) сводится к последним 9 цифрам - они есть в индексе отдельно
+        return f'phone : "{digits[-9:]}"*'
+    words = _WORD.findall(text)
+    if not words:
+        return None
+    return " ".join(f'"{w}"*' for w in words[:8])
+
+
+@DB_QUERY_SECONDS.timed(query="search_orders")
+def search_orders(text: str, limit: int = 5, offset: int = 0) -> Tuple[List[OrderSearchHit], bool]:
+    """Заказы по релевантности (bm25), при равенстве - новые выше. Возвращает (заказы, есть ли ещё)."""
+    match = build_search_query(text)
+    if not match:
+        return [], False
+    # при поиске по телефону фрагмент не нужен: номер и так в выдаче
+    snippet = "NULL" if match.startswith("phone") else "snippet(orders_fts, -1, ?, ?, '…', 10)"
+    params = () if match.startswith("phone") else (SNIPPET_OPEN, SNIPPET_CLOSE)
+    rows = get_conn().execute(
+        f'''
+        SELECT o.id, o.total_price, o.status, o.payment_status, o.created_at, o.user_name,
+               json_extract(o.contact_json, '$.name'), json_extract(o.contact_json, '$.phone'),
+               {snippet}
+        FROM orders_fts JOIN orders o ON o.id = orders_fts.rowid
+        WHERE orders_fts MATCH ?
+        ORDER BY bm25(orders_fts, {", ".join(map(str, SEARCH_WEIGHTS))}), o.id DESC
+        LIMIT ? OFFSET ?
+        ''',
+        (*params, match, limit + 1, offset),
+    ).fetchall()
+    return list(map(OrderSearchHit._make, rows[:limit])), len(rows) > limit
+
+
+@DB_QUERY_SECONDS.timed(query="get_order")
+def get_order(order_id: int) -> OrderRecord | None:
+    """Сначала горячая база, затем архив - для старых id."""
+    conn = get_conn()
+    row = conn.execute(f'SELECT {ORDER_SELECT} FROM main.orders WHERE id = ?', (order_id,)).fetchone()
+    if not row:
+        row = conn.execute(f'SELECT {ORDER_SELECT} FROM archive.orders WHERE id = ?', (order_id,)).fetchone()
+    if not row:
+        return None
+    return OrderRecord(row)
+
+
+@DB_QUERY_SECONDS.timed(query="update_order_status")
+def update_order_status(order_id: int, new_status: str) -> bool:
+    """
+    Отмена возвращает зарезервированный товар на склад, выполнение - окончательно списывает.
+    Взятый в обработку заказ держит резерв без срока - до выполнения или отмены админом.
+    """
+    with transaction() as conn:
+        c = conn.execute('UPDATE orders SET status = ? WHERE id = ?', (new_status, order_id))
+        if c.rowcount and new_status == 'cancelled':
+            _release_stock(conn, [order_id])
+        elif c.rowcount and new_status == 'processing':
+            conn.execute('UPDATE stock_reservations SET expires_at = NULL WHERE order_id = ?', (order_id,))
+        elif c.rowcount and new_status == 'completed':
+            conn.execute('DELETE FROM stock_reservations WHERE order_id = ?', (order_id,))
+        return c.rowcount > 0
+
+
+@DB_QUERY_SECONDS.timed(query="update_order_payment_status")
+def update_order_payment_status(order_id: int, status: str) -> None:
+    with transaction() as conn:
+        conn.execute('UPDATE orders SET payment_status = ? WHERE id = ?', (status, order_id))
+
+
+# === Update journal ===
+@DB_QUERY_SECONDS.timed(query="journal_updates")
+def journal_updates(updates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Записывает пачку обновлений одной транзакцией. Возвращает только новые -
+    уже записанные (повторная доставка Telegram) пропускаются.
+    """
+    if not updates:
+        return []
+    with transaction() as conn:
+        ids = [u["update_id"] for u in updates]
+        known = {
+            row[0] for row in conn.execute(
+                f'SELECT update_id FROM update_journal WHERE update_id IN ({", ".join("?" * len(ids))})', ids
+            )
+        }
+        fresh = [u for u in updates if u["update_id"] not in known]
+        conn.executemany(
+            'INSERT OR IGNORE INTO update_journal (update_id, payload) VALUES (?, ?)',
+            [(u["update_id"], json.dumps(u, ensure_ascii=False)) for u in fresh],
+        )
+    return fresh
+
+
+@DB_QUERY_SECONDS.timed(query="finish_update")
+def finish_update(update_id: int, state: str = 'done') -> None:
+    """state: 'done' - обработано, 'failed' - обработчик упал (повторно не воспроизводится)."""
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE update_journal SET state = ?, done_at = CURRENT_TIMESTAMP WHERE update_id = ?", (state, update_id)
+        )
+
+
+def forget_update(update_id: int) -> None:
+    """Удаляет ещё не обработанное обновление, которое не удалось поставить в очередь: Telegram пришлёт его снова."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM update_journal WHERE update_id = ? AND state = 'pending'", (update_id,))
+
+
+def get_pending_updates() -> List[Dict[str, Any]]:
+    rows = get_conn().execute(
+        "SELECT payload FROM update_journal WHERE state = 'pending' ORDER BY update_id"
+    ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def get_journal_offset() -> int | None:
+    """offset для getUpdates: следующий после последнего записанного update_id."""
+    row = get_conn().execute('SELECT MAX(update_id) FROM update_journal').fetchone()
+    return row[0] + 1 if row[0] is not None else None
+
+
+def prune_update_journal(retention_days: float) -> int:
+    """Удаляет обработанные записи старше retention_days; последняя запись остаётся ради offset."""
+    with transaction() as conn:
+        return conn.execute(
+            """
+            DELETE FROM update_journal
+            WHERE state != 'pending' AND done_at < datetime('now', ?)
+              AND update_id < (SELECT MAX(update_id) FROM update_journal)
+            """,
+            (f'-{float(retention_days)} days',),
+        ).rowcount
+
+
+# === Payments ===
+# Переход payment_status для каждого статуса LiqPay: (новый статус, из каких можно перейти).
+# 'expired' - резерв снят по таймауту; поздняя оплата всё равно фиксируется, чтобы админ её увидел.
+PAYMENT_TRANSITIONS = {
+    'success': ('paid', ('pending', 'failed', 'expired')),
+    'failure': ('failed', ('pending',)),
+    'error': ('failed', ('pending',)),
+}
+AMOUNT_TOLERANCE = 0.01
+
+
+def _apply_payment(conn: sqlite3.Connection, order_id: int, status: str | None, amount: float | None,
+                   currency: str | None, data: str, signature: str) -> str:
+    # отклонённый callback тоже пишется в журнал - статус заказа не трогается
+    if amount is None:
+        rejected = 'invalid_amount'
+    elif currency and currency != 'UAH':
+        rejected = 'currency_mismatch'
+    else:
+        rejected = None
+    transition = None if rejected else PAYMENT_TRANSITIONS.get(status or '')
+    applied = []
+    if transition:
+        new_status, allowed = transition
+        applied = conn.execute(
+            f'''
+            UPDATE orders SET payment_status = ?
+            WHERE id = ? AND abs(total_price - ?) <= ?
+              AND payment_status IN ({", ".join("?" * len(allowed))})
+            RETURNING status
+            ''',
+            (new_status, order_id, amount, AMOUNT_TOLERANCE, *allowed),
+        ).fetchall()
+    if applied:
+        # оплата отменённого заказа: товар уже вернулся на склад - админ решает, вернуть деньги или собрать заново
+        result = 'paid_after_cancel' if new_status == 'paid' and applied[0][0] == 'cancelled' else 'applied'
+        if new_status == 'paid':
+            # оплаченный заказ держит резерв без срока
+            conn.execute('UPDATE stock_reservations SET expires_at = NULL WHERE order_id = ?', (order_id,))
+    elif rejected:
+        result = rejected
+    else:
+        row = conn.execute('SELECT total_price, payment_status FROM orders WHERE id = ?', (order_id,)).fetchone()
+        if not row:
+            result = 'not_found'
+        elif abs(row[0] - amount) > AMOUNT_TOLERANCE:
+            result = 'amount_mismatch'
+        elif transition and row[1] == transition[0]:
+            result = 'duplicate'
+        else:
+            result = 'ignored'
+    conn.execute(
+        '''
+        INSERT INTO payment_events (order_id, status, amount, currency, result, data, signature)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+        (order_id, status, amount, currency, result, data, signature),
+    )
+    return result
+
+
+@DB_QUERY_SECONDS.timed(query="apply_payment_callback")
+def apply_payment_callback(order_id: int, status: str | None, amount: float | None, currency: str | None,
+                           data: str, signature: str) -> str:
+    """
+    Записывает callback в payment_events и атомарно меняет payment_status одним условным UPDATE.
+
+    Результат: 'applied' - статус изменён, 'paid_after_cancel' - оплачен уже отменённый заказ (резерва нет),
+    'duplicate' - уже в этом статусе (повторный callback),
+    'ignored' - статус LiqPay без перехода или переход запрещён, 'amount_mismatch', 'not_found',
+    'invalid_amount' (amount=None - сумма не пришла или не число), 'currency_mismatch' (валюта не UAH).
+    SELECT выполняется только если UPDATE ничего не изменил - чтобы назвать причину.
+    """
+    with transaction() as conn:
+        return _apply_payment(conn, order_id, status, amount, currency, data, signature)
+
+
+@DB_QUERY_SECONDS.timed(query="apply_payment_results")
+def apply_payment_results(results: List[Tuple[int, str | None, float, str | None, str]],
+                          batch_size: int = 500) -> List[Tuple[int, str]]:
+    """
+    Пакетное применение статусов (order_id, status, amount, currency, data) из запросов статуса LiqPay:
+    одна транзакция на batch_size заказов. Возвращает (order_id, результат) в том же порядке.
+    """
+    applied: List[Tuple[int, str]] = []
+    for start in range(0, len(results), batch_size):
+        with transaction() as conn:
+            for order_id, status, amount, currency, data in results[start:start + batch_size]:
+                applied.append((order_id, _apply_payment(conn, order_id, status, amount, currency, data, '')))
+    return applied
+
+
+@DB_QUERY_SECONDS.timed(query="get_pending_payments")
+def get_pending_payments(older_than_minutes: float, limit: int = 5000) -> List[Tuple[int, float]]:
+    """(id, total_price) заказов в payment_status='pending', созданных раньше чем N минут назад."""
+    return get_conn().execute(
+        '''
+        SELECT id, total_price FROM orders
+        WHERE payment_status = 'pending' AND created_at < datetime('now', ?)
+        ORDER BY created_at LIMIT ?
+        ''',
+        (f'-{float(older_than_minutes)} minutes', limit),
+    ).fetchall()
+
+
+@DB_QUERY_SECONDS.timed(query="get_payment_events")
+def get_payment_events(order_id: int) -> List[Dict[str, Any]]:
+    cur = get_conn().execute('SELECT * FROM payment_events WHERE order_id = ? ORDER BY id', (order_id,))
+    names = [d[0] for d in cur.description]
+    return [dict(zip(names, row)) for row in cur]
+
+
+# === Archive ===
+ARCHIVE_STATUSES = ('completed', 'cancelled')
+
+
+@DB_QUERY_SECONDS.timed(query="archive_orders")
+def archive_orders(older_than_days: float, batch_size: int = 500, max_batches: int = 0) -> int:
+    """
+    Переносит завершённые и отменённые заказы старше older_than_days (с позициями и payment_events) в архив,
+    по batch_size заказов на транзакцию - запись бота ждёт не дольше одной пачки. Возвращает число заказов.
+
+    В WAL транзакция над двумя базами не атомарна между ними, поэтому перенос идемпотентен: копия в архив
+    через INSERT OR IGNORE, затем удаление из горячей базы. После сбоя посередине следующий запуск доделает пачку.
+    Агрегаты статистики не меняются: DELETE-триггеров на orders у них нет. Из поиска /find заказ уходит.
+    """
+    order_cols = ", ".join(ARCHIVE_ORDER_COLUMNS)
+    item_cols = ", ".join(ARCHIVE_ITEM_COLUMNS)
+    event_cols = ", ".join(ARCHIVE_EVENT_COLUMNS)
+    moved = batches = 0
+    while not max_batches or batches < max_batches:
+        with transaction() as conn:
+            ids = [row[0] for row in conn.execute(
+                f'''
+                SELECT id FROM main.orders
+                WHERE status IN ({", ".join("?" * len(ARCHIVE_STATUSES))}) AND created_at < datetime('now', ?)
+                ORDER BY id LIMIT ?
+                ''',
+                (*ARCHIVE_STATUSES, f'-{float(older_than_days)} days', batch_size),
+            )]
+            if not ids:
+                break
+            marks = ", ".join("?" * len(ids))
+            conn.execute(f'INSERT OR IGNORE INTO archive.orders ({order_cols}) '
+                         f'SELECT {order_cols} FROM main.orders WHERE id IN ({marks})', ids)
+            conn.execute(f'INSERT OR IGNORE INTO archive.order_items ({item_cols}) '
+                         f'SELECT {item_cols} FROM main.order_items WHERE order_id IN ({marks})', ids)
+            conn.execute(f'INSERT OR IGNORE INTO archive.payment_events ({event_cols}) '
+                         f'SELECT {event_cols} FROM main.payment_events WHERE order_id IN ({marks})', ids)
+            conn.execute(f'DELETE FROM main.order_items WHERE order_id IN ({marks})', ids)
+            conn.execute(f'DELETE FROM main.payment_events WHERE order_id IN ({marks})', ids)
+            conn.execute(f'DELETE FROM main.orders WHERE id IN ({marks})', ids)
+        moved += len(ids)
+        batches += 1
+    return moved
+
+
+def incremental_vacuum(max_pages: int = 0) -> int:
+    """
+    Возвращает файлу свободные страницы шагами по VACUUM_STEP_PAGES; каждый шаг - отдельная короткая запись.
+    Без auto_vacuum=INCREMENTAL прагма ничего не делает - тогда сразу 0.
+    """
+    if not incremental_vacuum_enabled():
+        return 0
+    conn = get_conn()
+    released = 0
+    while not max_pages or released < max_pages:
+        free = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+        if not free:
+            break
+        step = min(free, VACUUM_STEP_PAGES)
+        # через execute модуль sqlite3 делает один шаг - одну страницу; executescript выполняет прагму целиком
+        conn.executescript(f"PRAGMA main.incremental_vacuum({step});")
+        released += step
+    return released
+
+
+# === Inventory ===
+@DB_QUERY_SECONDS.timed(query="expire_reservations")
+def expire_reservations(limit: int = 500) -> List[int]:
+    """
+    Снимает просроченные резервы неоплаченных заказов: товар возвращается на склад,
+    заказ получает payment_status='expired' и status='cancelled'. Возвращает id таких заказов.
+    Только заказы в статусе new: взятый админом в работу заказ сам не отменяется.
+    """
+    with transaction() as conn:
+        # CROSS JOIN фиксирует порядок: обход идёт по частичному индексу idx_stock_reservations_expires
+        # (только просроченные резервы), а не по всем заказам в status='new'
+        order_ids = [row[0] for row in conn.execute(
+            '''
+            SELECT DISTINCT r.order_id FROM stock_reservations r CROSS JOIN orders o ON o.id = r.order_id
+            WHERE r.expires_at < CURRENT_TIMESTAMP AND o.payment_status IN ('pending', 'failed') AND o.status = 'new'
+            LIMIT ?
+            ''',
+            (limit,),
+        )]
+        if not order_ids:
+            return []
+        _release_stock(conn, order_ids)
+        conn.execute(
+            f"UPDATE orders SET payment_status = 'expired', status = 'cancelled' "
+            f"WHERE id IN ({', '.join('?' * len(order_ids))}) AND status = 'new'",
+            order_ids,
+        )
+        return order_ids
+
+
+def get_stock() -> Dict[Tuple[int, str], int]:
+    """{(product_id, option_id): остаток}; option_id = '' у товаров без вариантов."""
+    return {(row[0], row[1]): row[2] for row in get_conn().execute('SELECT product_id, option_id, qty FROM stock')}
+
+
+def get_stock_version() -> int:
+    return get_conn().execute('SELECT version FROM stock_version').fetchone()[0]
+
+
+@DB_QUERY_SECONDS.timed(query="set_stock")
+def set_stock(product_id: int, option_id: str | None, qty: int) -> None:
+    with transaction() as conn:
+        conn.execute(
+            '''
+            INSERT INTO stock (product_id, option_id, qty) VALUES (?, ?, ?)
+            ON CONFLICT (product_id, option_id) DO UPDATE SET qty = excluded.qty, updated_at = CURRENT_TIMESTAMP
+            ''',
+            (product_id, option_id or '', qty),
+        )
+
+
+@DB_QUERY_SECONDS.timed(query="adjust_stock")
+def adjust_stock(product_id: int, option_id: str | None, delta: int) -> int | None:
+    """Приход (delta > 0) или списание. Возвращает новый остаток, None - товар не учитывается или ушёл бы в минус."""
+    with transaction() as conn:
+        rows = conn.execute(
+            '''
+            UPDATE stock SET qty = qty + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE product_id = ? AND option_id = ? AND qty + ? >= 0
+            RETURNING qty
+            ''',
+            (delta, product_id, option_id or '', delta),
+        ).fetchall()
+        return rows[0][0] if rows else None
+
+
+def seed_stock(rows: List[Tuple[int, str | None, int]], overwrite: bool = False) -> int:
+    """Заводит остатки пачкой (product_id, option_id, qty); уже учитываемые не трогает, если не overwrite."""
+    conflict = 'DO UPDATE SET qty = excluded.qty, updated_at = CURRENT_TIMESTAMP' if overwrite else 'DO NOTHING'
+    with transaction() as conn:
+        c = conn.executemany(
+            f'INSERT INTO stock (product_id, option_id, qty) VALUES (?, ?, ?) ON CONFLICT (product_id, option_id) {conflict}',
+            [(pid, opt or '', qty) for pid, opt, qty in rows],
+        )
+        return c.rowcount
+
+
+@DB_QUERY_SECONDS.timed(query="get_stats")
+def get_stats(top: int = 5) -> Dict[str, Any]:
+    """Сводка из агрегатных таблиц: число прочитанных строк не зависит от размера orders."""
+    conn = get_conn()
+    by_status: Dict[str, int] = {}
+    by_payment: Dict[str, float] = {}
+    total = revenue = paid_revenue = 0
+    for status, payment_status, orders, rev in conn.execute(
+        'SELECT status, payment_status, orders, revenue FROM order_stats'
+    ):
+        total += orders
+        by_status[status] = by_status.get(status, 0) + orders
+        if status != 'cancelled':
+            revenue += rev
+            by_payment[payment_status] = by_payment.get(payment_status, 0) + rev
+            if payment_status == 'paid':
+                paid_revenue += rev
+
+    def bucket(table: str, key: str) -> Dict[str, Any]:
+        row = conn.execute(f'SELECT orders, revenue, paid_revenue FROM {table} WHERE bucket = {key}').fetchone()
+        return dict(zip(('orders', 'revenue', 'paid_revenue'), row or (0, 0.0, 0.0)))
+
+    top_products = [
+        {"product_id": pid, "name": name, "qty": qty, "revenue": rev}
+        for pid, name, qty, rev in conn.execute(
+            'SELECT product_id, name, qty, revenue FROM product_sales WHERE qty > 0 ORDER BY qty DESC LIMIT ?', (top,)
+        )
+    ]
+    return {
+        "total": total,
+        "new": by_status.get('new', 0),
+        "by_status": by_status,
+        "revenue": revenue,
+        "paid_revenue": paid_revenue,
+        "revenue_by_payment": by_payment,
+        "today": bucket('revenue_daily', "date('now')"),
+        "yesterday": bucket('revenue_daily', "date('now', '-1 day')"),
+        "this_hour": bucket('revenue_hourly', "strftime('%Y-%m-%d %H:00', 'now')"),
+        "top_products": top_products,
+    }
+
+
+# === Broadcasts ===
+BROADCAST_STATES = ('pending', 'sending', 'sent', 'blocked', 'failed', 'unknown')
+
+
+class BroadcastJob(NamedTuple):
+    id: int
+    status: str
+    text: str
+    category: str | None
+    created_at: str
+    finished_at: str | None
+    chat_id: int | None
+    message_id: int | None
+
+
+BROADCAST_SELECT = "id, status, text, category, created_at, finished_at, chat_id, message_id"
+
+
+@DB_QUERY_SECONDS.timed(query="create_broadcast")
+def create_broadcast(text: str, product_ids: List[int] | None = None, category: str | None = None,
+                     created_by: int | None = None) -> Tuple[int, int]:
+    """
+    Черновик рассылки: получатели - все, кто оформлял заказы (и в архиве тоже), кроме отменённых заказов.
+    product_ids - только купившие эти товары (категория). Заблокировавшие бота пропускаются, если не заказывали
+    после блокировки. Возвращает (id задания, число получателей).
+    """
+    where = "o.status != 'cancelled'"
+    params: List[Any] = []
+    if product_ids is not None:
+        marks = ", ".join("?" * len(product_ids)) or "NULL"
+        where += f" AND o.id IN (SELECT order_id FROM {{db}}.order_items WHERE product_id IN ({marks}))"
+        params = list(product_ids)
+    with transaction() as conn:
+        job_id = conn.execute(
+            'INSERT INTO broadcast_jobs (text, category, created_by) VALUES (?, ?, ?)', (text, category, created_by)
+        ).lastrowid
+        conn.execute(
+            f'''
+            WITH customers(user_id, last_order) AS (
+                SELECT user_id, MAX(created_at) FROM (
+                    SELECT o.user_id, o.created_at FROM main.orders o WHERE {where.format(db="main")}
+                    UNION ALL
+                    SELECT o.user_id, o.created_at FROM archive.orders o WHERE {where.format(db="archive")}
+                ) GROUP BY user_id
+            )
+            INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT ?, c.user_id FROM customers c
+            WHERE NOT EXISTS (
+                SELECT 1 FROM broadcast_recipients b
+                WHERE b.user_id = c.user_id AND b.state = 'blocked' AND b.updated_at >= c.last_order
+            )
+            ''',
+            (*params, *params, job_id),
+        )
+        total = conn.execute('SELECT COUNT(*) FROM broadcast_recipients WHERE job_id = ?', (job_id,)).fetchone()[0]
+    return job_id, total
+
+
+def get_broadcast(job_id: int) -> BroadcastJob | None:
+    row = get_conn().execute(f'SELECT {BROADCAST_SELECT} FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+    return BroadcastJob._make(row) if row else None
+
+
+def list_broadcasts(limit: int = 5) -> List[BroadcastJob]:
+    rows = get_conn().execute(f'SELECT {BROADCAST_SELECT} FROM broadcast_jobs ORDER BY id DESC LIMIT ?', (limit,))
+    return list(map(BroadcastJob._make, rows))
+
+
+def get_running_broadcasts() -> List[int]:
+    return [row[0] for row in get_conn().execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")]
+
+
+@DB_QUERY_SECONDS.timed(query="broadcast_progress")
+def broadcast_progress(job_id: int) -> Dict[str, int]:
+    """Число получателей по состояниям (все BROADCAST_STATES, нулевые тоже)."""
+    counts = dict.fromkeys(BROADCAST_STATES, 0)
+    counts.update(get_conn().execute(
+        'SELECT state, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY state', (job_id,)
+    ).fetchall())
+    return counts
+
+
+def start_broadcast(job_id: int, chat_id: int, message_id: int) -> bool:
+    """draft -> running; chat_id/message_id - сообщение админа, в котором показывается прогресс."""
+    with transaction() as conn:
+        return conn.execute(
+            "UPDATE broadcast_jobs SET status = 'running', chat_id = ?, message_id = ? WHERE id = ? AND status = 'draft'",
+            (chat_id, message_id, job_id),
+        ).rowcount > 0
+
+
+def cancel_broadcast(job_id: int) -> bool:
+    with transaction() as conn:
+        return conn.execute(
+            "UPDATE broadcast_jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status IN ('draft', 'running')",
+            (job_id,),
+        ).rowcount > 0
+
+
+def finish_broadcast(job_id: int) -> bool:
+    """running -> done, если не осталось получателей в pending и sending."""
+    with transaction() as conn:
+        return conn.execute(
+            '''
+            UPDATE broadcast_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running' AND NOT EXISTS (
+                SELECT 1 FROM broadcast_recipients WHERE job_id = ? AND state IN ('pending', 'sending')
+            )
+            ''',
+            (job_id, job_id),
+        ).rowcount > 0
+
+
+@DB_QUERY_SECONDS.timed(query="claim_broadcast_recipients")
+def claim_broadcast_recipients(job_id: int, limit: int) -> List[int]:
+    """pending -> sending для следующих limit получателей; пусто, если задание уже не running."""
+    with transaction() as conn:
+        rows = conn.execute(
+            '''
+            UPDATE broadcast_recipients SET state = 'sending', updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND user_id IN (
+                SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND state = 'pending' LIMIT ?
+            ) AND EXISTS (SELECT 1 FROM broadcast_jobs WHERE id = ? AND status = 'running')
+            RETURNING user_id
+            ''',
+            (job_id, job_id, limit, job_id),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+@DB_QUERY_SECONDS.timed(query="record_broadcast_results")
+def record_broadcast_results(job_id: int, results: List[Tuple[int, str, str | None]]) -> None:
+    """[(user_id, sent | blocked | failed, ошибка)] одной транзакцией; меняются только строки в sending."""
+    if not results:
+        return
+    with transaction() as conn:
+        conn.executemany(
+            "UPDATE broadcast_recipients SET state = ?, error = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE job_id = ? AND user_id = ? AND state = 'sending'",
+            [(state, error, job_id, user_id) for user_id, state, error in results],
+        )
+
+
+def recover_broadcasts() -> int:
+    """При старте: получатели, оставшиеся в sending, -> unknown (сообщение могло уйти). Возвращает их число."""
+    with transaction() as conn:
+        return conn.execute(
+            "UPDATE broadcast_recipients SET state = 'unknown', updated_at = CURRENT_TIMESTAMP WHERE state = 'sending'"
+        ).rowcount
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Обслуживание базы заказов")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="перевести основную базу в auto_vacuum=INCREMENTAL (полный VACUUM, долгая блокировка)")
+    args = parser.parse_args()
+
+    if not args.enable_incremental_vacuum:
+        parser.print_help()
+        return 1
+    if enable_incremental_vacuum():
+        print(f"auto_vacuum=INCREMENTAL включён: {DB_PATH}")
+    else:
+        print(f"auto_vacuum=INCREMENTAL уже включён: {DB_PATH}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
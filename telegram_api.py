@@ -0,0 +1,209 @@
+"""
+Исходящие вызовы Telegram Bot API.
+
+TelegramClient - keep-alive сессия с пулом соединений и повторами с учётом retry_after.
+OutboundSender - очередь отправки с приоритетами и лимитами Telegram
+(~30 сообщений/с на бота и 1 сообщение/с в один чат).
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import profiling
+from metrics import SEND_ERRORS, TELEGRAM_API_SECONDS
+from ratelimit import KeyedBuckets, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Чем меньше число, тем раньше уходит сообщение
+PRIORITY_ADMIN = 0
+PRIORITY_CUSTOMER = 1
+PRIORITY_BULK = 2
+
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+MAX_BACKOFF = 60
+
+
+def _backoff(attempt: int) -> float:
+    return min(MAX_BACKOFF, 0.5 * 2 ** attempt)
+
+
+def _retry_after(result: Dict[str, Any]) -> float | None:
+    """Сколько ждать перед повтором; None - ошибка окончательная (400, 403 и т.п.)."""
+    code = result.get("error_code") or 0
+    if code == 429:
+        return float(result.get("parameters", {}).get("retry_after", 1))
+    if code == 0 or code >= 500:
+        return 0.0
+    return None
+
+
+class TelegramClient:
+    def __init__(self, api_url: str, pool_size: int = 16, max_retries: int = 3):
+        self.api_url = api_url
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, payload: Dict[str, Any], timeout: float = 10) -> Dict[str, Any]:
+        """Один вызов без повторов. Сетевые ошибки возвращаются как error_code=0."""
+        try:
+            with TELEGRAM_API_SECONDS.time(method=method):
+                resp = self.session.post(self.api_url + method, json=payload, timeout=timeout)
+        except requests.RequestException as e:
+            return {"ok": False, "error_code": 0, "description": str(e)}
+        try:
+            return resp.json()
+        except ValueError:
+            return {"ok": False, "error_code": resp.status_code, "description": resp.text[:200]}
+
+    def call(self, method: str, payload: Dict[str, Any], timeout: float = 10, retries: int | None = None) -> Dict[str, Any]:
+        """Синхронный вызов с повторами на 429/5xx/сетевых ошибках."""
+        retries = self.max_retries if retries is None else retries
+        attempt = 0
+        while True:
+            result = self.request(method, payload, timeout)
+            if result.get("ok"):
+                return result
+            wait = _retry_after(result)
+            if wait is None or attempt >= retries:
+                logger.error("Telegram %s failed: %s", method, result.get("description"))
+                SEND_ERRORS.inc(method=method, code=result.get("error_code") or 0)
+                return result
+            time.sleep(wait or _backoff(attempt))
+            attempt += 1
+
+
+class _Outgoing:
+    __slots__ = ("chat_id", "method", "payload", "on_done", "attempts", "trace", "queued")
+
+    def __init__(self, chat_id: int, method: str, payload: Dict[str, Any], on_done: Callable[[Dict[str, Any]], None] | None):
+        self.chat_id = chat_id
+        self.method = method
+        self.payload = payload
+        self.on_done = on_done
+        self.attempts = 0
+        # обновление, при обработке которого поставлено сообщение: по нему отчитывается задержка доставки
+        self.trace = profiling.current()
+        self.queued = time.perf_counter()
+
+
+class OutboundSender:
+    """Фоновая отправка: приоритетная очередь + token bucket'ы, повторы не блокируют воркеры."""
+
+    def __init__(self, client: TelegramClient, workers: int = 4, global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE, max_attempts: int = 8):
+        self.client = client
+        self.max_attempts = max_attempts
+        self._workers = max(1, workers)
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = KeyedBuckets(chat_rate, 1)
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._ready: List[Tuple[int, int, _Outgoing]] = []
+        self._delayed: List[Tuple[float, int, int, _Outgoing]] = []
+        self._in_flight = 0
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        for i in range(self._workers):
+            t = threading.Thread(target=self._worker, name=f"tg-sender-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, method: str, payload: Dict[str, Any], chat_id: int, priority: int = PRIORITY_CUSTOMER,
+               on_done: Callable[[Dict[str, Any]], None] | None = None) -> None:
+        with profiling.span(f"outbox:{method}"), self._cond:
+            heapq.heappush(self._ready, (priority, next(self._seq), _Outgoing(chat_id, method, payload, on_done)))
+            self._cond.notify()
+
+    def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_CUSTOMER,
+                     on_done: Callable[[Dict[str, Any]], None] | None = None, **params: Any) -> None:
+        payload: Dict[str, Any] = {"chat_id": chat_id, "text": text}
+        payload.update({k: v for k, v in params.items() if v is not None})
+        self.submit("sendMessage", payload, chat_id, priority, on_done)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._ready) + len(self._delayed) + self._in_flight
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Досылает очередь (включая отложенные повторы) и останавливает воркеры."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _next(self) -> Tuple[int, _Outgoing] | None:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, priority, seq, item = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (priority, seq, item))
+
+                if self._ready:
+                    priority, seq, item = self._ready[0]
+                    chat_wait = self._chats.get(item.chat_id, now).wait_time(now)
+                    if chat_wait > 0:
+                        # чат упёрся в лимит - откладываем, не задерживая остальные чаты
+                        heapq.heappop(self._ready)
+                        heapq.heappush(self._delayed, (now + chat_wait, priority, seq, item))
+                        continue
+                    global_wait = self._global.take(now)
+                    if global_wait == 0:
+                        heapq.heappop(self._ready)
+                        self._chats.get(item.chat_id, now).take(now)
+                        self._in_flight += 1
+                        return priority, item
+                    self._cond.wait(global_wait)
+                    continue
+
+                if self._stopping and not self._delayed and not self._in_flight:
+                    self._cond.notify_all()
+                    return None
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _worker(self) -> None:
+        while True:
+            nxt = self._next()
+            if nxt is None:
+                return
+            priority, item = nxt
+            started = time.perf_counter()
+            result = self.client.request(item.method, item.payload)
+            item.attempts += 1
+            wait = None if result.get("ok") else _retry_after(result)
+
+            with self._cond:
+                self._in_flight -= 1
+                if wait is not None and item.attempts < self.max_attempts:
+                    ready_at = time.monotonic() + (wait or _backoff(item.attempts))
+                    heapq.heappush(self._delayed, (ready_at, priority, next(self._seq), item))
+                    item = None
+                self._cond.notify_all()
+
+            if item is None:
+                continue
+            profiling.sent(item.trace, item.method, item.queued, started, result)
+            if not result.get("ok"):
+                logger.error("Send Error: %s %s to %s: %s", item.method, result.get("error_code"), item.chat_id, result.get("description"))
+                SEND_ERRORS.inc(method=item.method, code=result.get("error_code") or 0)
+            if item.on_done:
+                try:
+                    item.on_done(result)
+                except Exception as e:
+                    logger.error("Send callback error: %s", e)
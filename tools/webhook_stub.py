@@ -0,0 +1,65 @@
+﻿"""
+Локальная заглушка Telegram: шлёт обновления на webhook бота.
+
+Запуск:
+    python tools/webhook_stub.py --secret <WEBHOOK_SECRET> --count 100
+    python tools/webhook_stub.py --secret <WEBHOOK_SECRET> --file updates.jsonl
+"""
+import argparse
+import json
+import sys
+import time
+
+import requests
+
+
+def synthetic_updates(count: int, chats: int, start_id: int):
+    for i in range(count):
+        chat_id = 100000 + i % chats
+        yield {
+            "update_id": start_id + i,
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "first_name": "Test", "username": f"user{chat_id}"},
+                "text": "/start",
+            },
+        }
+
+
+def file_updates(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram/webhook")
+    parser.add_argument("--secret", required=True)
+    parser.add_argument("--file", help="JSONL с обновлениями (по одному на строку)")
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--start-id", type=int, default=int(time.time()))
+    args = parser.parse_args()
+
+    updates = file_updates(args.file) if args.file else synthetic_updates(args.count, args.chats, args.start_id)
+    session = requests.Session()
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret}
+    codes: dict = {}
+    started = time.perf_counter()
+    for upd in updates:
+        resp = session.post(args.url, json=upd, headers=headers, timeout=10)
+        codes[resp.status_code] = codes.get(resp.status_code, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    total = sum(codes.values())
+    print(f"Отправлено: {total} за {elapsed:.2f} с ({total / elapsed if elapsed else 0:.0f} upd/s)")
+    print("Ответы:", ", ".join(f"{code}: {cnt}" for code, cnt in sorted(codes.items())))
+    return 0 if set(codes) <= {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+﻿"""
+Приём обновлений Telegram через webhook (альтернатива getUpdates).
+
+Сервер проверяет X-Telegram-Bot-Api-Secret-Token, сразу отвечает 200 и кладёт
+обновление во внутреннюю ограниченную очередь. Если очередь переполнена - 503,
+Telegram повторит доставку позже.
+"""
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    server: "WebhookServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _reply(self, code: int) -> None:
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self) -> None:
+        if self.path != self.server.webhook_path:
+            return self._reply(404)
+
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.server.secret_token.encode()):
+            logger.warning("Webhook: invalid secret token from %s", self.client_address[0])
+            return self._reply(403)
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > MAX_BODY_SIZE:
+            return self._reply(400)
+        try:
+            upd = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._reply(400)
+        if not isinstance(upd, dict) or "update_id" not in upd:
+            return self._reply(400)
+
+        if self.server.accept(upd):
+            self._reply(200)
+        else:
+            logger.warning("Webhook: queue is full, update %s rejected", upd["update_id"])
+            self._reply(503)
+
+    def do_GET(self) -> None:
+        self._reply(200 if self.path == "/health" else 404)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, accept: Callable[[Dict[str, Any]], bool], secret_token: str,
+                 host: str = "0.0.0.0", port: int = 8443, path: str = "/telegram/webhook"):
+        if not secret_token:
+            raise ValueError("webhook secret token is required")
+        self.accept = accept
+        self.secret_token = secret_token
+        self.webhook_path = path
+        super().__init__((host, port), _WebhookHandler)
+
+    def start(self) -> threading.Thread:
+        t = threading.Thread(target=self.serve_forever, name="webhook-server", daemon=True)
+        t.start()
+        return t